@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from decouple import config
+from runner import RunTest, _run_databases
+from service.db import DB, AsyncDB, drop_database
+from service.fixtures import run_fixture
+from mock_gate import FakeAsyncDB
+from schedule import CaseSchedule, SCHEDULE_TIMEOUT
+from templates import device_identifiers
+from framing import frame_reader, read_frames_async
+from profiler import PROFILER, phase
+
+
+class AsyncRunTest(RunTest):
+    """RunTest variant that drives every connection of every case on one asyncio event loop.
+
+    Socket I/O runs on the loop with asyncio.open_connection and DB work goes through
+    AsyncDB; the blocking NSQ checks are handed to a bounded thread pool so thousands
+    of sessions can stay open.
+    """
+
+    def __init__(self, mock_gate=None, metrics=None):
+        super().__init__(mock_gate, metrics)
+        self.check_workers = config('ASYNC_CHECK_WORKERS', default=64, cast=int)
+        self._shared_adb = FakeAsyncDB(mock_gate.db) if mock_gate else AsyncDB()
+
+    def _pools(self):
+        pools = super()._pools()
+        if hasattr(self._shared_adb, 'metrics'):
+            pools['async'] = self._shared_adb
+        return pools
+
+    @property
+    def _adb(self):
+        run = _run_databases.get()
+        return run['adb'] if run else self._shared_adb
+
+    def run(self, files=None, jobs=1):
+        asyncio.run(self._run_all(self._plan_runs(self._payload_files(files), jobs), jobs))
+
+    def run_test_tcp(self, filename: str, variables=None, case_indexes=None):
+        asyncio.run(self._run_all([(filename, case_indexes, variables)], 1))
+
+    async def _run_all(self, planned, jobs):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.check_workers))
+        semaphore = asyncio.Semaphore(max(jobs, 1))
+
+        async def _run_planned(p):
+            async with semaphore:
+                await self._run_planned_async(p)
+
+        try:
+            # one thread drives every connection, it is the one worker to cProfile
+            with PROFILER.worker():
+                if jobs <= 1:
+                    for p in planned:
+                        await self._run_planned_async(p)
+                else:
+                    await asyncio.gather(*(_run_planned(p) for p in planned))
+                    print('\nFAILED: ', self.error_test_case)
+        finally:
+            await self._shared_adb.close()
+
+    async def _run_planned_async(self, planned):
+        file_path, case_indexes, variables = planned
+        file_name = os.path.basename(file_path)
+        print(f"\n[INFO] Running test case: {file_name}")
+        try:
+            with phase('run'):
+                await self.run_test_tcp_async(file_path, variables, case_indexes)
+        except FileNotFoundError:
+            print(f"[ERROR] File not found: {file_path}")
+        except json.JSONDecodeError as e:
+            print(f"[ERROR] Invalid JSON in {file_name}: {e}")
+        except ValueError as e:
+            print(f"[ERROR] {file_name}: {e}")
+
+    async def run_test_tcp_async(self, filename: str, variables=None, case_indexes=None):
+        test_case, run_nsq = await asyncio.to_thread(self._prepare_test_case, filename, variables)
+        msg_type = test_case.get('message_type', 'hex')
+        device_type = test_case.get('device_type')
+        identifiers = device_identifiers(variables) if variables else None
+        isolation = self._isolation(test_case, variables)
+        with phase('isolation'):
+            token = await self._begin_isolation_async(isolation) if isolation else None
+        try:
+            await self._run_cases_async(test_case, case_indexes, msg_type, device_type, identifiers, isolation,
+                                        run_nsq)
+        finally:
+            if token:
+                await self._end_isolation_async(token)
+        print('\nFAILED: ', self.error_test_case)
+
+    async def _begin_isolation_async(self, isolation):
+        """Async counterpart of RunTest._begin_isolation; the clone gets an AsyncDB as well."""
+        mode, snapshot, template = isolation
+        token = None
+        if mode == 'template' and not self.mock_gate:
+            name = await asyncio.to_thread(self._clone_run_database, snapshot, template)
+            db = await asyncio.to_thread(DB, maxconn=4, database=name)
+            token = _run_databases.set({'name': name, 'db': db, 'adb': AsyncDB(database=name)})
+        if mode != 'reset':
+            await asyncio.to_thread(snapshot.capture, self._db)
+        return token
+
+    async def _end_isolation_async(self, token):
+        run = _run_databases.get()
+        _run_databases.reset(token)
+        await run['adb'].close()
+        run['db'].close()
+        await asyncio.to_thread(drop_database, run['name'])
+
+    async def _run_cases_async(self, test_case, case_indexes, msg_type, device_type, identifiers, isolation,
+                               run_nsq=False):
+        host, port = self._gate_address()
+        impair = test_case.get('impair', self.impair)
+        for case_idx, case in enumerate(test_case.get('test_case', [])):
+            if case_indexes is not None and case_idx not in case_indexes:
+                continue
+
+            connections = case.get('connections')
+            if not connections:
+                print(f"[WARN] No 'connection' section in case: {case.get('name')}")
+                continue
+            if isolation:
+                _, snapshot, _ = isolation
+                start = time.perf_counter()
+                with phase('isolation'):
+                    await self._adb.save_many(snapshot.restore_statements())
+                self.metrics.observe('isolation_reset', time.perf_counter() - start)
+
+            # same schedule as RunTest, with events that are awaitable on the loop
+            schedule = self._case_schedule(case, asyncio.Event)
+            if schedule is None:
+                continue
+
+            tasks = []
+            for idx, conn in enumerate(connections, start=1):
+                host, port, delay = self._connection_address(conn['steps'], host, port)
+                link_host, link_port = self._link_address(conn['steps'], host, port, impair, msg_type)
+
+                if not schedule.delays_start(idx):
+                    with phase('delay'):
+                        await asyncio.sleep(delay)
+                    delay = 0
+                tasks.append(asyncio.create_task(
+                    self._run_connection_steps_async(idx, link_host, link_port, conn['steps'], msg_type, device_type,
+                                                     case['name'], schedule, identifiers, delay, run_nsq)
+                ))
+
+            with phase('join'):
+                await asyncio.gather(*tasks)
+
+    async def _wait_schedule_async(self, events, what):
+        with phase('schedule_wait'):
+            for event in events:
+                try:
+                    await asyncio.wait_for(event.wait(), SCHEDULE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"{what} waited {SCHEDULE_TIMEOUT}s for a preceding step")
+
+    async def _read_ack_async(self, stream: asyncio.StreamReader, reader, step: dict, timings=None):
+        """Async counterpart of RunTest._read_ack."""
+        return await read_frames_async(stream, reader, *self._ack_wait(step), timings)
+
+    async def _wait_db_async(self, db: dict):
+        """Async counterpart of RunTest._wait_db, querying through AsyncDB."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + db.get('timeout', self.db_check_timeout)
+        backoff = self.db_backoff_initial
+
+        while True:
+            with phase('db_query'):
+                result = await self._adb.fetch_one_dict(db['query'], db.get('params', []))
+            mismatches = self._db_row_mismatches(db, result)
+            remaining = deadline - loop.time()
+            if not mismatches or remaining <= 0:
+                return mismatches
+
+            wait = min(backoff, remaining)
+            with phase('db_backoff'):
+                if self._db_notifier:
+                    await asyncio.to_thread(self._db_notifier.wait, wait)
+                else:
+                    await asyncio.sleep(wait)
+            backoff = min(backoff * 2, self.db_backoff_max)
+
+    async def _check_db_async(self, step: dict, step_result: dict):
+        if 'db_check' not in step:
+            step_result["db"] = "skipped"
+            return
+
+        db_pass = True
+        for db in step['db_check']:
+            if db.get('delay'):
+                with phase('delay'):
+                    await asyncio.sleep(db['delay'])
+
+            if not db.get('query'):
+                continue
+
+            mismatches = await self._wait_db_async(db)
+            if mismatches:
+                db_pass = False
+                step_result['notes'] += ''.join(mismatches)
+
+        step_result["db"] = db_pass
+        self._mark_visible(step_result, 'db_visible', db_pass)
+
+    async def _run_connection_steps_async(self, conn_id: int, host, port, steps, msg_type: str, device_type: str,
+                                          case_name: str, schedule: CaseSchedule, identifiers=None, delay=0,
+                                          run_nsq=False):
+        writer = None
+        connected = False
+        try:
+            await self._wait_schedule_async(schedule.start_waits(conn_id), f"Conn-{conn_id}")
+            with phase('delay'):
+                await asyncio.sleep(delay)
+            connect_started = time.perf_counter()
+            with phase('connect'):
+                stream, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=30)
+            self._record_connect(case_name, device_type, connect_started)
+            connected = True
+            session_started = time.perf_counter()
+            reader = frame_reader(msg_type, device_type)
+
+            for pos, step in enumerate(steps):
+                step: dict
+                step_name = step.get('name')
+                if not step_name:
+                    continue
+                step_result = {
+                    "status": "pass",
+                    "notes": "",
+                    "conn": True,
+                    "started": time.perf_counter(),
+                    "timings": {}
+                }
+
+                try:
+                    await self._wait_schedule_async(schedule.step_waits(conn_id, pos, step), step_name)
+                    with phase('replay_wait'):
+                        await asyncio.sleep(self._replay_delay(step, session_started))
+                    step_result['started'] = time.perf_counter()
+                    with phase('encode_send'):
+                        msg = self._encode_send(step, msg_type)
+
+                    # Run pre_test SQL if any
+                    if step.get('pre_test'):
+                        with phase('pre_test'):
+                            for kind, item in self._pre_test_batches(step):
+                                if kind == 'fixture':
+                                    # COPY needs a synchronous connection
+                                    await asyncio.to_thread(run_fixture, self._db, item)
+                                else:
+                                    await self._adb.save_many(item)
+                        with phase('settle'):
+                            await asyncio.sleep(step.get('settle', self.pre_test_settle))
+
+                    step_result['timings']['sent'] = time.perf_counter()
+                    with phase('send'):
+                        writer.write(msg)
+                        await writer.drain()
+                    reader.sent(msg)
+
+                    # ACK checker
+                    frames, closed = await self._read_ack_async(stream, reader, step, step_result['timings'])
+                    if closed and step != steps[-1]:
+                        step_result['conn'] = False
+                        step_result['notes'] += ', connection closed by server'
+
+                    with phase('check_ack'):
+                        self._check_ack(step, frames, msg_type, step_result)
+
+                    if step == steps[-1] and step_result['conn']:
+                        writer.close()
+                        step_result['conn'] = True
+
+                    await self._check_db_async(step, step_result)
+                    await asyncio.to_thread(self._check_nsq, step, step_result, identifiers, run_nsq)
+
+                except Exception as e:
+                    step_result["status"] = "FAILED!"
+                    step_result["error"] = str(e)
+
+                self._report_step(step_result, case_name, step_name, identifiers, device_type)
+                schedule.finish(conn_id, pos)
+
+        except Exception as e:
+            print(f"[ERROR] Conn-{conn_id}: connection failed — {e}")
+            self.metrics.inc('failures_total', reason='connect')
+        finally:
+            schedule.release(conn_id)
+            if writer is not None and not writer.is_closing():
+                writer.close()
+            if connected:
+                self._record_disconnect()
@@ -0,0 +1,273 @@
+import os
+import gc
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import platform
+import yaml
+from datetime import datetime, timezone
+from helper import replace_variables, expand_templates, split_hex, load_payload
+from scenario import Scenario, read_raw, compile_payload
+from framing import ConcoxFrameReader
+from service.nsq_index import NsqIndex
+from templates import device_vars, nsq_data, db_check_device
+from mock_gate import MockGate
+from runner import RunTest
+
+BASELINE = 'benchmarks/baseline.json'
+PAYLOAD_FOLDER = 'src/payloads'
+SEED_PAYLOAD = 'test_case_concox.yml'
+
+
+# WORKLOADS
+# every workload is a factory: setup runs once, the returned callable is timed and returns its op count
+def _large_payload_file(copies=50):
+    """The concox payload with its cases repeated `copies` times, written to a temp YAML file."""
+    tree = read_raw(os.path.join(PAYLOAD_FOLDER, SEED_PAYLOAD))
+    tree = dict(tree, test_case=tree['test_case'] * copies)
+    fd, path = tempfile.mkstemp(suffix='.yml', prefix='bench_payload_')
+    with os.fdopen(fd, 'w') as f:
+        yaml.safe_dump(tree, f)
+    return path, tree
+
+
+def bench_payload_expand():
+    """The pre-compile load path: replace_variables + expand_templates over a parsed payload."""
+    path, tree = _large_payload_file()
+    os.unlink(path)
+    variables = device_vars(1)
+
+    def run():
+        expand_templates(replace_variables(tree, variables), variables)
+        return len(tree['test_case'])
+    return run
+
+
+def bench_payload_compile():
+    """Compiling the same payload into a Scenario, done once per file and process."""
+    path, tree = _large_payload_file()
+    os.unlink(path)
+
+    def run():
+        Scenario(path, tree)
+        return len(tree['test_case'])
+    return run
+
+
+def bench_payload_bind():
+    """load_payload with the compiled payload cached: only the per-device binding."""
+    path, tree = _large_payload_file()
+    compile_payload(path)
+    slots = iter(range(1, 10 ** 9))
+
+    def run():
+        load_payload(path, device_vars(next(slots)))
+        return len(tree['test_case'])
+    run.cleanup = lambda: os.unlink(path)
+    return run
+
+
+def _ack_buffer(size_mb=4):
+    # login ACK, a frame with 0d0a inside and a 7979 long frame
+    frames = bytes.fromhex('787805010001d9dc0d0a' '787807130d0a0d0a00010d0a' '79790006aabb0d0accdd0d0a')
+    return frames * (size_mb * 1024 * 1024 // len(frames))
+
+
+def bench_split_hex():
+    """split_hex over a multi-megabyte concox ACK buffer given as hex, like received data used to be."""
+    msg = _ack_buffer().hex()
+
+    def run():
+        return len(split_hex('concox', msg))
+    return run
+
+
+def bench_frame_reader_stream():
+    """The same buffer streamed through one ConcoxFrameReader in 4 KB recv chunks."""
+    data = _ack_buffer()
+
+    def run():
+        reader = ConcoxFrameReader()
+        count = 0
+        for i in range(0, len(data), 4096):
+            count += len(reader.feed(data[i:i + 4096]))
+        return count
+    return run
+
+
+def bench_nsq_index(messages=10_000, devices=500):
+    """10k queued NSQ messages for 500 devices, then every one matched like the NSQ checks do."""
+    bodies, expected = [], []
+    for i in range(messages):
+        imei = f"123900{i % devices:09d}"
+        msg = nsq_data(imei, f"7878{i:08x}0d0a", 'x3', 'concox')
+        bodies.append(json.dumps(dict(msg, received_on=datetime.now().isoformat())).encode())
+        expected.append(msg)
+
+    def run():
+        index = NsqIndex()
+        for body in bodies:
+            index.add(body)
+        for msg in expected:
+            if not index.wait_match(msg, 0):
+                raise AssertionError(f"message not matched: {msg}")
+        return messages
+    return run
+
+
+def bench_db_assertions(checks=10_000):
+    """The db_check loop: query through the DB layer and compare every assertion."""
+    gate = MockGate()
+    tester = RunTest(gate)
+    date_now = datetime.now().isoformat()
+    db_checks = []
+    for i in range(checks):
+        db = db_check_device(f"123900{i:09d}", 'concox', 'x3', 0, False, date_now)
+        row = dict(db['assertions'], connection_status_time=datetime.now(timezone.utc))
+        gate.db.put(db['query'], db['params'], row)
+        db_checks.append(db)
+
+    def run():
+        for db in db_checks:
+            if tester._wait_db(db):
+                raise AssertionError(f"db check failed: {db}")
+        return checks
+    return run
+
+
+def bench_mock_gate_connections(devices=1000):
+    """1k devices playing the gate command payload concurrently against the mock gate, ACK checks only."""
+    from load import LoadWorker, _raise_fd_limit
+    _raise_fd_limit()
+    file_path = os.path.join(PAYLOAD_FOLDER, 'test_gate_command.yml')
+    gate = MockGate().start()
+    slots = list(range(1, devices + 1))
+    for slot in slots:
+        gate.learn(load_payload(file_path, device_vars(slot)), key=(file_path, slot))
+
+    def run():
+        worker = LoadWorker(file_path, slots, gate_address=gate.address)
+        stats = asyncio.run(worker.run(time.time()))
+        if stats['ack_mismatches'] or stats['connect_failures'] or stats['errors']:
+            raise AssertionError(f"load run failed: {stats}")
+        return stats['connections']
+    run.cleanup = gate.stop
+    return run
+
+
+BENCHMARKS = {
+    'payload_expand': bench_payload_expand,
+    'payload_compile': bench_payload_compile,
+    'payload_bind': bench_payload_bind,
+    'split_hex_4mb': bench_split_hex,
+    'frame_reader_stream_4mb': bench_frame_reader_stream,
+    'nsq_index_10k': bench_nsq_index,
+    'db_assertions_10k': bench_db_assertions,
+    'mock_gate_1k_connections': bench_mock_gate_connections,
+}
+
+
+# RUNNER
+def measure(factory, repeat):
+    """Best wall time of `repeat` runs, with gc off while timing like timeit."""
+    run = factory()
+    times = []
+    ops = 0
+    try:
+        for _ in range(repeat):
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                ops = run()
+                times.append(time.perf_counter() - start)
+            finally:
+                gc.enable()
+    finally:
+        if hasattr(run, 'cleanup'):
+            run.cleanup()
+    best = min(times)
+    return {'best': round(best, 6), 'mean': round(sum(times) / len(times), 6), 'ops': ops,
+            'ops_per_sec': round(ops / best, 1) if best else None}
+
+
+def load_baseline(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    """Names of the benchmarks slower than baseline * (1 + tolerance)."""
+    regressions = []
+    for name, result in results.items():
+        base = (baseline or {}).get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = result['best'] / base['best'] if base['best'] else 0
+        result['baseline'] = base['best']
+        result['ratio'] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the runner's hot paths on synthetic workloads.")
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best one counts')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON to compare against')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slowdown against the baseline before failing, 0.5 = 50%%')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        print(f"[ERROR] Unknown benchmarks: {unknown}")
+        return 2
+
+    results = {}
+    for name in names:
+        results[name] = measure(BENCHMARKS[name], args.repeat)
+        print(f"[BENCH] {name:<26} best {results[name]['best'] * 1000:10.2f} ms"
+              f"  {results[name]['ops_per_sec'] or 0:>14,.0f} ops/s")
+
+    baseline = load_baseline(args.baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    for name in names:
+        if 'ratio' in results[name]:
+            flag = '  REGRESSION' if name in regressions else ''
+            print(f"[BENCH] {name:<26} x{results[name]['ratio']:.2f} of baseline{flag}")
+
+    if args.save:
+        data = dict(baseline or {}, machine=platform.platform(), python=platform.python_version(),
+                    saved=datetime.now().isoformat(timespec='seconds'))
+        data['results'] = dict((baseline or {}).get('results', {}), **{
+            name: {k: v for k, v in r.items() if k not in ('baseline', 'ratio')} for name, r in results.items()
+        })
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print(f"[INFO] Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"[ERROR] Slower than baseline: {regressions}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# python3 src/benchmark.py
+# python3 src/benchmark.py nsq_index_10k split_hex_4mb --repeat 10
+# python3 src/benchmark.py --save
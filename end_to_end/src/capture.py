@@ -0,0 +1,399 @@
+import os
+import sys
+import time
+import struct
+import asyncio
+import argparse
+import yaml
+from framing import frame_reader, device_frame_reader, detect_device_type
+
+# concox protocol numbers that get a readable step name
+CONCOX_NAMES = {
+    0x01: 'Login', 0x13: 'Heartbeat', 0x22: 'Location', 0x26: 'Alarm', 0x12: 'Location',
+    0x16: 'Alarm', 0x8a: 'Time request', 0x94: 'Information', 0x21: 'Command reply', 0x15: 'Command reply',
+}
+
+
+class CapturedSession:
+    """Everything one device connection sent and received, as (seconds, 'device'|'gate', bytes) chunks."""
+
+    def __init__(self, peer, started=None):
+        self.peer = peer
+        self.started = time.time() if started is None else started
+        self.chunks = []
+
+    def add(self, direction, data, at=None):
+        if data:
+            self.chunks.append(((time.time() if at is None else at) - self.started, direction, bytes(data)))
+
+    @property
+    def device_type(self):
+        for _, direction, data in self.chunks:
+            if direction == 'device':
+                return detect_device_type(data)
+        return None
+
+
+def _step_name(device_type, frame):
+    if device_type == 'concox' and len(frame) > 4:
+        protocol = frame[3] if frame[:2] == b'\x78\x78' else frame[4]
+        return CONCOX_NAMES.get(protocol, f"Protocol {protocol:02x}")
+    if device_type == 'teltonika':
+        return 'Login' if frame[:1] == b'\x00' and frame[1:2] != b'\x00' else 'AVL'
+    return 'Packet'
+
+
+def _imei(device_type, frame):
+    if device_type == 'concox' and frame[:2] == b'\x78\x78' and frame[3] == 0x01:
+        return frame[4:12].hex().lstrip('0')
+    if device_type == 'teltonika' and frame[:1] == b'\x00' and frame[1:2] != b'\x00':
+        return frame[2:].decode(errors='replace')
+    return None
+
+
+def _imei_vars(device_type, imei):
+    """(hex of a real IMEI, payload variable for it) as the IMEI appears in packets of the device type."""
+    if device_type == 'teltonika':
+        return imei.encode().hex(), '${imei_hex}'
+    # concox packs the digits as they are read, `787811010${imei}...`
+    return imei, '${imei}'
+
+
+def session_case(session: CapturedSession, index, acks=True):
+    """The session as a payload case: one connection whose steps carry their capture offset in `at`.
+
+    The device's IMEI is replaced by its payload variable, so every replayed session
+    logs in as the IMEI of its own run instead of the captured device.
+    """
+    device_type = session.device_type
+    device_reader = device_frame_reader(device_type)
+    gate_reader = frame_reader('hex', device_type)
+
+    steps, imei = [], None
+    for at, direction, data in session.chunks:
+        if direction == 'gate':
+            frames = gate_reader.feed(data)
+            if steps and acks:
+                steps[-1]['expect_ack'].extend(frame.hex() for frame in frames)
+            continue
+        for frame in device_reader.feed(data):
+            gate_reader.sent(frame)
+            imei = imei or _imei(device_type, frame)
+            steps.append({
+                'name': f"{len(steps) + 1} {_step_name(device_type, frame)}",
+                'at': round(at, 3),
+                'send': frame.hex(),
+                'expect_ack': [],
+            })
+    if not steps:
+        return None
+    if imei:
+        real, variable = _imei_vars(device_type, imei)
+        for step in steps:
+            step['send'] = step['send'].replace(real, variable)
+            step['expect_ack'] = [ack.replace(real, variable) for ack in step['expect_ack']]
+    return {
+        'name': f"Session {index} {session.peer}",
+        'connections': [{'steps': steps}],
+    }
+
+
+def write_payload(sessions, out_path, acks=True):
+    """Write captured sessions as payload files, one per device type; returns the paths written."""
+    by_type = {}
+    for session in sessions:
+        if not any(direction == 'device' for _, direction, _ in session.chunks):
+            continue
+        by_type.setdefault(session.device_type, []).append(session)
+
+    written = []
+    base, ext = os.path.splitext(out_path)
+    for device_type, group in by_type.items():
+        cases = [c for c in (session_case(s, i, acks) for i, s in enumerate(group, start=1)) if c]
+        if not cases:
+            continue
+        path = out_path if len(by_type) == 1 else f"{base}_{device_type or 'unknown'}{ext or '.yml'}"
+        payload = {
+            'type': 'tcp',
+            'message_type': 'hex',
+            'device_type': device_type or 'unknown',
+            # every session is an independent device, --jobs plays them side by side
+            'parallel': True,
+            'test_case': cases,
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"# captured {time.strftime('%Y-%m-%d %H:%M:%S')}, {len(cases)} sessions; "
+                    f"steps are replayed at their `at` offset (see --replay-speed)\n")
+            yaml.safe_dump(payload, f, sort_keys=False, width=1000)
+        print(f"[INFO] Wrote {len(cases)} sessions to {path}")
+        written.append(path)
+    return written
+
+
+# PROXY
+class CaptureProxy:
+    """Passthrough TCP proxy in front of the gate that records every session going through it."""
+
+    def __init__(self, listen, gate):
+        self.listen = listen
+        self.gate = gate
+        self.sessions = []
+
+    async def _pipe(self, reader, writer, session, direction):
+        try:
+            while data := await reader.read(65536):
+                session.add(direction, data)
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if not writer.is_closing():
+                writer.close()
+
+    async def _handle(self, device_reader, device_writer):
+        peer = device_writer.get_extra_info('peername')
+        session = CapturedSession(f"{peer[0]}:{peer[1]}")
+        try:
+            gate_reader, gate_writer = await asyncio.open_connection(*self.gate)
+        except OSError as e:
+            print(f"[ERROR] Proxy cannot reach gate {self.gate[0]}:{self.gate[1]}: {e}")
+            device_writer.close()
+            return
+        self.sessions.append(session)
+        await asyncio.gather(
+            self._pipe(device_reader, gate_writer, session, 'device'),
+            self._pipe(gate_reader, device_writer, session, 'gate'),
+        )
+
+    async def run(self, duration=None):
+        server = await asyncio.start_server(self._handle, *self.listen)
+        print(f"[INFO] Capturing on {self.listen[0]}:{self.listen[1]} -> {self.gate[0]}:{self.gate[1]}, "
+              f"Ctrl-C to stop")
+        async with server:
+            if duration:
+                await asyncio.sleep(duration)
+            else:
+                await server.serve_forever()
+
+
+# PCAP
+LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LOOP, LINKTYPE_LINUX_SLL = 0, 1, 101, 108, 113
+TCP_FIN, TCP_SYN, TCP_RST = 0x01, 0x02, 0x04
+SEQ_MOD = 1 << 32
+
+
+def _seq_offset(seq, base):
+    """How far seq is past base in TCP sequence space, negative when it is behind; wraps at 2**32."""
+    return (seq - base + SEQ_MOD // 2) % SEQ_MOD - SEQ_MOD // 2
+
+
+class _TcpStream:
+    """One direction of a TCP flow, put back in order by sequence number.
+
+    Segments past the next expected byte wait in `pending` until the gap before them
+    fills; retransmitted bytes are dropped.
+    """
+
+    def __init__(self):
+        self.next_seq = None
+        self.pending = {}
+        self.fin = False
+
+    def syn(self, seq):
+        self.next_seq = (seq + 1) % SEQ_MOD
+
+    def segment(self, seq, payload):
+        """The bytes that are in order now that this segment arrived."""
+        if self.next_seq is None:
+            # the capture started in the middle of the flow
+            self.next_seq = seq
+        if len(payload) > len(self.pending.get(seq, b'')):
+            self.pending[seq] = payload
+        data = bytearray()
+        while self.pending:
+            seq = min(self.pending, key=lambda s: _seq_offset(s, self.next_seq))
+            offset = _seq_offset(seq, self.next_seq)
+            if offset > 0:
+                break
+            payload = self.pending.pop(seq)[-offset:]
+            data += payload
+            self.next_seq = (self.next_seq + len(payload)) % SEQ_MOD
+        return bytes(data)
+
+    def flush(self):
+        """Whatever still waits behind a gap the capture never filled, and how many bytes are missing."""
+        data, missing = bytearray(), 0
+        while self.pending:
+            seq = min(self.pending, key=lambda s: _seq_offset(s, self.next_seq))
+            gap = _seq_offset(seq, self.next_seq)
+            if gap > 0:
+                missing += gap
+                self.next_seq = seq
+            data += self.segment(seq, self.pending.pop(seq))
+        return bytes(data), missing
+
+
+def _ip_packet(linktype, frame):
+    """The IP packet inside a link layer frame, or None."""
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, int.from_bytes(frame[12:14], 'big')
+        while ethertype == 0x8100:
+            ethertype = int.from_bytes(frame[offset + 2:offset + 4], 'big')
+            offset += 4
+        return frame[offset:] if ethertype in (0x0800, 0x86dd) else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return frame[16:]
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        return frame[4:]
+    if linktype == LINKTYPE_RAW:
+        return frame
+    return None
+
+
+def _tcp_segment(ip):
+    """(src, dst, sport, dport, seq, flags, payload) of a TCP/IP packet, or None."""
+    version = ip[0] >> 4
+    if version == 4:
+        header = (ip[0] & 0x0F) * 4
+        if ip[9] != 6:
+            return None
+        total = int.from_bytes(ip[2:4], 'big')
+        src, dst, tcp = ip[12:16], ip[16:20], ip[header:total or None]
+    elif version == 6:
+        if ip[6] != 6:
+            return None
+        src, dst, tcp = ip[8:24], ip[24:40], ip[40:40 + int.from_bytes(ip[4:6], 'big')]
+    else:
+        return None
+    if len(tcp) < 20:
+        return None
+    sport, dport, seq = struct.unpack('!HHI', tcp[:8])
+    offset = (tcp[12] >> 4) * 4
+    return src, dst, sport, dport, seq, tcp[13], tcp[offset:]
+
+
+def read_pcap(path):
+    """(timestamp, linktype, frame) of every packet in a classic libpcap file."""
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError(f"{path} is not a pcap file")
+        magic = header[:4]
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            endian = '>'
+        else:
+            raise ValueError(f"{path} is not a classic pcap file (pcapng: convert with `editcap -F pcap`)")
+        scale = 1e-9 if magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e-6
+        linktype = struct.unpack(endian + 'I', header[20:24])[0]
+
+        while record := f.read(16):
+            if len(record) < 16:
+                break
+            seconds, fraction, captured, _ = struct.unpack(endian + 'IIII', record)
+            yield seconds + fraction * scale, linktype, f.read(captured)
+
+
+def sessions_from_pcap(path, gate_port):
+    """Rebuild the device sessions to `gate_port` in a pcap, in the order they started."""
+    flows, done = {}, []
+    for ts, linktype, frame in read_pcap(path):
+        ip = _ip_packet(linktype, frame)
+        segment = _tcp_segment(ip) if ip else None
+        if segment is None:
+            continue
+        src, dst, sport, dport, seq, flags, payload = segment
+        if dport == gate_port:
+            key, direction = (src, sport, dst, dport), 'device'
+        elif sport == gate_port:
+            key, direction = (dst, dport, src, sport), 'gate'
+        else:
+            continue
+
+        if flags & TCP_SYN and direction == 'device' and key in flows:
+            # the device reconnected from the same port, a new session
+            done.append(_finish(*flows.pop(key), at=ts))
+        if key not in flows:
+            if direction == 'gate' and not flags & TCP_SYN:
+                # the tail of a flow that already ended, or one that started before the capture
+                continue
+            peer = f"{'.'.join(map(str, key[0])) if len(key[0]) == 4 else key[0].hex()}:{key[1]}"
+            flows[key] = [CapturedSession(peer, started=ts), {'device': _TcpStream(), 'gate': _TcpStream()}]
+        session, streams = flows[key]
+
+        if flags & TCP_SYN:
+            streams[direction].syn(seq)
+        elif payload:
+            session.add(direction, streams[direction].segment(seq, payload), at=ts)
+
+        if flags & TCP_FIN:
+            streams[direction].fin = True
+        if flags & TCP_RST or all(stream.fin for stream in streams.values()):
+            # a half-closed device may still get gate bytes, the session ends with both sides
+            done.append(_finish(*flows.pop(key), at=ts))
+
+    done.extend(_finish(*flow) for flow in flows.values())
+    return sorted(done, key=lambda s: s.started)
+
+
+def _finish(session, streams, at=None):
+    """Add the bytes still waiting behind gaps; they are kept, the missing ones are reported."""
+    if at is None:
+        at = session.started + (session.chunks[-1][0] if session.chunks else 0)
+    for direction, stream in streams.items():
+        data, missing = stream.flush()
+        if missing:
+            print(f"[WARN] Session {session.peer}: {missing} {direction} bytes are missing from the capture")
+        session.add(direction, data, at=at)
+    return session
+
+
+def _address(text):
+    host, _, port = text.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Record device sessions into the payloads format.')
+    sub = parser.add_subparsers(dest='source', required=True)
+
+    proxy = sub.add_parser('proxy', help='passthrough TCP proxy in front of the gate')
+    proxy.add_argument('--listen', type=_address, default=('0.0.0.0', 1201), metavar='HOST:PORT',
+                       help='where devices connect (default 0.0.0.0:1201)')
+    proxy.add_argument('--gate', type=_address, required=True, metavar='HOST:PORT', help='the real gate')
+    proxy.add_argument('--duration', type=float, help='stop after this many seconds (default: until Ctrl-C)')
+
+    pcap = sub.add_parser('pcap', help='sessions from a classic libpcap file')
+    pcap.add_argument('path', help='capture file')
+    pcap.add_argument('--port', type=int, default=1200, help='gate TCP port in the capture')
+
+    for p in (proxy, pcap):
+        p.add_argument('--out', default='src/payloads/captured.yml', help='payload file to write')
+        p.add_argument('--no-acks', dest='acks', action='store_false',
+                       help='do not assert the gate replies seen in the capture')
+    args = parser.parse_args(argv)
+
+    if args.source == 'pcap':
+        sessions = sessions_from_pcap(args.path, args.port)
+    else:
+        capture = CaptureProxy(args.listen, args.gate)
+        try:
+            asyncio.run(capture.run(args.duration))
+        except KeyboardInterrupt:
+            pass
+        sessions = capture.sessions
+
+    if not write_payload(sessions, args.out, acks=args.acks):
+        print('[WARN] No device traffic captured')
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# python3 src/capture.py proxy --listen 0.0.0.0:1201 --gate 10.0.0.7:1200 --out src/payloads/captured.yml
+# python3 src/capture.py pcap gate.pcap --port 1200 --out src/payloads/captured.yml
+# python3 src/runner.py captured.yml --engine asyncio --jobs 500 --replay-speed 10
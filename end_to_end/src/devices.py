@@ -0,0 +1,126 @@
+from array import array
+from collections.abc import Mapping
+import templates
+from templates import IMEI_VARS, IMEI_POOL_PREFIX, imei_from_pool
+
+# DeviceTable.state values
+IDLE, CONNECTING, CONNECTED, CLOSED = range(4)
+STATE_NAMES = ('idle', 'connecting', 'connected', 'closed')
+
+
+class ImeiAllocator:
+    """Leases the device slots of a range, and with them the IMEIs templates.device_vars derives.
+
+    Slot s owns pool sequences s * len(IMEI_VARS) and up, so the slot of an IMEI is one
+    division away instead of a scan over the pool. Leases are one byte per slot, released
+    slots are handed out again last-in first-out before untouched ones; every operation
+    is O(1).
+    """
+
+    def __init__(self, slots: range):
+        self.slots = slots
+        self._leased = bytearray(len(slots))
+        self._free = array('I')
+        self._next = 0
+        self.count = 0
+
+    def lease(self):
+        """A free slot; raises RuntimeError when every slot of the range is leased."""
+        if self._free:
+            row = self._free.pop()
+        elif self._next < len(self.slots):
+            row = self._next
+            self._next += 1
+        else:
+            raise RuntimeError(f"All {len(self.slots)} device slots are leased")
+        self._leased[row] = 1
+        self.count += 1
+        return self.slots[row]
+
+    def release(self, slot):
+        row = self.slots.index(slot)
+        if not self._leased[row]:
+            raise ValueError(f"Slot {slot} is not leased")
+        self._leased[row] = 0
+        self._free.append(row)
+        self.count -= 1
+
+    def leased(self, slot) -> bool:
+        return slot in self.slots and bool(self._leased[self.slots.index(slot)])
+
+    def slot_of(self, imei):
+        """The leased slot an IMEI belongs to, or None."""
+        imei = str(imei)
+        if len(imei) != 15 or not imei.startswith(IMEI_POOL_PREFIX) or not imei.isdigit():
+            return None
+        slot = int(imei[len(IMEI_POOL_PREFIX):]) // len(IMEI_VARS)
+        return slot if self.leased(slot) else None
+
+    @staticmethod
+    def imei(slot, var='imei'):
+        return imei_from_pool(slot * len(IMEI_VARS) + IMEI_VARS.index(var))
+
+
+class DeviceVars(Mapping):
+    """templates.device_vars(slot) without the copy: the IMEI vars are derived on access."""
+
+    __slots__ = ('slot',)
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def __getitem__(self, key):
+        if self.slot:
+            if key in IMEI_VARS:
+                return ImeiAllocator.imei(self.slot, key)
+            if key in ('imei_hex', 'imei_1_hex'):
+                return ImeiAllocator.imei(self.slot, key[:-4]).encode().hex()
+        return templates.vars[key]
+
+    def __iter__(self):
+        return iter(templates.vars)
+
+    def __len__(self):
+        return len(templates.vars)
+
+
+class DeviceTable:
+    """State of a load worker's virtual devices as columns, one row per device.
+
+    A row is its slot (the IMEIs follow from it), a connection state byte, the case and
+    step it is playing and its packet and ACK counters: 25 bytes in arrays instead of an
+    object graph per device. Rows are allocated up front for the whole range.
+    """
+
+    COLUMNS = ('slot', 'case', 'step', 'packets', 'acks')
+
+    def __init__(self, slots: range):
+        size = len(slots)
+        self.slots = slots
+        self.slot = array('Q', slots)
+        self.state = bytearray(size)
+        self.case = array('I', bytes(4 * size))
+        self.step = array('I', bytes(4 * size))
+        self.packets = array('I', bytes(4 * size))
+        self.acks = array('I', bytes(4 * size))
+
+    def __len__(self):
+        return len(self.state)
+
+    def row(self, slot):
+        return self.slots.index(slot)
+
+    def nbytes(self):
+        return len(self.state) + sum(getattr(self, c).itemsize * len(self) for c in self.COLUMNS)
+
+    def states(self):
+        """Devices per connection state name."""
+        return {name: self.state.count(value) for value, name in enumerate(STATE_NAMES)}
+
+    def reset_counters(self):
+        self.packets = array('I', bytes(4 * len(self)))
+        self.acks = array('I', bytes(4 * len(self)))
+
+    def silent(self):
+        """Devices that never received an ACK frame."""
+        return self.acks.tolist().count(0)
@@ -0,0 +1,277 @@
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import secrets
+import ipaddress
+import asyncio
+import subprocess
+from decouple import config
+from load import run_load, combine_results, load_report
+from profiles import parse_profile, split_profile
+
+AGENT_PORT = config('AGENT_PORT', default=7400, cast=int)
+# seconds between handing out the run and its common start, enough for every agent to spin up its processes
+AGENT_START_LEAD = config('AGENT_START_LEAD', default=3, cast=float)
+AGENT_CONNECT_TIMEOUT = config('AGENT_CONNECT_TIMEOUT', default=10, cast=float)
+# shared secret every control request must carry; required for agents listening beyond loopback
+AGENT_TOKEN = config('AGENT_TOKEN', default='')
+
+
+class Agent:
+    """Runs load slices for a coordinator.
+
+    The control channel is newline-delimited JSON over TCP, one reply per request:
+        {"cmd": "hello"}                      -> {"ok": true, "time": <epoch>, "host": ..., "cpus": ...}
+        {"cmd": "run", "load": {run_load kwargs}} -> {"ok": true, "report": <load report>}
+        {"cmd": "shutdown"}                   -> {"ok": true}, then the agent exits
+    Every request carries "token": AGENT_TOKEN when one is set. Without a token the agent
+    only listens on loopback, since any peer could start load runs against the gate.
+    One coordinator is served at a time; with mock every run gets its own mock gate.
+    """
+
+    def __init__(self, host='127.0.0.1', port=AGENT_PORT, mock=False, token=AGENT_TOKEN):
+        if not token and not _is_loopback(host):
+            raise ValueError(f"an agent listening on {host} needs AGENT_TOKEN")
+        self.host = host
+        self.port = port
+        self.mock = mock
+        self.token = token
+        self._running = True
+
+    def serve(self):
+        with socket.create_server((self.host, self.port)) as server:
+            print(f"[AGENT] Listening on {self.host}:{server.getsockname()[1]}", flush=True)
+            while self._running:
+                conn, peer = server.accept()
+                print(f"[AGENT] Coordinator connected from {peer[0]}:{peer[1]}", flush=True)
+                with conn, conn.makefile('rwb') as channel:
+                    self._session(channel)
+
+    def _session(self, channel):
+        for line in channel:
+            try:
+                request = json.loads(line)
+                if self.token and not hmac.compare_digest(str(request.get('token', '')), self.token):
+                    reply = {'ok': False, 'error': 'bad token'}
+                else:
+                    reply = self._dispatch(request)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                reply = {'ok': False, 'error': f"bad request: {e}"}
+            try:
+                channel.write(json.dumps(reply).encode() + b'\n')
+                channel.flush()
+            except OSError:
+                return
+            if not self._running:
+                return
+
+    def _dispatch(self, request):
+        cmd = request['cmd']
+        if cmd == 'hello':
+            return {'ok': True, 'time': time.time(), 'host': socket.gethostname(), 'cpus': os.cpu_count()}
+        if cmd == 'run':
+            try:
+                report = self._run(request['load'])
+            except Exception as e:
+                # the agent outlives a broken run
+                print(f"[ERROR] Load run failed: {e!r}", flush=True)
+                return {'ok': False, 'error': f"load run failed: {e!r}"}
+            if report is None:
+                return {'ok': False, 'error': 'load run failed, see the agent output'}
+            return {'ok': True, 'report': report}
+        if cmd == 'shutdown':
+            self._running = False
+            return {'ok': True}
+        return {'ok': False, 'error': f"unknown command '{cmd}'"}
+
+    def _run(self, options):
+        mock_gate = None
+        if self.mock:
+            from mock_gate import MockGate
+            mock_gate = MockGate().start()
+        try:
+            return run_load(mock_gate=mock_gate, **options)
+        finally:
+            if mock_gate:
+                mock_gate.stop()
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+
+def _partition(devices, parts):
+    """Contiguous (first_slot, count) ranges, so every agent plays its own IMEIs."""
+    size, extra = divmod(devices, parts)
+    ranges, first = [], 1
+    for i in range(parts):
+        count = size + (1 if i < extra else 0)
+        ranges.append((first, count))
+        first += count
+    return ranges
+
+
+class Coordinator:
+    """Splits one load run over agents and merges their reports.
+
+    Every agent gets a contiguous range of device slots, an equal share of the rates and
+    profiles, and the same start instant, corrected by the clock offset measured at hello.
+    Counters are summed and latency histograms merged exactly; the run passes only when
+    every agent ran and passed.
+    """
+
+    def __init__(self, addresses, token=AGENT_TOKEN):
+        self.addresses = addresses
+        self.token = token
+
+    def run(self, file_name, devices=1, rate=0, connect_rate=0, profile=None, connect_profile=None, **options):
+        try:
+            profiles = self._split_profiles(devices, profile, connect_profile)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            return None
+        return asyncio.run(self._run(file_name, devices, rate, connect_rate, profiles, options))
+
+    def _split_profiles(self, devices, profile, connect_profile):
+        parts = len(self.addresses)
+        shares = []
+        for spec in (profile, connect_profile):
+            parsed = parse_profile(spec, count=devices) if spec else None
+            shares.append([p.spec() if p else None for p in split_profile(parsed, parts)])
+        return list(zip(*shares))
+
+    async def _connect(self, address):
+        host, port = address
+        deadline = time.time() + AGENT_CONNECT_TIMEOUT
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+        sent = time.time()
+        hello = await self._request(reader, writer, {'cmd': 'hello', 'token': self.token})
+        if not hello.get('ok'):
+            raise ConnectionError(f"agent {host}:{port} refused: {hello.get('error')}")
+        received = time.time()
+        offset = hello['time'] - (sent + received) / 2
+        print(f"[INFO] Agent {host}:{port} ({hello['host']}, {hello['cpus']} cpus), clock offset {offset:+.3f}s")
+        return reader, writer, offset
+
+    @staticmethod
+    async def _request(reader, writer, request):
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('agent closed the control channel')
+        return json.loads(line)
+
+    async def _run(self, file_name, devices, rate, connect_rate, profiles, options):
+        parts = len(self.addresses)
+        try:
+            channels = await asyncio.gather(*(self._connect(address) for address in self.addresses))
+        except OSError as e:
+            print(f"[ERROR] Cannot reach agent: {e}")
+            return None
+
+        start_at = time.time() + AGENT_START_LEAD
+        # (address, request) pairs, agents without devices get none
+        runs = []
+        for address, (reader, writer, offset), (first_slot, count), (profile, connect_profile) in zip(
+                self.addresses, channels, _partition(devices, parts), profiles):
+            if not count:
+                continue
+            load = dict(options, file_name=file_name, devices=count, first_slot=first_slot,
+                        rate=rate / parts, connect_rate=connect_rate / parts, profile=profile,
+                        connect_profile=connect_profile, start_at=start_at + offset)
+            runs.append((address, self._request(reader, writer, {'cmd': 'run', 'load': load, 'token': self.token})))
+
+        print(f"\n[INFO] Distributed load: {devices} devices on {len(runs)} agents, scenario {file_name}")
+        replies = await asyncio.gather(*(run for _, run in runs), return_exceptions=True)
+        for _, writer, _ in channels:
+            writer.close()
+
+        reports, failed = [], 0
+        for (address, _), reply in zip(runs, replies):
+            if isinstance(reply, Exception) or not reply.get('ok'):
+                error = reply if isinstance(reply, Exception) else reply.get('error')
+                print(f"[ERROR] Agent {address[0]}:{address[1]}: {error}")
+                failed += 1
+                continue
+            reports.append(reply['report'])
+            print(f"[AGENT] {address[0]}:{address[1]}: devices {reply['report']['devices']}, "
+                  f"passed {reply['report']['passed']}")
+        if not reports:
+            return None
+
+        report = load_report(combine_results(reports))
+        report['agents'] = len(reports)
+        report['failed_agents'] = failed
+        report['passed'] = report['passed'] and not failed
+        return report
+
+
+def parse_address(text, default_host='127.0.0.1'):
+    host, _, port = text.rpartition(':')
+    return host or default_host, int(port)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def spawn_local_agents(count, mock=False, token=None):
+    """Start `count` agents on this host; returns their processes and addresses.
+
+    They require `token`, by default AGENT_TOKEN or a fresh one (see local_token()).
+    """
+    procs, addresses = [], []
+    env = dict(os.environ, AGENT_TOKEN=token or local_token())
+    for _ in range(count):
+        port = _free_port()
+        cmd = [sys.executable, os.path.join(os.path.dirname(__file__), 'runner.py'), '--agent',
+               '--listen', f"127.0.0.1:{port}"] + (['--mock'] if mock else [])
+        procs.append(subprocess.Popen(cmd, env=env))
+        addresses.append(('127.0.0.1', port))
+    return procs, addresses
+
+
+_local_token = None
+
+
+def local_token():
+    """AGENT_TOKEN, or a token made up once per process for agents it spawns."""
+    global _local_token
+    if AGENT_TOKEN:
+        return AGENT_TOKEN
+    if _local_token is None:
+        _local_token = secrets.token_hex(16)
+    return _local_token
+
+
+def stop_local_agents(procs, addresses, token=None):
+    for host, port in addresses:
+        try:
+            with socket.create_connection((host, port), timeout=2) as sock:
+                request = {'cmd': 'shutdown', 'token': token or local_token()}
+                sock.sendall(json.dumps(request).encode() + b'\n')
+                sock.recv(1024)
+        except OSError:
+            pass
+    for proc in procs:
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
@@ -0,0 +1,228 @@
+import time
+import asyncio
+from collections import deque
+from profiler import phase
+
+CONCOX_SHORT = b'\x78\x78'
+CONCOX_LONG = b'\x79\x79'
+CONCOX_END = b'\x0d\x0a'
+TELTONIKA_PREAMBLE = b'\x00\x00\x00\x00'
+TELTONIKA_CODEC12 = 0x0C
+
+
+class FrameReader:
+    """Cut the byte stream received from the gate into protocol frames.
+
+    feed() may be called with arbitrary chunks; incomplete frames stay buffered
+    until the rest arrives, so a reader can live for the whole connection.
+    Frames are located by offset and copied out once, the buffer is compacted
+    once per feed, so a chunk holding many frames is split in linear time.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        buf = self.buffer
+        buf += data
+        frames = []
+        start = 0
+        with memoryview(buf) as view:
+            while start < len(buf):
+                length = self._frame_length(buf, start)
+                if length is None or start + length > len(buf):
+                    break
+                frames.append(bytes(view[start:start + length]))
+                start += length
+        if start:
+            del buf[:start]
+        return frames
+
+    def flush(self) -> list:
+        """Return whatever is still buffered as a last (possibly partial) frame."""
+        if not self.buffer:
+            return []
+        frame = bytes(self.buffer)
+        self.buffer.clear()
+        return [frame]
+
+    def sent(self, data: bytes):
+        """What the device just sent, for protocols whose replies can only be cut knowing it."""
+
+    def read_done(self):
+        """A step stopped reading; replies still owed for what it sent are not coming."""
+
+    def _frame_length(self, buf: bytearray, start: int):
+        """Length of the frame starting at buf[start], or None if more bytes are needed."""
+        return len(buf) - start
+
+
+class ConcoxFrameReader(FrameReader):
+    """7878 <len:1> ... 0d0a and 7979 <len:2> ... 0d0a, where len counts the bytes up to the end bits."""
+
+    def _frame_length(self, buf, start):
+        remaining = len(buf) - start
+        if buf.startswith(CONCOX_SHORT, start) and remaining >= 3:
+            return 2 + 1 + buf[start + 2] + 2
+        if buf.startswith(CONCOX_LONG, start) and remaining >= 4:
+            return 2 + 2 + int.from_bytes(buf[start + 2:start + 4], 'big') + 2
+        if remaining < 4 and (CONCOX_SHORT.startswith(buf[start:]) or CONCOX_LONG.startswith(buf[start:])):
+            return None
+
+        # unknown start, fall back to the end bits
+        end = buf.find(CONCOX_END, start)
+        return None if end < 0 else end + len(CONCOX_END) - start
+
+
+class TeltonikaFrameReader(FrameReader):
+    """Server side teltonika replies.
+
+    01                                   login accepted
+    000000NN                             number of AVL records accepted
+    00000000 <len:4> <data> <crc:4>      codec 12 command
+
+    A login reject (00) and zero accepted records (00000000) start like the next longer
+    frame, so sent() queues the reply each packet is owed and those are cut by it, as
+    long as the bytes have that reply's shape. Replies the gate never sent are dropped
+    when the step stops reading (read_done).
+    """
+
+    def __init__(self):
+        super().__init__()
+        # 'login' or 'avl' per packet sent and not answered yet
+        self.owed = deque()
+
+    def sent(self, data: bytes):
+        for frame in TeltonikaDeviceFrameReader().feed(data):
+            if frame[:4] != TELTONIKA_PREAMBLE:
+                self.owed.append('login')
+            elif len(frame) > 8 and frame[8] != TELTONIKA_CODEC12:
+                # the gate does not answer codec 12 replies
+                self.owed.append('avl')
+
+    def read_done(self):
+        self.owed.clear()
+
+    def _frame_length(self, buf, start):
+        remaining = len(buf) - start
+        if self.owed and self.owed[0] == 'login':
+            self.owed.popleft()
+            if buf[start] in (0x00, 0x01):
+                return 1
+        if buf[start] != 0x00:
+            return 1
+        if remaining < 4:
+            return None
+        if self.owed and self.owed[0] == 'avl':
+            self.owed.popleft()
+            if buf.startswith(b'\x00\x00\x00', start):
+                return 4
+        if not buf.startswith(TELTONIKA_PREAMBLE, start):
+            return 4
+        if remaining < 8:
+            return None
+        return 8 + int.from_bytes(buf[start + 4:start + 8], 'big') + 4
+
+
+class TeltonikaDeviceFrameReader(FrameReader):
+    """Device side teltonika packets, as a capture sees them.
+
+    <len:2> <imei>                       login
+    00000000 <len:4> <data> <crc:4>      AVL data or codec 12 reply
+    """
+
+    def _frame_length(self, buf, start):
+        remaining = len(buf) - start
+        if remaining < 2:
+            return None
+        if buf[start] == 0x00 and buf[start + 1] != 0x00:
+            return 2 + int.from_bytes(buf[start:start + 2], 'big')
+        if remaining < 8:
+            return None
+        if buf.startswith(TELTONIKA_PREAMBLE, start):
+            return 8 + int.from_bytes(buf[start + 4:start + 8], 'big') + 4
+        return remaining
+
+
+class StringFrameReader(FrameReader):
+    """Gate command replies are plain strings without framing; every chunk is a reply."""
+
+
+def frame_reader(msg_type: str, device_type: str) -> FrameReader:
+    if msg_type == 'hex' and device_type == 'concox':
+        return ConcoxFrameReader()
+    if msg_type == 'hex' and device_type == 'teltonika':
+        return TeltonikaFrameReader()
+    return StringFrameReader()
+
+
+def device_frame_reader(device_type: str) -> FrameReader:
+    """Reader for what a device sends, the other direction of frame_reader()."""
+    if device_type == 'concox':
+        return ConcoxFrameReader()
+    if device_type == 'teltonika':
+        return TeltonikaDeviceFrameReader()
+    return StringFrameReader()
+
+
+def detect_device_type(data: bytes):
+    """concox, teltonika or None (gate commands, unknown) from the first bytes a device sends."""
+    if data[:2] in (CONCOX_SHORT, CONCOX_LONG):
+        return 'concox'
+    if data[:1] == b'\x00':
+        return 'teltonika'
+    return None
+
+
+def expected_frames(expected_ack) -> int:
+    """Number of frames that complete a step, 0 when the step does not expect an ACK."""
+    if not expected_ack:
+        return 0
+    if isinstance(expected_ack, list):
+        # an empty string stands for no frame
+        return sum(1 for ack in expected_ack if ack)
+    return 1
+
+
+def mark_ack_timings(timings, frames, expected):
+    """Record first-ACK and ACK-complete latency, relative to timings['sent'] (perf_counter)."""
+    if timings is None or 'sent' not in timings:
+        return
+    now = time.perf_counter()
+    if frames and 'first_ack' not in timings:
+        timings['first_ack'] = now - timings['sent']
+    if expected and len(frames) >= expected and 'ack_complete' not in timings:
+        timings['ack_complete'] = now - timings['sent']
+
+
+async def read_frames_async(stream: asyncio.StreamReader, reader: FrameReader, expected: int, max_wait: float,
+                            timings=None):
+    """Read frames until `expected` are in or max_wait passes; returns the frames and whether the peer closed.
+
+    With expected == 0 everything arriving within max_wait is collected.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait
+    frames = []
+
+    while not expected or len(frames) < expected:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            with phase('select'):
+                data = await asyncio.wait_for(stream.read(4096), timeout=remaining)
+        except asyncio.TimeoutError:
+            break
+        if data == b'':
+            frames.extend(reader.flush())
+            reader.read_done()
+            return frames, True
+        with phase('frame_parse'):
+            frames.extend(reader.feed(data))
+            mark_ack_timings(timings, frames, expected)
+
+    if len(frames) < expected:
+        frames.extend(reader.flush())
+    reader.read_done()
+    return frames, False
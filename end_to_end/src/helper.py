@@ -1,5 +1,4 @@
 import re
-import json, yaml
 import templates
 
 vars = templates.vars
@@ -10,21 +9,30 @@ def hex_to_bytes(hex_str):
 def bytes_to_str(bytes_msg):
     return bytes.hex(bytes_msg)
 
-def replace_variables(obj):
-    """Recursively replace ${var} placeholders using vars dict."""
+def encode_send(send, msg_type):
+    """Bytes to put on the wire for a step's `send`; online commands (8080...) are sent as text."""
+    if msg_type == 'string' or send[:4] == '8080':
+        return send.encode()
+    elif msg_type == 'hex':
+        return hex_to_bytes(send)
+    raise ValueError(f"Unsupported message_type: {msg_type}")
+
+def replace_variables(obj, variables=None):
+    """Recursively replace ${var} placeholders using vars dict (or the given variables)."""
+    variables = vars if variables is None else variables
     if isinstance(obj, str):
-        return re.sub(r"\$\{(\w+)\}", lambda m: str(vars.get(m.group(1), m.group(0))), obj)
+        return re.sub(r"\$\{(\w+)\}", lambda m: str(variables.get(m.group(1), m.group(0))), obj)
     elif isinstance(obj, list):
-        return [replace_variables(x) for x in obj]
+        return [replace_variables(x, variables) for x in obj]
     elif isinstance(obj, dict):
-        return {k: replace_variables(v) for k, v in obj.items()}
+        return {k: replace_variables(v, variables) for k, v in obj.items()}
     return obj
 
-def expand_templates(obj):
+def expand_templates(obj, variables=None):
     """Recursively expand objects containing $template."""
     if isinstance(obj, dict) and '$template' in obj:
         template_name = obj["$template"]
-        args = [replace_variables(a) for a in obj.get("args", [])]
+        args = [replace_variables(a, variables) for a in obj.get("args", [])]
         expected_failed = obj.get("expected_failed", False)
 
         if not hasattr(templates, template_name):
@@ -40,33 +48,28 @@ def expand_templates(obj):
         return expanded
 
     elif isinstance(obj, list):
-        return [expand_templates(x) for x in obj]
+        return [expand_templates(x, variables) for x in obj]
     elif isinstance(obj, dict):
-        return {k: expand_templates(v) for k, v in obj.items()}
+        return {k: expand_templates(v, variables) for k, v in obj.items()}
     return obj
 
-def load_payload(filename):
-    """Load and expand test payloads from JSON or YAML file."""
-    with open(filename, encoding="utf-8") as f:
-        if filename.endswith((".yaml", ".yml")):
-            payload = yaml.safe_load(f)
-        else:
-            payload = json.load(f)
+def load_payload(filename, variables=None):
+    """Load and expand test payloads from JSON or YAML file.
 
-    payload = replace_variables(payload)
-    return expand_templates(payload)
+    variables overrides templates.vars, e.g. with templates.device_vars(slot) for an isolated run.
+    The file is parsed and compiled once per process (see scenario.py); each call only binds variables.
+    """
+    from scenario import compile_payload
+    return compile_payload(filename).bind(variables)
 
 def split_hex(type, msg):
-    if type == 'concox':
-        end_bit = "0d0a"
-        messages = []
-        current = ""
+    """Split a received hex string (or raw bytes) into the device's frames, as hex strings.
 
-        for i in range(0, len(msg), 2):
-            current += msg[i:i+2]
-            if current.endswith(end_bit):
-                messages.append(current)
-                current = ""
-        return messages
-    else:
-        return [msg]
\ No newline at end of file
+    Uses the byte level readers in framing.py; the runner feeds those directly and
+    only hex-encodes frames when comparing them with expect_ack.
+    """
+    from framing import frame_reader
+    reader = frame_reader('hex', type)
+    data = hex_to_bytes(msg) if isinstance(msg, str) else msg
+    frames = reader.feed(data) + reader.flush()
+    return [bytes_to_str(frame) for frame in frames]
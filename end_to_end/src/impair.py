@@ -0,0 +1,302 @@
+import socket
+import struct
+import random
+import asyncio
+import threading
+from decouple import config
+
+# how long a fragmented write waits between its pieces so they leave as separate segments
+FRAGMENT_GAP = config('IMPAIR_FRAGMENT_GAP', default=0.002, cast=float)
+
+# named links a spec can start from, e.g. `gprs,reset=0.01`; latency and jitter are one-way seconds,
+# bandwidth bytes/sec per connection and direction
+PRESETS = {
+    'gprs': {'latency': 0.35, 'jitter': 0.15, 'bandwidth': 5000},
+    'edge': {'latency': 0.15, 'jitter': 0.05, 'bandwidth': 25000},
+    '3g': {'latency': 0.05, 'jitter': 0.02, 'bandwidth': 100000},
+    'flaky': {'latency': 0.1, 'jitter': 0.1, 'fragment': 16, 'reset': 0.02},
+}
+
+
+class Impairment:
+    """How a link between a device and the gate misbehaves.
+
+    latency and jitter (seconds, one-way) delay every chunk by latency +- jitter without
+    reordering it; bandwidth (bytes/sec) paces each direction of a connection; fragment
+    splits writes into pieces of at most that many bytes, so frames straddle segments (hex
+    payloads only, see for_message_type);
+    reset is the chance per forwarded chunk, and reset_after the seconds after connect,
+    at which both sides get a TCP reset. seed makes jitter and resets repeatable.
+    """
+
+    FIELDS = ('latency', 'jitter', 'bandwidth', 'fragment', 'reset', 'reset_after', 'seed')
+
+    def __init__(self, latency=0, jitter=0, bandwidth=0, fragment=0, reset=0, reset_after=0, seed=None):
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.bandwidth = float(bandwidth)
+        self.fragment = int(fragment)
+        self.reset = float(reset)
+        self.reset_after = float(reset_after)
+        self.seed = None if seed is None else int(seed)
+        if min(self.latency, self.jitter, self.bandwidth, self.fragment, self.reset, self.reset_after) < 0:
+            raise ValueError(f"negative impairment: {self.spec()}")
+        if self.reset > 1:
+            raise ValueError(f"impairment reset is a probability, got {self.reset}")
+
+    def delay(self, rnd):
+        return max(0.0, self.latency + rnd.uniform(-self.jitter, self.jitter)) if self.jitter else self.latency
+
+    def spec(self):
+        """The spec parse_impairment() turns back into this impairment, also its identity."""
+        values = ((f, getattr(self, f)) for f in self.FIELDS)
+        return ','.join(f"{f}={v:g}" if isinstance(v, float) else f"{f}={v}" for f, v in values if v)
+
+    def __bool__(self):
+        return any(getattr(self, f) for f in self.FIELDS if f != 'seed')
+
+    def for_message_type(self, msg_type):
+        """This impairment for a payload of msg_type, or None when nothing of it is left.
+
+        string messages have no framing, the gate tells them apart by segment, so splitting
+        them changes what it receives instead of how; they keep everything but fragment.
+        """
+        if msg_type == 'hex' or not self.fragment:
+            return self
+        if self.spec() not in _unframed_warned:
+            _unframed_warned.add(self.spec())
+            print(f"[WARN] Impairment fragment is ignored for message_type {msg_type}, only framed packets are split")
+        fields = {f: getattr(self, f) for f in self.FIELDS}
+        fields['fragment'] = 0
+        return Impairment(**fields) or None
+
+
+# specs for which for_message_type() already said it drops fragment
+_unframed_warned = set()
+
+
+def parse_impairment(value):
+    """An Impairment from a payload `impair` value or a --impair spec, or None for an unimpaired link.
+
+    Specs are a preset and/or key=value pairs, e.g. `gprs`, `latency=0.2,jitter=0.05,fragment=8`
+    or `flaky,seed=7`; payloads may give the same keys as a dict. none/false/empty turn it off.
+    """
+    if isinstance(value, Impairment):
+        return value or None
+    if value is None or value is False or str(value).strip().lower() in ('', 'none', 'off', 'false'):
+        return None
+    if isinstance(value, dict):
+        fields = dict(value)
+    else:
+        fields = {}
+        for part in str(value).split(','):
+            part = part.strip()
+            key, sep, val = part.partition('=')
+            if not sep:
+                if part not in PRESETS:
+                    raise ValueError(f"unknown impairment preset '{part}' (one of {', '.join(PRESETS)})")
+                fields.update(PRESETS[part])
+            else:
+                fields[key.strip()] = val.strip()
+    unknown = set(fields) - set(Impairment.FIELDS)
+    if unknown:
+        raise ValueError(f"unknown impairment field: {', '.join(sorted(unknown))}")
+    return Impairment(**fields) or None
+
+
+class _Link:
+    """Both sockets of one proxied connection."""
+
+    def __init__(self, device_writer):
+        self.device_writer = device_writer
+        self.gate_writer = None
+        self.was_reset = False
+
+    def reset(self):
+        if self.was_reset:
+            return
+        self.was_reset = True
+        for writer in (self.device_writer, self.gate_writer):
+            if writer is None or writer.is_closing():
+                continue
+            sock = writer.get_extra_info('socket')
+            if sock is not None:
+                # zero linger turns the close into a RST
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            writer.transport.abort()
+
+
+class ImpairmentProxy:
+    """TCP proxy in front of one gate address that degrades every connection by an Impairment.
+
+    serve() listens on the running loop: load workers run theirs in place, the runners
+    through LinkPool. stats counts connections, forwarded bytes and segments, and the
+    resets it injected.
+    """
+
+    def __init__(self, gate, impairment: Impairment, listen=('127.0.0.1', 0)):
+        self.gate = gate
+        self.impairment = impairment
+        self.host, self.port = listen
+        self.stats = {'connections': 0, 'connect_failures': 0, 'bytes': 0, 'segments': 0, 'resets': 0}
+        self._seq = 0
+        self._server = None
+        self._handlers = set()
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    def _random(self):
+        self._seq += 1
+        seed = self.impairment.seed
+        return random.Random(None if seed is None else seed * 1000003 + self._seq)
+
+    async def _deliver(self, queue, writer, link, rnd):
+        loop = asyncio.get_running_loop()
+        imp = self.impairment
+        free_at = 0.0
+        while (item := await queue.get()) is not None:
+            due, data = item
+            if link.was_reset:
+                return
+            if due > loop.time():
+                await asyncio.sleep(due - loop.time())
+            if imp.bandwidth:
+                # the link is busy with earlier bytes until free_at
+                free_at = max(free_at, loop.time()) + len(data) / imp.bandwidth
+                await asyncio.sleep(free_at - loop.time())
+            step = imp.fragment or len(data)
+            for start in range(0, len(data), step):
+                if start:
+                    await asyncio.sleep(FRAGMENT_GAP)
+                writer.write(data[start:start + step])
+                await writer.drain()
+                self.stats['segments'] += 1
+            self.stats['bytes'] += len(data)
+            if imp.reset and rnd.random() < imp.reset:
+                self.stats['resets'] += 1
+                link.reset()
+                return
+        if not writer.is_closing() and writer.can_write_eof():
+            writer.write_eof()
+
+    async def _pipe(self, reader, writer, link):
+        loop = asyncio.get_running_loop()
+        rnd = self._random()
+        queue = asyncio.Queue()
+        deliver = asyncio.create_task(self._deliver(queue, writer, link, rnd))
+        last_due = 0.0
+        try:
+            try:
+                while data := await reader.read(65536):
+                    # TCP does not reorder, jitter only stretches the gaps
+                    last_due = max(last_due, loop.time() + self.impairment.delay(rnd))
+                    queue.put_nowait((last_due, data))
+            except (ConnectionError, OSError):
+                pass
+            queue.put_nowait(None)
+            await deliver
+        except (ConnectionError, OSError):
+            link.reset()
+        finally:
+            deliver.cancel()
+
+    async def _handle(self, device_reader, device_writer):
+        self.stats['connections'] += 1
+        self._handlers.add(asyncio.current_task())
+        link = _Link(device_writer)
+        try:
+            gate_reader, link.gate_writer = await asyncio.open_connection(*self.gate)
+        except OSError as e:
+            self.stats['connect_failures'] += 1
+            print(f"[ERROR] Impairment proxy cannot reach gate {self.gate[0]}:{self.gate[1]}: {e}")
+            device_writer.close()
+            return
+        for writer in (device_writer, link.gate_writer):
+            writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        timer = None
+        if self.impairment.reset_after:
+            def _reset():
+                if not link.was_reset:
+                    self.stats['resets'] += 1
+                link.reset()
+            timer = asyncio.get_running_loop().call_later(self.impairment.reset_after, _reset)
+        try:
+            await asyncio.gather(
+                self._pipe(device_reader, link.gate_writer, link),
+                self._pipe(gate_reader, device_writer, link),
+            )
+        except asyncio.CancelledError:
+            # closed with the connection still open
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            if timer:
+                timer.cancel()
+            for writer in (device_writer, link.gate_writer):
+                if not writer.is_closing():
+                    writer.close()
+
+    async def serve(self):
+        """Listen on the running loop; returns the proxy once it accepts connections."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        return self
+
+    async def close(self):
+        """Stop listening and drop the connections still open."""
+        if self._server:
+            self._server.close()
+        for task in list(self._handlers):
+            task.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+
+class LinkPool:
+    """Impairment proxies started on demand, one per gate address and impairment.
+
+    They all run on one background event loop, so the thread and asyncio runners can
+    both hand a connection the proxy's address in place of the gate's.
+    """
+
+    def __init__(self):
+        self._proxies = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+
+    def address(self, host, port, impairment: Impairment):
+        """Where to connect to reach host:port over the impaired link."""
+        key = (host, port, impairment.spec())
+        with self._lock:
+            proxy = self._proxies.get(key)
+            if proxy is None:
+                if self._loop is None:
+                    self._loop = asyncio.new_event_loop()
+                    self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                    self._thread.start()
+                proxy = ImpairmentProxy((host, port), impairment)
+                asyncio.run_coroutine_threadsafe(proxy.serve(), self._loop).result(timeout=5)
+                self._proxies[key] = proxy
+                print(f"[INFO] Impaired link {proxy.host}:{proxy.port} -> {host}:{port} ({impairment.spec()})")
+        return proxy.address
+
+    def __bool__(self):
+        return bool(self._proxies)
+
+    def stats(self):
+        """Counters summed over every proxy."""
+        total = {}
+        for proxy in list(self._proxies.values()):
+            for k, v in proxy.stats.items():
+                total[k] = total.get(k, 0) + v
+        return total
+
+    def stop(self):
+        if self._loop:
+            for proxy in self._proxies.values():
+                asyncio.run_coroutine_threadsafe(proxy.close(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
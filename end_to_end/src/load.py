@@ -0,0 +1,518 @@
+import os
+import time
+import queue
+import asyncio
+import resource
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from decouple import config
+from helper import load_payload
+from framing import expected_frames, read_frames_async
+from session import SessionManager
+from scenario import compile_payload, bind_step
+from devices import DeviceTable, DeviceVars, ImeiAllocator, CONNECTING, CONNECTED, CLOSED
+from packets import PacketStream, SerialCounter
+from impair import ImpairmentProxy, parse_impairment
+from templates import device_vars
+from report import Histogram
+from profiles import ConstantProfile, parse_profile, split_profile
+from runner import RunTest
+from service.fixtures import run_fixture
+
+PAYLOAD_FOLDER = 'src/payloads'
+
+
+class Pacer:
+    """Hand out send slots following an open-loop Profile; no profile means unpaced.
+
+    Slots are fixed from start() on and never move when the sender lags, so a late
+    sender catches up at once and wait() returns the slot it should have used. Latency
+    is measured from that intended time (coordinated-omission correct).
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.origin = None
+        self._offsets = None
+
+    def start(self, origin=None):
+        """Anchor the schedule at `origin` (perf_counter), by default now."""
+        if self.profile is not None:
+            self.origin = time.perf_counter() if origin is None else origin
+            self._offsets = self.profile.offsets()
+
+    async def wait(self):
+        """Sleep until the next slot; returns its intended perf_counter time."""
+        if self.profile is None:
+            return time.perf_counter()
+        if self._offsets is None:
+            self.start()
+        offset = next(self._offsets, None)
+        if offset is None:
+            return time.perf_counter()
+        slot = self.origin + offset
+        delay = slot - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return slot
+
+
+class LoadStats:
+    FIELDS = ('devices', 'connections', 'connect_failures', 'server_closes', 'reconnects', 'sessions_reused',
+              'prewarmed', 'packets', 'bytes_sent', 'acks', 'ack_mismatches', 'errors', 'behind_schedule',
+              'silent_devices', 'link_resets', 'max_active')
+    LATENCIES = ('connect', 'first_ack', 'ack_complete', 'ack_service')
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+        self.active = 0
+        self.latency = {name: Histogram() for name in self.LATENCIES}
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class LoadWorker:
+    """Plays a payload scenario for a slice of virtual devices on one event loop.
+
+    Only the traffic is replayed: sends, ACK framing and ACK comparison. DB and NSQ
+    assertions are skipped, pre_test runs only with `pre_test=True`.
+
+    keep_alive (default: the payload's `keep_alive` flag) reuses device sockets across
+    cases and iterations; prewarm logs every device in before the measured run starts.
+
+    profile and connect_profile schedule packets and new connections open-loop; rate and
+    connect_rate are shorthands for constant profiles. connect and ACK latencies count
+    from the scheduled time, ack_service from the actual send.
+
+    Devices are rows of a DeviceTable and lease their slot (and so their IMEIs) from an
+    ImeiAllocator; steps are bound for a device one at a time from the compiled scenario,
+    so a device costs its table row plus its socket, not a copy of the payload.
+    Connection targets are resolved once per worker with the default variables.
+
+    impair (a --impair spec, see impair.py) degrades the links of connections whose payload
+    or settings steps do not set their own `impair`; the worker proxies them on its loop.
+    """
+
+    def __init__(self, file_path, slots, iterations=1, rate=0, connect_rate=0, pre_test=False, gate_address=None,
+                 keep_alive=None, prewarm=False, profile=None, connect_profile=None, progress=None, impair=None):
+        self.file_path = file_path
+        self.gate_address = gate_address
+        self.slots = slots
+        self.iterations = iterations
+        self.packet_pacer = Pacer(profile or (ConstantProfile(rate) if rate else None))
+        self.connect_pacer = Pacer(connect_profile or (ConstantProfile(connect_rate) if connect_rate else None))
+        self.pre_test = pre_test
+        self.keep_alive = keep_alive
+        self.prewarm = prewarm
+        self.impair = impair
+        self.ack_max_wait = config('ACK_MAX_WAIT', default=5, cast=float)
+        self.ack_grace = config('ACK_GRACE', default=0.3, cast=float)
+        self.late_slack = config('LOAD_LATE_SLACK', default=0.01, cast=float)
+        # queue the parent's live metrics read worker snapshots from
+        self.progress = progress
+        self.progress_interval = config('METRICS_INTERVAL', default=1, cast=float)
+        self.stats = LoadStats()
+        self.sessions = None
+        self.devices = DeviceTable(slots)
+        self.imeis = ImeiAllocator(slots)
+        self.msg_type = 'hex'
+        self.device_type = None
+        self.cases = []
+        # steps with generated packets, bound once per device so serials keep counting
+        self._streams = {}
+        # one serial counter per slot, shared by its generated packets
+        self._serials = {}
+        self._links = {}
+        self._resets_before = 0
+        self._db = None
+        # bulk fixtures COPY through a synchronous connection
+        self._fixture_db = None
+
+    async def run(self, start_at):
+        if self.pre_test:
+            from service.db import AsyncDB, DB
+            self._db = AsyncDB()
+            self._fixture_db = DB(maxconn=2)
+
+        scenario = compile_payload(self.file_path)
+        await self._layout(scenario)
+        keep_alive = self.keep_alive
+        if keep_alive is None:
+            keep_alive = bool(scenario.option('keep_alive'))
+        # a warmed device is only worth something if its socket survives into the run
+        self.sessions = SessionManager(self.stats, self.connect_pacer, keep_alive=keep_alive or self.prewarm)
+        self.stats.devices = len(self.slots)
+
+        try:
+            if self.prewarm:
+                await asyncio.gather(*(self._prewarm(slot) for slot in self.slots))
+                self._reset_stats()
+
+            await asyncio.sleep(max(0, start_at - time.time()))
+            started = time.time()
+            self.packet_pacer.start()
+            self.connect_pacer.start()
+            reporter = asyncio.create_task(self._report_progress()) if self.progress is not None else None
+            await asyncio.gather(*(self._run_device(self.imeis.lease()) for _ in self.slots))
+            finished = time.time()
+            if reporter:
+                reporter.cancel()
+        finally:
+            self.sessions.close_all()
+            self._put_progress()
+            for proxy in self._links.values():
+                await proxy.close()
+            if self._db:
+                await self._db.close()
+                self._fixture_db.close()
+        self._device_stats()
+        histograms = {name: hist.to_dict() for name, hist in self.stats.latency.items()}
+        return dict(self.stats.as_dict(), started=started, finished=finished, histograms=histograms)
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self._put_progress()
+
+    def _put_progress(self):
+        if self.progress is None:
+            return
+        self._device_stats()
+        histograms = {name: hist.to_dict() for name, hist in self.stats.latency.items()}
+        self.progress.put((self.slots[0], dict(self.stats.as_dict(), active=self.stats.active, histograms=histograms)))
+
+    def _device_stats(self):
+        self.stats.silent_devices = self.devices.silent()
+        self.stats.link_resets = sum(proxy.stats['resets'] for proxy in self._links.values()) - self._resets_before
+
+    def _reset_stats(self):
+        """Start the measured run with clean counters, keeping the warmed sockets."""
+        warm = self.stats
+        self.stats = LoadStats()
+        self.stats.devices = warm.devices
+        self.stats.prewarmed = warm.connections
+        self.stats.active = self.stats.max_active = warm.active
+        self.sessions.stats = self.stats
+        self.devices.reset_counters()
+        self._resets_before = sum(proxy.stats['resets'] for proxy in self._links.values())
+
+    async def _layout(self, scenario):
+        """Payload options and every connection's target, resolved once for all devices."""
+        self.msg_type = scenario.option('message_type', 'hex')
+        self.device_type = scenario.option('device_type')
+        impair = scenario.option('impair', self.impair)
+
+        host = config('TCP_HOST', default='localhost')
+        port = int(config('TCP_PORT', default=1200))
+        self.cases = []
+        for case in scenario.connections():
+            conns = []
+            for idx, (settings, steps) in enumerate(case):
+                settings = [bind_step(x) for x in settings]
+                host, port, delay = RunTest._connection_target(settings, host, port)
+                if self.gate_address:
+                    host, port = self.gate_address
+                link_host, link_port = await self._link(host, port, RunTest._connection_impairment(settings, impair, self.msg_type))
+                conns.append((idx, link_host, link_port, delay, steps))
+            self.cases.append(conns)
+
+    async def _link(self, host, port, impairment):
+        """host:port, or this worker's impairment proxy in front of it."""
+        if impairment is None:
+            return host, port
+        key = (host, port, impairment.spec())
+        if key not in self._links:
+            self._links[key] = await ImpairmentProxy((host, port), impairment).serve()
+        return self._links[key].address
+
+    def _step(self, key, case_idx, pos, node, variables):
+        """A step bound for one device; generated packets are kept and share the slot's serial counter."""
+        step = self._streams.get((key, case_idx, pos)) if self._streams else None
+        if step is None:
+            step = bind_step(node, variables)
+            if isinstance(step.get('send'), PacketStream):
+                step['send'].serials = self._serials.setdefault(key[0], SerialCounter())
+                self._streams[(key, case_idx, pos)] = step
+        return step
+
+    async def _prewarm(self, slot):
+        """Connect the first case's connections and play their first step, usually the login."""
+        row = self.devices.row(slot)
+        variables = DeviceVars(slot)
+        for idx, host, port, _, steps in (self.cases[0] if self.cases else []):
+            key = (slot, idx)
+            session = await self.sessions.acquire(key, host, port, self.msg_type, self.device_type)
+            if session is None:
+                continue
+            closed = False
+            try:
+                if steps:
+                    closed = await self._play_step(session, self._step(key, 0, 0, steps[0], variables), row)
+                    session.warmed = not closed
+            except (OSError, ValueError):
+                self.stats.errors += 1
+                closed = True
+            self.devices.state[row] = CONNECTED if self.sessions.release(key, session, closed) else CLOSED
+
+    async def _run_device(self, slot):
+        variables = DeviceVars(slot)
+        try:
+            for _ in range(self.iterations):
+                for case_idx, conns in enumerate(self.cases):
+                    self.devices.case[self.devices.row(slot)] = case_idx
+                    tasks = []
+                    for idx, host, port, delay, steps in conns:
+                        await asyncio.sleep(delay)
+                        play = self._run_connection((slot, idx), case_idx, host, port, steps, variables)
+                        # a lone connection runs in the device's own task
+                        if len(conns) == 1:
+                            await play
+                        else:
+                            tasks.append(asyncio.create_task(play))
+                    await asyncio.gather(*tasks)
+        finally:
+            self.imeis.release(slot)
+
+    async def _run_connection(self, key, case_idx, host, port, steps, variables):
+        devices = self.devices
+        row = devices.row(key[0])
+        devices.state[row] = CONNECTING
+        session = await self.sessions.acquire(key, host, port, self.msg_type, self.device_type)
+        if session is None:
+            devices.state[row] = CLOSED
+            return
+
+        devices.state[row] = CONNECTED
+        closed = False
+        # a prewarmed socket is logged in already, the measured run starts after that step
+        first = 1 if session.warmed and case_idx == 0 else 0
+        session.warmed = False
+        try:
+            for pos, node in enumerate(steps):
+                if pos < first:
+                    continue
+                devices.step[row] = pos
+                closed = await self._play_step(session, self._step(key, case_idx, pos, node, variables), row)
+                if closed:
+                    break
+        except (OSError, ValueError):
+            self.stats.errors += 1
+            closed = True
+        finally:
+            devices.state[row] = CONNECTED if self.sessions.release(key, session, closed) else CLOSED
+
+    async def _play_step(self, session, step, row):
+        """Send one step and check its ACK; returns whether the gate closed the socket."""
+        stats = self.stats
+        msg_type = self.msg_type
+        if self._db and step.get('pre_test'):
+            for kind, item in RunTest._pre_test_batches(step):
+                if kind == 'fixture':
+                    await asyncio.to_thread(run_fixture, self._fixture_db, item)
+                else:
+                    await self._db.save_many(item)
+
+        msg = RunTest._encode_send(step, msg_type)
+        intended = await self.packet_pacer.wait()
+        sent = time.perf_counter()
+        if sent - intended > self.late_slack:
+            stats.behind_schedule += 1
+        session.writer.write(msg)
+        await session.writer.drain()
+        session.reader.sent(msg)
+        stats.packets += 1
+        stats.bytes_sent += len(msg)
+        self.devices.packets[row] += 1
+
+        expected = expected_frames(step.get('expect_ack'))
+        max_wait = step.get('max_wait', self.ack_max_wait if expected else self.ack_grace)
+        timings = {'sent': intended}
+        frames, closed = await read_frames_async(session.stream, session.reader, expected, max_wait, timings)
+        stats.acks += len(frames)
+        self.devices.acks[row] += len(frames)
+        if 'first_ack' in timings:
+            stats.latency['first_ack'].record(timings['first_ack'])
+        if 'ack_complete' in timings:
+            stats.latency['ack_complete'].record(timings['ack_complete'])
+            stats.latency['ack_service'].record(timings['ack_complete'] - (sent - intended))
+
+        step_result = {'notes': ''}
+        RunTest._check_ack(step, frames, msg_type, step_result)
+        if not step_result['ack']:
+            stats.ack_mismatches += 1
+
+        if closed:
+            stats.server_closes += 1
+        return closed
+
+
+class LoadMetricsFeed:
+    """Turns the snapshots load workers put on a queue into live gauges and histograms of a Metrics."""
+
+    def __init__(self, metrics, progress):
+        self.metrics = metrics
+        self.progress = progress
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        metrics.collect(self._gauges)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+    def _drain(self):
+        while not self._stop.is_set():
+            try:
+                worker, snapshot = self.progress.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                self._latest[worker] = snapshot
+                snapshots = list(self._latest.values())
+            for name in LoadStats.LATENCIES:
+                merged = Histogram()
+                for snap in snapshots:
+                    merged.merge(Histogram.from_dict(snap['histograms'][name]))
+                self.metrics.set_histogram(name, merged)
+
+    def _gauges(self):
+        with self._lock:
+            snapshots = list(self._latest.values())
+        total = {field: sum(s[field] for s in snapshots) for field in LoadStats.FIELDS + ('active',)}
+        gauges = [(f"load_{field}", None, value) for field, value in total.items()]
+        gauges.append(('active_connections', None, total['active']))
+        gauges.append(('steps_total', None, total['packets']))
+        # a packet fails on its ACK or on an error that ends its connection, never both
+        gauges.append(('steps_failed_total', None, total['ack_mismatches'] + total['errors']))
+        for reason, field in (('ack', 'ack_mismatches'), ('connect', 'connect_failures'), ('error', 'errors')):
+            gauges.append(('failures_total', {'reason': reason}, total[field]))
+        return gauges
+
+
+def _raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _run_worker(file_path, slots, options, start_at):
+    _raise_fd_limit()
+    worker = LoadWorker(file_path, slots, **options)
+    return asyncio.run(worker.run(start_at))
+
+
+def run_load(file_name, devices=1, processes=1, iterations=1, rate=0, connect_rate=0, pre_test=False,
+             mock_gate=None, keep_alive=None, prewarm=False, profile=None, connect_profile=None, first_slot=1,
+             start_at=None, metrics=None, impair=None):
+    """Fan a payload scenario out to `devices` virtual devices across `processes` processes.
+
+    rate and connect_rate are totals per second for the whole run and are split evenly
+    between the processes, like the profile and connect_profile specs (see profiles.py)
+    that replace them. `spread:<seconds>` on connect_profile ramps up to all devices.
+
+    Device slots run from first_slot (default 1, so the configured IMEIs stay free);
+    start_at is the wall-clock start, by default a second from now. With a mock_gate
+    every device talks to it instead of TCP_HOST:TCP_PORT. Rates are measured over the
+    run itself, prewarming is not part of it. With metrics (metrics.Metrics) the workers
+    report their counters and histograms to it while they run. impair degrades the device
+    links through a proxy in every worker (see impair.py).
+    """
+    file_path = file_name if os.path.isfile(file_name) else os.path.join(PAYLOAD_FOLDER, file_name)
+    if not os.path.isfile(file_path):
+        print(f"[ERROR] File not found: {file_path}")
+        return None
+
+    try:
+        profile = parse_profile(profile, count=devices) if profile else ConstantProfile(rate) if rate else None
+        connect_profile = (parse_profile(connect_profile, count=devices) if connect_profile
+                           else ConstantProfile(connect_rate) if connect_rate else None)
+        parse_impairment(impair)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        return None
+
+    processes = max(1, min(processes, devices))
+    options = dict(
+        iterations=iterations,
+        pre_test=pre_test,
+        keep_alive=keep_alive,
+        prewarm=prewarm,
+        impair=impair,
+    )
+    last_slot = first_slot + devices
+    if mock_gate:
+        if pre_test:
+            print("[WARN] --pre-test is ignored with the mock gate")
+            options['pre_test'] = False
+        for slot in range(first_slot, last_slot):
+            mock_gate.learn(load_payload(file_path, device_vars(slot)), key=(file_path, slot))
+        options['gate_address'] = mock_gate.address
+    slices = [range(first_slot + i, last_slot, processes) for i in range(processes)]
+    per_process = [
+        dict(options, profile=p, connect_profile=c)
+        for p, c in zip(split_profile(profile, processes), split_profile(connect_profile, processes))
+    ]
+
+    print(f"\n[INFO] Load: {devices} devices on {processes} processes, scenario {os.path.basename(file_path)}")
+    start_at = time.time() + 1 if start_at is None else start_at
+    manager = feed = None
+    if metrics is not None:
+        manager = multiprocessing.Manager()
+        feed = LoadMetricsFeed(metrics, manager.Queue()).start()
+        per_process = [dict(p, progress=feed.progress) for p in per_process]
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_run_worker, [file_path] * processes, slices, per_process,
+                                    [start_at] * processes))
+    finally:
+        if feed:
+            # the workers' last snapshots are already queued
+            time.sleep(0.6)
+            feed.stop()
+            manager.shutdown()
+    return load_report(combine_results(results))
+
+
+def combine_results(results):
+    """Sum the counters of worker results (or load reports) and merge their latency histograms."""
+    total = LoadStats().as_dict()
+    latency = {name: Histogram() for name in LoadStats.LATENCIES}
+    for result in results:
+        for k in total:
+            total[k] += result[k]
+        for name, hist in result['histograms'].items():
+            latency[name].merge(Histogram.from_dict(hist))
+    total['started'] = min(r['started'] for r in results)
+    total['finished'] = max(r['finished'] for r in results)
+    total['histograms'] = latency
+    return total
+
+
+def load_report(combined):
+    """Print and return the load report of combined results; it keeps the raw histograms for further merging."""
+    elapsed = max(combined['finished'] - combined['started'], 1e-9)
+    report = {k: combined[k] for k in LoadStats.FIELDS}
+    report['elapsed'] = round(elapsed, 3)
+    report['connections_per_sec'] = round(report['connections'] / elapsed, 2)
+    report['packets_per_sec'] = round(report['packets'] / elapsed, 2)
+    report['passed'] = not (report['errors'] or report['ack_mismatches'] or report['connect_failures'])
+    print('[LOAD]', report)
+
+    histograms = combined['histograms']
+    report['latency'] = {name: hist.summary() for name, hist in histograms.items()}
+    for name, summary in report['latency'].items():
+        print(f'[LOAD] latency {name}:', summary)
+    report.update(started=combined['started'], finished=combined['finished'],
+                  histograms={name: hist.to_dict() for name, hist in histograms.items()})
+    return report
@@ -0,0 +1,208 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from decouple import config
+from report import Histogram
+
+PREFIX = 'gate_runner'
+# latencies the progress line shows, in this order
+PROGRESS_LATENCIES = ('ack_complete', 'db_visible', 'nsq_visible')
+
+
+class Metrics:
+    """Live counters, gauges and latency histograms of a run.
+
+    Runners update it as steps finish; collectors add gauges computed at read time (NSQ
+    queue depth, load worker snapshots). render() gives the Prometheus text format,
+    snapshot() the plain values the progress line is built from.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name, delta, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, metric, value):
+        with self._lock:
+            if metric not in self._histograms:
+                self._histograms[metric] = Histogram()
+            self._histograms[metric].record(value)
+
+    def set_histogram(self, metric, hist: Histogram):
+        with self._lock:
+            self._histograms[metric] = hist
+
+    def collect(self, fn):
+        """Register fn() -> [(name, labels dict or None, value), ...], gauges read on every scrape."""
+        self._collectors.append(fn)
+
+    def record_step(self, result: dict, timings=None):
+        """Count a reported step and its failure reasons, and record its latencies."""
+        self.inc('steps_total')
+        if result.get('status') == 'FAIL':
+            self.inc('steps_failed_total')
+            for reason in ('ack', 'db', 'nsq', 'conn'):
+                if not result.get(reason):
+                    self.inc('failures_total', reason=reason)
+            if result.get('error'):
+                self.inc('failures_total', reason='error')
+        for metric, value in (timings or {}).items():
+            if metric != 'sent':
+                self.observe(metric, value)
+
+    def _collected(self):
+        gauges = {}
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    gauges[self._key(name, labels or {})] = value
+            except Exception as e:
+                print(f"[WARN] Metrics collector failed: {e}")
+        return gauges
+
+    def snapshot(self):
+        gauges = self._collected()
+        with self._lock:
+            gauges.update(self._gauges)
+            return {
+                'uptime': time.time() - self.started,
+                'counters': dict(self._counters),
+                'gauges': gauges,
+                'latency': {metric: hist.summary() for metric, hist in self._histograms.items()},
+            }
+
+    @staticmethod
+    def _series(name, labels):
+        if not labels:
+            return f"{PREFIX}_{name}"
+        return f"{PREFIX}_{name}{{" + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def render(self):
+        gauges = self._collected()
+        with self._lock:
+            gauges.update(self._gauges)
+            counters = dict(self._counters)
+            histograms = {metric: (hist.count, hist.total, [hist.percentile(q * 100) for q in (0.5, 0.9, 0.95, 0.99)])
+                          for metric, hist in self._histograms.items()}
+
+        lines = [f"# TYPE {PREFIX}_uptime_seconds gauge", f"{PREFIX}_uptime_seconds {time.time() - self.started:.3f}"]
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+                    typed.add(name)
+                lines.append(f"{self._series(name, labels)} {value}")
+
+        if histograms:
+            lines.append(f"# TYPE {PREFIX}_latency_seconds summary")
+        for metric, (count, total, quantiles) in sorted(histograms.items()):
+            for q, value in zip(('0.5', '0.9', '0.95', '0.99'), quantiles):
+                lines.append(f'{PREFIX}_latency_seconds{{metric="{metric}",quantile="{q}"}} {value or 0:.6f}')
+            lines.append(f'{PREFIX}_latency_seconds_sum{{metric="{metric}"}} {total:.6f}')
+            lines.append(f'{PREFIX}_latency_seconds_count{{metric="{metric}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(metrics: Metrics, port, host=None):
+    """Serve /metrics in the Prometheus text format on a daemon thread; returns the server."""
+    host = host or config('METRICS_HOST', default='127.0.0.1')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class Progress:
+    """Prints one compact status line every `interval` seconds until stopped."""
+
+    def __init__(self, metrics: Metrics, interval=None):
+        self.metrics = metrics
+        self.interval = interval or config('PROGRESS_INTERVAL', default=2, cast=float)
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = (time.time(), 0)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+        print(self.line())
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            print(self.line(), flush=True)
+
+    def line(self):
+        snap = self.metrics.snapshot()
+        counters, gauges = snap['counters'], snap['gauges']
+        # load workers report their totals as gauges
+        steps = counters.get(('steps_total', ()), gauges.get(('steps_total', ()), 0))
+        now = time.time()
+        last_time, last_steps = self._last
+        self._last = (now, steps)
+        rate = (steps - last_steps) / max(now - last_time, 1e-9)
+
+        # a step failing for several reasons is one failed step, the reasons are broken down after it
+        failed_steps = counters.get(('steps_failed_total', ()), gauges.get(('steps_failed_total', ()), 0))
+        failures = {dict(labels)['reason']: v for (name, labels), v in counters.items() if name == 'failures_total'}
+        failures.update({dict(labels)['reason']: v for (name, labels), v in gauges.items() if name == 'failures_total'})
+        failed = ', '.join(f"{reason} {count}" for reason, count in sorted(failures.items()) if count)
+
+        elapsed = int(snap['uptime'])
+        parts = [
+            f"{elapsed // 60:02d}:{elapsed % 60:02d}",
+            f"active {gauges.get(('active_connections', ()), 0)}",
+            f"steps {steps} ({rate:.1f}/s)",
+            f"failed {failed_steps}" + (f" ({failed})" if failed else ''),
+        ]
+        for metric in PROGRESS_LATENCIES:
+            p95 = snap['latency'].get(metric, {}).get('p95')
+            if p95 is not None:
+                parts.append(f"{metric} p95 {p95 * 1000:.1f}ms")
+        if ('nsq_pending', ()) in gauges:
+            parts.append(f"nsq pending {gauges[('nsq_pending', ())]}")
+        return '[PROGRESS] ' + ' | '.join(parts)
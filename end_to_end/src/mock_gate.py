@@ -0,0 +1,409 @@
+import json
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+from helper import encode_send
+from packets import PacketStream, frame_key
+
+
+# DB STAND-IN
+class _FakeCursor:
+    def __init__(self, db, conn):
+        self._db = db
+        self.connection = conn
+        self.rowcount = 0
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, query, params=None):
+        return f"{query} -- {params!r}".encode()
+
+    def execute(self, query, params=None):
+        self._db.record(query)
+        self.rowcount = 1
+
+    def copy_expert(self, sql, data):
+        self._db.record(sql)
+
+    def fetchone(self):
+        return None
+
+
+class _FakeConnection:
+    encoding = 'UTF8'
+    autocommit = True
+    closed = False
+
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self):
+        return _FakeCursor(self._db, self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeDB:
+    """In-memory stand-in for service.db.DB.
+
+    Rows are keyed by (query, params) of the db_check that reads them; the mock gate
+    stores the rows a step asserts when it receives that step's packet, as the real
+    gate would write them. Writes from pre_test and fixtures are only counted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rows = {}
+        self.statements = 0
+        self.queries = 0
+
+    @staticmethod
+    def _key(query, params):
+        return query, json.dumps(list(params or []), default=str)
+
+    def put(self, query, params, row):
+        with self._lock:
+            self.rows[self._key(query, params)] = row
+
+    def record(self, query):
+        with self._lock:
+            self.statements += 1
+
+    @contextmanager
+    def connection(self):
+        yield _FakeConnection(self)
+
+    @contextmanager
+    def cursor(self):
+        with _FakeConnection(self).cursor() as cursor:
+            yield cursor
+
+    def fetch_one_dict(self, query, params=None):
+        with self._lock:
+            self.queries += 1
+            row = self.rows.get(self._key(query, params))
+        return dict(row) if row is not None else None
+
+    def fetch_one(self, query, params=None):
+        row = self.fetch_one_dict(query, params)
+        return tuple(row.values()) if row is not None else None
+
+    def save(self, query, params=None):
+        self.record(query)
+        return 1
+
+    def save_many(self, statements):
+        for _ in statements:
+            self.record(None)
+        return 1 if statements else 0
+
+    def close(self):
+        pass
+
+
+class FakeAsyncDB:
+    """service.db.AsyncDB interface over a FakeDB."""
+
+    def __init__(self, db: FakeDB):
+        self._db = db
+
+    @asynccontextmanager
+    async def connection(self):
+        yield _FakeConnection(self._db)
+
+    async def fetch_one_dict(self, query, params=None):
+        return self._db.fetch_one_dict(query, params)
+
+    async def save(self, query, params=None):
+        return self._db.save(query, params)
+
+    async def save_many(self, statements):
+        return self._db.save_many(statements)
+
+    async def close(self):
+        pass
+
+
+# NSQ STAND-IN
+class MockMessage:
+    """The part of nsq.Message the runner's handler uses."""
+
+    __slots__ = ('body',)
+
+    def __init__(self, body):
+        self.body = body
+
+
+class MockNsq:
+    """Delivers published messages straight to the subscribed handlers, like one nsqd channel per subscriber."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self.published = 0
+
+    def subscribe(self, topic, handler):
+        with self._lock:
+            self._handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic, body: bytes):
+        with self._lock:
+            self.published += 1
+            handlers = list(self._handlers.get(topic, []))
+        for handler in handlers:
+            handler(MockMessage(body))
+
+
+# GATE
+class _Script:
+    """What the gate answers the packets of one learned run with, and how far each packet got."""
+
+    def __init__(self):
+        self.entries = {}
+        self.cursor = {}
+        self.send_lengths = set()
+
+    def add(self, send, entry):
+        self.entries.setdefault(send, []).append(entry)
+        if isinstance(send, bytes):
+            self.send_lengths.add(len(send))
+
+    def next(self, send):
+        entries = self.entries[send]
+        idx = self.cursor.get(send, 0)
+        self.cursor[send] = idx + 1
+        return entries[idx % len(entries)]
+
+    def find(self, buf: bytearray, generated=True):
+        """The script key of the packet at the start of buf and its length, or (None, 0).
+
+        generated=False only matches learned bytes, not generated packets by frame type.
+        """
+        whole = bytes(buf)
+        if whole in self.entries:
+            return whole, len(whole)
+        # several packets arrived in one chunk
+        for length in sorted(self.send_lengths, reverse=True):
+            if 0 < length < len(buf) and bytes(buf[:length]) in self.entries:
+                return bytes(buf[:length]), length
+        if generated:
+            key, length = frame_key(buf)
+            if key in self.entries:
+                return key, length
+        return None, 0
+
+    def startswith(self, whole: bytes):
+        return any(isinstance(send, bytes) and send.startswith(whole) for send in self.entries)
+
+
+class MockGate:
+    """In-process gate that replays what the payload files expect.
+
+    learn() reads the bound payload of a run: for every step it stores the ACK frames
+    from expect_ack, the nsq_check messages and the db_check rows under the bytes the
+    step sends. When those bytes arrive the gate publishes the messages, stores the
+    rows and answers with the ACK frames. A packet sent by several steps is answered
+    by them in turn. Generated packets (packets.PacketStream) are matched by device
+    type and protocol instead of their bytes. Unknown packets get no reply.
+
+    Every run keeps its own script: a connection is bound to the run its first packet
+    belongs to (the login carries the run's IMEI; a packet several runs send goes to
+    the one learned last), so runs sending the same packets never take each other's
+    answers.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, topic='PACKET'):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.db = FakeDB()
+        self.nsq = MockNsq()
+        self.stats = {'connections': 0, 'packets': 0, 'unknown_packets': 0, 'acks': 0}
+
+        self._lock = threading.Lock()
+        # learn key -> _Script, in the order they were learned
+        self._scripts = {}
+
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    # script
+    def learn(self, payload: dict, key=None):
+        """Add the steps of a bound payload as one run; a payload learned under the same key is skipped."""
+        with self._lock:
+            if key is None:
+                key = object()
+            elif key in self._scripts:
+                return
+            script = self._scripts[key] = _Script()
+
+            msg_type = payload.get('message_type', 'hex')
+            for case in payload.get('test_case', []):
+                for conn in case.get('connections') or []:
+                    for step in conn.get('steps', []):
+                        if step.get('name') and 'send' in step:
+                            self._learn_step(script, step, msg_type)
+
+    def _learn_step(self, script, step, msg_type):
+        entry = (self._ack_bytes(step, msg_type), self._nsq_messages(step), self._db_rows(step))
+        if isinstance(step['send'], PacketStream):
+            # generated packets differ on every send, they are answered by device type and protocol
+            script.add(step['send'].key, entry)
+            return
+        script.add(step.get('send_bytes') or encode_send(step['send'], msg_type), entry)
+
+    @staticmethod
+    def _ack_bytes(step, msg_type):
+        if step.get('expect_ack_bytes') is not None:
+            return b''.join(step['expect_ack_bytes'])
+        expect_ack = step.get('expect_ack')
+        if not expect_ack:
+            return b''
+        if isinstance(expect_ack, str):
+            expect_ack = [expect_ack]
+        if msg_type == 'hex':
+            return b''.join(bytes.fromhex(x) for x in expect_ack)
+        return ''.join(expect_ack).encode()
+
+    @staticmethod
+    def _nsq_messages(step):
+        return [
+            {k: v for k, v in expected.items() if k != 'expected_failed'}
+            for expected in step.get('nsq_check') or []
+        ]
+
+    @staticmethod
+    def _db_rows(step):
+        rows = []
+        for db in step.get('db_check') or []:
+            if not db.get('query'):
+                continue
+            assertions = db.get('assertions')
+            # checks without assertions expect no row
+            row = None
+            if isinstance(assertions, dict) and assertions:
+                row = {k: (None if v == '' else v) for k, v in assertions.items()}
+            rows.append((db['query'], db.get('params', []), row))
+        return rows
+
+    def _match(self, buf: bytearray, script=None):
+        """(script entry, length, script) of the packet at the start of buf, or (None, 0, script).
+
+        An unbound connection (script None) is bound to the last learned run knowing the packet,
+        by its bytes before any run's generated packets, which match every packet of their type.
+        """
+        with self._lock:
+            if script:
+                passes = [(script, True)]
+            else:
+                scripts = list(reversed(list(self._scripts.values())))
+                passes = [(c, False) for c in scripts] + [(c, True) for c in scripts]
+            for candidate, generated in passes:
+                send, length = candidate.find(buf, generated)
+                if send is not None:
+                    return candidate.next(send), length, candidate
+        return None, 0, script
+
+    def _partial(self, buf: bytearray, script=None):
+        """Whether buf can still grow into a known packet, i.e. the rest is in a later segment."""
+        if len(buf) >= 65536:
+            return False
+        if (buf[:2] in (b'\x78\x78', b'\x79\x79') or buf[:1] == b'\x00') and frame_key(buf)[0] is None:
+            # a framed device packet that is not complete yet
+            return True
+        # or the start of a learned send, which may hold several packets
+        whole = bytes(buf)
+        with self._lock:
+            return any(c.startswith(whole) for c in ([script] if script else self._scripts.values()))
+
+    # server
+    def _emit(self, entry):
+        acks, messages, rows = entry
+        for query, params, row in rows:
+            self.db.put(query, params, row)
+        now = datetime.now(timezone.utc).isoformat()
+        for msg in messages:
+            body = {k: (now if v == '' and k in ('time', 'received_on') else v) for k, v in msg.items()}
+            self.nsq.publish(self.topic, json.dumps(body, default=str).encode())
+        return acks
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats['connections'] += 1
+        buf = bytearray()
+        # the run this connection plays, known from its first packet
+        script = None
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data
+                while buf:
+                    entry, length, script = self._match(buf, script)
+                    if entry is None and self._partial(buf, script):
+                        # a fragmented write, wait for the rest
+                        break
+                    if entry is None:
+                        self.stats['unknown_packets'] += 1
+                        buf.clear()
+                        break
+                    del buf[:length]
+                    self.stats['packets'] += 1
+                    acks = self._emit(entry)
+                    if acks:
+                        self.stats['acks'] += 1
+                        writer.write(acks)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self):
+        """Serve on a background thread; returns the gate once it is listening."""
+        started = threading.Event()
+
+        async def _serve():
+            self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=4096)
+            self.host, self.port = self._server.sockets[0].getsockname()[:2]
+            started.set()
+            async with self._server:
+                await self._server.serve_forever()
+
+        def _thread_fn():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(_serve())
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self._loop.close()
+
+        self._thread = threading.Thread(target=_thread_fn, daemon=True)
+        self._thread.start()
+        if not started.wait(timeout=5):
+            raise RuntimeError("Mock gate did not start within timeout")
+        print(f"[INFO] Mock gate listening on {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        if self._loop and self._server:
+            # ends serve_forever; open connections die with the daemon thread
+            self._loop.call_soon_threadsafe(self._server.close)
+        if self._thread:
+            self._thread.join(timeout=5)
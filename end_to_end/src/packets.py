@@ -0,0 +1,245 @@
+import time
+import threading
+from datetime import datetime, timezone
+
+# PROTOCOL NUMBERS
+CONCOX_LOGIN = 0x01
+CONCOX_HEARTBEAT = 0x13
+CONCOX_LOCATION = 0x22
+TELTONIKA_PREAMBLE = b'\x00\x00\x00\x00'
+CODEC8 = 0x08
+
+
+# CHECKSUMS
+def _crc16_table(poly):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_ITU_TABLE = _crc16_table(0x8408)
+_IBM_TABLE = _crc16_table(0xA001)
+
+
+def crc_itu(data) -> int:
+    """CRC-ITU (CRC-16/X-25) of concox packets, over length byte(s) to serial number."""
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _ITU_TABLE[(crc ^ byte) & 0xFF]
+    return crc ^ 0xFFFF
+
+
+def crc16_ibm(data) -> int:
+    """CRC-16/IBM (ARC) of teltonika AVL packets, over codec id to the second record count."""
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ _IBM_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+
+# CONCOX
+def concox_frame(protocol: int, content: bytes, serial: int) -> bytes:
+    """78 78 <len> <protocol> <content> <serial:2> <crc:2> 0d 0a, or 79 79 with a 2 byte length."""
+    length = 1 + len(content) + 4
+    body = bytes([protocol]) + content + (serial & 0xFFFF).to_bytes(2, 'big')
+    if length > 0xFF:
+        head = length.to_bytes(2, 'big')
+        start = b'\x79\x79'
+    else:
+        head = bytes([length])
+        start = b'\x78\x78'
+    crc = crc_itu(head + body)
+    return start + head + body + crc.to_bytes(2, 'big') + b'\r\n'
+
+
+def concox_login(imei, serial=1, type_id=0x2008, timezone_info=0x12c9) -> bytes:
+    content = bytes.fromhex(str(imei).rjust(16, '0')) + type_id.to_bytes(2, 'big') + timezone_info.to_bytes(2, 'big')
+    return concox_frame(CONCOX_LOGIN, content, serial)
+
+
+def concox_heartbeat(serial=1, terminal_info=0x06, voltage=0x04, gsm=0x05, language=0x0002) -> bytes:
+    content = bytes([terminal_info, voltage, gsm]) + language.to_bytes(2, 'big')
+    return concox_frame(CONCOX_HEARTBEAT, content, serial)
+
+
+def concox_location(serial=1, when=None, lat=-7.269, lon=113.333, speed=0, course=0, satellites=8,
+                    mcc=510, mnc=10, lac=0x3e99, cell_id=0x96f4, acc=1, upload_mode=0, realtime=1) -> bytes:
+    """GPS location packet (protocol 0x22); coordinates in degrees, south and west negative."""
+    when = when or datetime.now(timezone.utc)
+    status = 0x10 | (0x08 if lon < 0 else 0) | (0x04 if lat >= 0 else 0) | ((course >> 8) & 0x03)
+    content = (
+        bytes([when.year % 100, when.month, when.day, when.hour, when.minute, when.second])
+        + bytes([0xC0 | (satellites & 0x0F)])
+        + round(abs(lat) * 1800000).to_bytes(4, 'big')
+        + round(abs(lon) * 1800000).to_bytes(4, 'big')
+        + bytes([speed & 0xFF, status, course & 0xFF])
+        + mcc.to_bytes(2, 'big') + bytes([mnc]) + lac.to_bytes(2, 'big') + cell_id.to_bytes(3, 'big')
+        + bytes([acc, upload_mode, realtime])
+    )
+    return concox_frame(CONCOX_LOCATION, content, serial)
+
+
+# TELTONIKA
+def teltonika_login(imei) -> bytes:
+    imei = str(imei).encode()
+    return len(imei).to_bytes(2, 'big') + imei
+
+
+def codec8_record(when=None, lat=-7.269, lon=113.333, altitude=0, angle=0, satellites=8, speed=0, priority=0,
+                  event_id=0, io=None) -> bytes:
+    """One codec 8 AVL record; io maps IO ids to values, sized 1/2/4/8 bytes by magnitude."""
+    timestamp = int((when or datetime.now(timezone.utc)).timestamp() * 1000)
+    groups = {1: [], 2: [], 4: [], 8: []}
+    for io_id, value in (io or {}).items():
+        size = next(s for s in (1, 2, 4, 8) if value < 1 << (8 * s))
+        groups[size].append(bytes([io_id]) + value.to_bytes(size, 'big'))
+    io_data = bytes([event_id, sum(len(g) for g in groups.values())])
+    for size in (1, 2, 4, 8):
+        io_data += bytes([len(groups[size])]) + b''.join(groups[size])
+    return (
+        timestamp.to_bytes(8, 'big') + bytes([priority])
+        + round(lon * 10000000).to_bytes(4, 'big', signed=True)
+        + round(lat * 10000000).to_bytes(4, 'big', signed=True)
+        + altitude.to_bytes(2, 'big', signed=True) + angle.to_bytes(2, 'big') + bytes([satellites])
+        + speed.to_bytes(2, 'big') + io_data
+    )
+
+
+def codec8_packet(records) -> bytes:
+    """00000000 <len:4> 08 <count> <records> <count> <crc:4>"""
+    data = bytes([CODEC8, len(records)]) + b''.join(records) + bytes([len(records)])
+    return TELTONIKA_PREAMBLE + len(data).to_bytes(4, 'big') + data + crc16_ibm(data).to_bytes(4, 'big')
+
+
+# STREAMS
+class SerialCounter:
+    """Serial numbers of one device, shared by all its packet streams so they never repeat one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = None
+
+    def next(self, start=1):
+        """The next serial; the first packet of the device starts counting at `start`."""
+        with self._lock:
+            if self.value is None:
+                self.value = start & 0xFFFF
+            serial = self.value
+            self.value = (self.value + 1) & 0xFFFF
+            return serial
+
+
+def share_serials(steps, counters):
+    """Point the packet streams in one connection's steps at their device's SerialCounter.
+
+    The device is the IMEI of the connection's login stream (None when it has none);
+    counters maps devices to their counter and is shared by the connections of a run.
+    """
+    streams = [step['send'] for step in steps if isinstance(step.get('send'), PacketStream)]
+    device = next((stream.imei for stream in streams if stream.imei is not None), None)
+    counter = counters.setdefault(device, SerialCounter())
+    for stream in streams:
+        stream.serials = counter
+
+
+class PacketStream:
+    """A packet template bound to one device; next() builds a new valid packet on every send.
+
+    Concox packets get the next serial number of their device (a SerialCounter shared by
+    the device's streams, or the stream's own when it has none), location packets and AVL records the current
+    time and a position moved a little from the previous one, so a device sending at a high rate
+    never repeats a packet and the gate's duplicate handling stays out of the measurement.
+    Fields arrive as they are written in the payload and are only converted on first use,
+    which lets the templates be expanded with ${var} placeholders at compile time.
+    """
+
+    KINDS = ('concox_login', 'concox_heartbeat', 'concox_location', 'teltonika_login', 'teltonika_avl')
+    # degrees a location moves per packet
+    STEP = 0.00001
+
+    def __init__(self, kind, imei=None, **fields):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown packet kind: {kind}")
+        self.kind = kind
+        self.imei = imei
+        self.fields = fields
+        self.serial = None
+        self.serials = None
+        self.sent = 0
+
+    @property
+    def key(self):
+        """(device type, protocol) of the packets, what the mock gate answers them by."""
+        return {
+            'concox_login': ('concox', CONCOX_LOGIN),
+            'concox_heartbeat': ('concox', CONCOX_HEARTBEAT),
+            'concox_location': ('concox', CONCOX_LOCATION),
+            'teltonika_login': ('teltonika', 'login'),
+            'teltonika_avl': ('teltonika', CODEC8),
+        }[self.kind]
+
+    def _prepare(self):
+        fields = {k: (float(v) if k in ('lat', 'lon') else int(v, 0) if isinstance(v, str) else v)
+                  for k, v in self.fields.items() if v not in (None, '')}
+        self.serial = fields.pop('serial', 1)
+        self.records = fields.pop('records', 1)
+        self.fields = fields
+
+    def _moved(self):
+        fields = dict(self.fields)
+        if self.kind in ('concox_location', 'teltonika_avl'):
+            fields['lat'] = fields.get('lat', -7.269) + self.STEP * self.sent
+            fields['lon'] = fields.get('lon', 113.333) + self.STEP * self.sent
+        return fields
+
+    def next(self) -> bytes:
+        if self.serial is None:
+            self._prepare()
+        if self.serials is not None:
+            serial = self.serials.next(self.serial)
+        else:
+            serial = self.serial
+            self.serial = (self.serial + 1) & 0xFFFF
+
+        if self.kind == 'concox_login':
+            packet = concox_login(self.imei, serial, **self.fields)
+        elif self.kind == 'concox_heartbeat':
+            packet = concox_heartbeat(serial, **self.fields)
+        elif self.kind == 'concox_location':
+            packet = concox_location(serial, **self._moved())
+        elif self.kind == 'teltonika_login':
+            packet = teltonika_login(self.imei)
+        else:
+            now = time.time()
+            records = []
+            for i in range(self.records):
+                # one millisecond apart, the gate keys AVL records by timestamp
+                when = datetime.fromtimestamp(now - (self.records - 1 - i) / 1000, timezone.utc)
+                records.append(codec8_record(when, **self._moved()))
+            packet = codec8_packet(records)
+        self.sent += 1
+        return packet
+
+    def __repr__(self):
+        return f"PacketStream({self.kind}, imei={self.imei}, sent={self.sent})"
+
+
+def frame_key(buf):
+    """(key, length) of the device packet at the start of buf, or (None, 0) when it is not complete."""
+    if len(buf) >= 4 and buf[:2] == b'\x78\x78':
+        length = buf[2] + 5
+        return (('concox', buf[3]), length) if len(buf) >= length else (None, 0)
+    if len(buf) >= 5 and buf[:2] == b'\x79\x79':
+        length = int.from_bytes(buf[2:4], 'big') + 6
+        return (('concox', buf[4]), length) if len(buf) >= length else (None, 0)
+    if len(buf) >= 9 and buf[:4] == TELTONIKA_PREAMBLE:
+        length = 12 + int.from_bytes(buf[4:8], 'big')
+        return (('teltonika', buf[8]), length) if len(buf) >= length else (None, 0)
+    if len(buf) >= 2 and buf[0] == 0:
+        length = 2 + int.from_bytes(buf[:2], 'big')
+        return (('teltonika', 'login'), length) if len(buf) >= length else (None, 0)
+    return None, 0
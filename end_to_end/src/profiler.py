@@ -0,0 +1,240 @@
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextvars
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from decouple import config
+
+# phases that wait on the gate, the database, NSQ or the schedule rather than work in the runner
+WAIT_PHASES = {'connect', 'delay', 'select', 'settle', 'schedule_wait', 'replay_wait', 'join',
+               'db_query', 'db_backoff', 'pre_test', 'nsq_wait'}
+# runner work per step above this many seconds is reported as a warning
+STEP_BUDGET = config('PROFILE_STEP_BUDGET', default=0.001, cast=float)
+MEMORY_FRAMES = config('PROFILE_MEMORY_FRAMES', default=10, cast=int)
+TOP = 15
+
+# open phases of the current thread or asyncio task, outermost first
+_stack = contextvars.ContextVar('profile_stack', default=())
+_NULL = nullcontext()
+
+
+class _Phase:
+    __slots__ = ('profiler', 'name', 'frame', 'token')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        # name, start, time spent in children on the same thread, thread
+        self.frame = [self.name, time.perf_counter(), 0.0, threading.get_ident()]
+        self.token = _stack.set(_stack.get() + (self.frame,))
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.frame[1]
+        stack = _stack.get()
+        _stack.reset(self.token)
+        if len(stack) > 1 and stack[-2][3] == self.frame[3]:
+            stack[-2][2] += elapsed
+        # concurrent asyncio children can add up to more than the parent lasted
+        self.profiler._record(';'.join(f[0] for f in stack), elapsed, max(0.0, elapsed - self.frame[2]))
+        return False
+
+
+class _Acquire:
+    __slots__ = ('profiler', 'lock', 'name')
+
+    def __init__(self, profiler, lock, name):
+        self.profiler = profiler
+        self.lock = lock
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            with _Phase(self.profiler, self.name):
+                self.lock.acquire()
+        else:
+            self.lock.acquire()
+        return self.lock
+
+    def __exit__(self, *exc):
+        self.lock.release()
+        return False
+
+
+class Profiler:
+    """Where the runner itself spends its time.
+
+    phase(name) wraps a piece of runner work in a timer; until enable() it returns a shared
+    no-op context, so the hooks stay in place at no measurable cost. Phases nest per thread
+    or asyncio task and are kept as stacks (run;case;send) with total and self time, in
+    per-thread tables merged only when the report is built. cProfile (per worker thread)
+    and tracemalloc are opt-in on top.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = False
+        self.memory = False
+        self.started = None
+        self._local = threading.local()
+        self._tables = []
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def enable(self, cprofile=False, memory=False):
+        self.enabled = True
+        self.cprofile = cprofile
+        self.memory = memory
+        self.started = time.perf_counter()
+        if memory:
+            tracemalloc.start(MEMORY_FRAMES)
+        return self
+
+    def phase(self, name):
+        return _Phase(self, name) if self.enabled else _NULL
+
+    def acquire(self, lock, name='lock_wait'):
+        """`with profiler.acquire(lock):` holds the lock, timing how long taking it took."""
+        return _Acquire(self, lock, name)
+
+    def _record(self, key, elapsed, own):
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._local.table = {}
+            with self._lock:
+                self._tables.append(table)
+        entry = table.get(key)
+        if entry is None:
+            table[key] = [1, elapsed, own]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] += own
+
+    @contextmanager
+    def worker(self):
+        """cProfile the calling thread for the duration of the block, when enabled with cprofile."""
+        if not self.cprofile:
+            yield
+            return
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            with self._lock:
+                try:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(prof)
+                    else:
+                        self._stats.add(prof)
+                except TypeError:
+                    # nothing was called on this thread
+                    pass
+
+    # REPORT
+    def stacks(self):
+        """{stack: [count, total, self]} merged over threads."""
+        merged = {}
+        with self._lock:
+            tables = list(self._tables)
+        for table in tables:
+            for key, (count, total, own) in list(table.items()):
+                entry = merged.setdefault(key, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += total
+                entry[2] += own
+        return merged
+
+    def breakdown(self):
+        """Per phase name: calls, total and self seconds, sorted by self time."""
+        phases = {}
+        for key, (count, total, own) in self.stacks().items():
+            name = key.rsplit(';', 1)[-1]
+            entry = phases.setdefault(name, {'phase': name, 'calls': 0, 'total': 0.0, 'self': 0.0})
+            entry['calls'] += count
+            # a phase nested in itself is counted once in its total
+            if name not in key.split(';')[:-1]:
+                entry['total'] += total
+            entry['self'] += own
+        rows = sorted(phases.values(), key=lambda r: r['self'], reverse=True)
+        for row in rows:
+            row['wait'] = row['phase'] in WAIT_PHASES
+            row['mean_us'] = round(row['total'] / row['calls'] * 1e6, 1) if row['calls'] else 0
+            row['total'] = round(row['total'], 6)
+            row['self'] = round(row['self'], 6)
+        return rows
+
+    def folded(self):
+        """Collapsed stacks with self time in microseconds, the input of flamegraph.pl and speedscope."""
+        return ''.join(f"{key} {round(own * 1e6)}\n"
+                       for key, (_, _, own) in sorted(self.stacks().items()) if round(own * 1e6))
+
+    def _memory(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'current': current,
+            'peak': peak,
+            'top': [{'where': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:TOP]],
+        }
+
+    def report(self, steps=0, prefix=None):
+        """Print the breakdown and write <prefix>.json, .folded and .pstats; returns the breakdown dict."""
+        wall = time.perf_counter() - self.started
+        rows = self.breakdown()
+        work = sum(r['self'] for r in rows if not r['wait'])
+        waiting = sum(r['self'] for r in rows if r['wait'])
+        result = {
+            'wall': round(wall, 6),
+            'steps': steps,
+            'runner_work': round(work, 6),
+            'waiting': round(waiting, 6),
+            'work_per_step': round(work / steps, 9) if steps else None,
+            'phases': rows,
+        }
+
+        print(f"\n[PROFILE] {'phase':<16} {'calls':>8} {'total s':>10} {'self s':>10} {'mean us':>10}")
+        for row in rows[:TOP]:
+            print(f"[PROFILE] {row['phase'] + ('*' if row['wait'] else ''):<16} {row['calls']:>8} "
+                  f"{row['total']:>10.4f} {row['self']:>10.4f} {row['mean_us']:>10.1f}")
+        print(f"[PROFILE] * waits on the gate/DB/NSQ. runner work {work:.4f}s, waiting {waiting:.4f}s, wall {wall:.3f}s")
+        if steps:
+            per_step = work / steps
+            print(f"[PROFILE] runner work per step {per_step * 1e6:.1f}us over {steps} steps")
+            if per_step > STEP_BUDGET:
+                print(f"[WARN] Runner work per step is above PROFILE_STEP_BUDGET ({STEP_BUDGET * 1e6:.0f}us), "
+                      f"latencies include runner overhead")
+
+        if self.memory:
+            result['memory'] = self._memory()
+            print(f"[PROFILE] memory peak {result['memory']['peak'] / 1e6:.1f} MB, top allocations:")
+            for entry in result['memory']['top'][:5]:
+                print(f"[PROFILE]   {entry['size'] / 1e3:>10.1f} kB  {entry['where']}")
+            tracemalloc.stop()
+
+        if prefix:
+            with open(f"{prefix}.json", 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+            with open(f"{prefix}.folded", 'w', encoding='utf-8') as f:
+                f.write(self.folded())
+            written = [f"{prefix}.json", f"{prefix}.folded"]
+            if self._stats is not None:
+                self._stats.dump_stats(f"{prefix}.pstats")
+                written.append(f"{prefix}.pstats")
+            print(f"[INFO] Profile written to {', '.join(written)}")
+        return result
+
+
+PROFILER = Profiler()
+phase = PROFILER.phase
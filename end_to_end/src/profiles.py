@@ -0,0 +1,178 @@
+import math
+import random
+import itertools
+
+
+class Profile:
+    """Open-loop arrival schedule: offsets(), in seconds from the start, of successive events.
+
+    Offsets never depend on how fast the gate answers; a sender that falls behind
+    sends late and the latency it records counts from the scheduled offset, so
+    queueing in the runner is not hidden (coordinated omission).
+    """
+
+    def offsets(self):
+        """Iterator of offsets; when it runs out the remaining events go unpaced."""
+        raise NotImplementedError
+
+    def split(self, parts):
+        """The share of this profile one of `parts` equal worker processes plays."""
+        raise NotImplementedError
+
+    def spec(self):
+        """The CLI spec parse_profile() turns back into this profile."""
+        raise NotImplementedError
+
+
+class ConstantProfile(Profile):
+    """`rate` events per second, evenly spaced."""
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def offsets(self):
+        return (i / self.rate for i in itertools.count())
+
+    def split(self, parts):
+        return ConstantProfile(self.rate / parts)
+
+    def spec(self):
+        return f"constant:{self.rate}"
+
+
+class PoissonProfile(Profile):
+    """Poisson arrivals with a mean of `rate` events per second."""
+
+    def __init__(self, rate, seed=None):
+        self.rate = rate
+        self.seed = seed
+
+    def offsets(self):
+        rnd = random.Random(self.seed)
+        return itertools.accumulate(rnd.expovariate(self.rate) for _ in itertools.count())
+
+    def split(self, parts):
+        # a Poisson process split at random is again Poisson; seeds stay distinct per part
+        return [PoissonProfile(self.rate / parts, None if self.seed is None else self.seed + i) for i in range(parts)]
+
+    def spec(self):
+        return f"poisson:{self.rate}" + ('' if self.seed is None else f":{self.seed}")
+
+
+class RampProfile(Profile):
+    """Rate moving linearly from `start` to `end` events per second over `duration` seconds, then held."""
+
+    def __init__(self, start, end, duration):
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    def _offset(self, i):
+        # events up to t: start*t + slope*t^2/2, solved for the i-th event
+        slope = (self.end - self.start) / self.duration if self.duration else 0
+        ramp_events = self.start * self.duration + slope * self.duration ** 2 / 2
+        if i <= ramp_events and slope:
+            return (-self.start + math.sqrt(self.start ** 2 + 2 * slope * i)) / slope
+        if i <= ramp_events:
+            return i / self.start
+        return self.duration + (i - ramp_events) / self.end
+
+    def offsets(self):
+        return (self._offset(i) for i in itertools.count())
+
+    def split(self, parts):
+        return RampProfile(self.start / parts, self.end / parts, self.duration)
+
+    def spec(self):
+        return f"ramp:{self.start}:{self.end}:{self.duration}"
+
+
+class BurstProfile(Profile):
+    """`size` events at once every `period` seconds, like devices reconnecting after a gate restart."""
+
+    def __init__(self, size, period):
+        self.size = size
+        self.period = period
+
+    def offsets(self):
+        return ((i // self.size) * self.period for i in itertools.count())
+
+    def split(self, parts):
+        # the remainder goes one event each to the first parts; a part always bursts at least once
+        size, extra = divmod(self.size, parts)
+        return [BurstProfile(max(1, size + (1 if i < extra else 0)), self.period) for i in range(parts)]
+
+    def spec(self):
+        return f"burst:{self.size}:{self.period}"
+
+
+class SpreadProfile(Profile):
+    """`count` events spread evenly over `duration` seconds: a linear ramp up to `count` devices.
+
+    Later events are not scheduled at all, the pacer lets them through unpaced.
+    """
+
+    def __init__(self, duration, count=1):
+        self.duration = duration
+        self.count = count
+
+    def offsets(self):
+        step = self.duration / max(self.count, 1)
+        return (i * step for i in range(self.count))
+
+    def split(self, parts):
+        return SpreadProfile(self.duration, max(1, math.ceil(self.count / parts)))
+
+    def spec(self):
+        # the count comes from the devices of whoever parses it
+        return f"spread:{self.duration}"
+
+
+PROFILES = {
+    'constant': (ConstantProfile, 'constant:<rate>'),
+    'poisson': (PoissonProfile, 'poisson:<rate>[:<seed>]'),
+    'ramp': (RampProfile, 'ramp:<start rate>:<end rate>:<seconds>'),
+    'burst': (BurstProfile, 'burst:<size>:<period seconds>'),
+    'spread': (SpreadProfile, 'spread:<seconds>'),
+}
+
+
+def parse_profile(spec, count=None):
+    """Build a Profile from a CLI spec such as `poisson:500` or `ramp:0:1000:60`.
+
+    count is the number of events the profile has to place, used by spread.
+    """
+    name, *args = spec.split(':')
+    if name not in PROFILES:
+        raise ValueError(f"Unknown profile '{name}', use one of: {', '.join(usage for _, usage in PROFILES.values())}")
+    cls, usage = PROFILES[name]
+    try:
+        if name == 'burst':
+            profile = cls(int(args[0]), float(args[1]))
+        elif name == 'poisson':
+            profile = cls(float(args[0]), int(args[1]) if len(args) > 1 else None)
+        elif name == 'spread':
+            profile = cls(float(args[0]), count or 1)
+        else:
+            profile = cls(*(float(x) for x in args))
+    except (IndexError, TypeError, ValueError):
+        raise ValueError(f"Invalid profile '{spec}', expected {usage}")
+
+    # rates divide the schedule, a rate of 0 would stall the worker instead of slowing it down
+    if isinstance(profile, (ConstantProfile, PoissonProfile)) and profile.rate <= 0:
+        raise ValueError(f"Invalid profile '{spec}', the rate must be > 0")
+    if isinstance(profile, RampProfile) and (profile.start < 0 or profile.end <= 0 or profile.duration <= 0):
+        raise ValueError(f"Invalid profile '{spec}', a ramp needs start >= 0, end > 0 and seconds > 0")
+    if isinstance(profile, BurstProfile) and (profile.size <= 0 or profile.period <= 0):
+        raise ValueError(f"Invalid profile '{spec}', size and period must be > 0")
+    if isinstance(profile, SpreadProfile) and profile.duration < 0:
+        raise ValueError(f"Invalid profile '{spec}', seconds must be >= 0")
+    return profile
+
+
+def split_profile(profile, parts):
+    """One profile per worker process."""
+    if profile is None:
+        return [None] * parts
+    shares = profile.split(parts)
+    return shares if isinstance(shares, list) else [shares] * parts
@@ -0,0 +1,199 @@
+import json
+import math
+import threading
+import xml.etree.ElementTree as ET
+from profiler import PROFILER
+
+METRICS = ('connect', 'first_ack', 'ack_complete', 'db_visible', 'nsq_visible')
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets (about 1% relative error).
+
+    Buckets are fixed, so histograms recorded in other processes or on other hosts
+    can be merged exactly.
+    """
+
+    MIN = 1e-6
+    GROWTH = 1.02
+    _LOG_GROWTH = math.log(GROWTH)
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        if value <= self.MIN:
+            return 0
+        return int(math.log(value / self.MIN) / self._LOG_GROWTH) + 1
+
+    def _bucket_value(self, bucket):
+        if bucket == 0:
+            return self.MIN
+        return self.MIN * self.GROWTH ** (bucket - 0.5)
+
+    def record(self, value):
+        bucket = self._bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100 * self.count))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(max(self._bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min': round(self.min, 6),
+            'mean': round(self.total / self.count, 6),
+            'p50': round(self.percentile(50), 6),
+            'p95': round(self.percentile(95), 6),
+            'p99': round(self.percentile(99), 6),
+            'max': round(self.max, 6),
+        }
+
+    def to_dict(self):
+        return {
+            'counts': {str(k): v for k, v in self.counts.items()},
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls()
+        hist.counts = {int(k): v for k, v in data['counts'].items()}
+        hist.count = data['count']
+        hist.total = data['total']
+        hist.min = data['min']
+        hist.max = data['max']
+        return hist
+
+
+class Report:
+    """Step results and latency histograms of a run, grouped per case and per device type."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.steps = []
+        self.histograms = {}
+        # PoolMetrics snapshots of the run's DB pools, by pool name
+        self.db_pools = {}
+
+    def _histogram(self, group, name, metric):
+        key = (group, name, metric)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        return self.histograms[key]
+
+    def record(self, case_name, device_type, metric, value):
+        with self._lock:
+            self._histogram('cases', case_name, metric).record(value)
+            self._histogram('device_types', device_type, metric).record(value)
+
+    def record_step(self, result: dict, case_name, device_type, duration, timings=None):
+        entry = dict(result)
+        entry.update(case=case_name, device_type=device_type, duration=round(duration, 6))
+        latencies = {k: v for k, v in (timings or {}).items() if k in METRICS}
+        entry['latency'] = {k: round(v, 6) for k, v in latencies.items()}
+
+        with PROFILER.acquire(self._lock):
+            self.steps.append(entry)
+            for metric, value in latencies.items():
+                self._histogram('cases', case_name, metric).record(value)
+                self._histogram('device_types', device_type, metric).record(value)
+
+    def merge(self, other: 'Report'):
+        with self._lock:
+            self.steps.extend(other.steps)
+            for (group, name, metric), hist in other.histograms.items():
+                self._histogram(group, name, metric).merge(hist)
+
+    def summary(self):
+        with self._lock:
+            out = {'cases': {}, 'device_types': {}}
+            for (group, name, metric), hist in sorted(self.histograms.items(), key=lambda x: tuple(map(str, x[0]))):
+                out[group].setdefault(str(name), {})[metric] = hist.summary()
+            failed = [s['step'] for s in self.steps if s.get('status') == 'FAIL']
+            out['totals'] = {'steps': len(self.steps), 'failed': len(failed)}
+            if self.db_pools:
+                out['db_pools'] = dict(self.db_pools)
+            return out
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'steps': list(self.steps),
+                'histograms': [
+                    {'group': group, 'name': name, 'metric': metric, 'histogram': hist.to_dict()}
+                    for (group, name, metric), hist in self.histograms.items()
+                ],
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        report = cls()
+        report.steps = list(data.get('steps', []))
+        for h in data.get('histograms', []):
+            report.histograms[(h['group'], h['name'], h['metric'])] = Histogram.from_dict(h['histogram'])
+        return report
+
+    def write_json(self, path):
+        data = {'summary': self.summary()}
+        data.update(self.to_dict())
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, default=str)
+
+    def write_junit(self, path):
+        with self._lock:
+            steps = list(self.steps)
+
+        suites = {}
+        for step in steps:
+            suites.setdefault(step['case'], []).append(step)
+
+        root = ET.Element('testsuites', tests=str(len(steps)),
+                          failures=str(sum(1 for s in steps if s.get('status') == 'FAIL')))
+        for case_name, case_steps in suites.items():
+            suite = ET.SubElement(
+                root, 'testsuite', name=str(case_name), tests=str(len(case_steps)),
+                failures=str(sum(1 for s in case_steps if s.get('status') == 'FAIL')),
+                time=f"{sum(s['duration'] for s in case_steps):.6f}",
+            )
+            for step in case_steps:
+                testcase = ET.SubElement(
+                    suite, 'testcase', classname=str(step['device_type']),
+                    name=step['step'].split(', ', 1)[-1], time=f"{step['duration']:.6f}",
+                )
+                if step.get('status') == 'FAIL':
+                    message = step.get('error') or step.get('notes', '').lstrip(', ') or 'step failed'
+                    failure = ET.SubElement(testcase, 'failure', message=message)
+                    failure.text = json.dumps({k: step.get(k) for k in ('ack', 'db', 'nsq', 'conn')})
+
+        ET.ElementTree(root).write(path, encoding='utf-8', xml_declaration=True)
@@ -1,400 +1,968 @@
 import os
-import sys
+import argparse
 import json
 import socket
 import time
 import select
 import threading
+import contextvars
 import nsq
 import tornado.ioloop
-from service.db import DB
-from decouple import config
-from helper import hex_to_bytes, bytes_to_str, split_hex, load_payload
-from datetime import datetime, timezone
+from service.db import DB, DBNotifier, TableSnapshot, ISOLATION_TABLES, clone_database, drop_database
+from service.nsq_index import NsqIndex
+from service.fixtures import is_fixture, run_fixture
+from decouple import config, Csv
+from helper import bytes_to_str, encode_send, load_payload
+from framing import frame_reader, expected_frames, mark_ack_timings
+from report import Report
+from packets import PacketStream, share_serials
+from metrics import Metrics
+from profiler import PROFILER, phase
+from impair import LinkPool, parse_impairment
+from schedule import CasePlan, CaseSchedule, SCHEDULE_TIMEOUT
+from templates import vars as default_vars, device_vars, device_identifiers, VARS_TAKEN_AT
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+# allowed clock difference between the runner and the database for timestamp assertions
+DB_CLOCK_SKEW = config('DB_CLOCK_SKEW', default=5, cast=float)
+
+# values of a payload's `isolation` option
+ISOLATION_MODES = ('reset', 'snapshot', 'template')
+# databases of the run in progress when its payload uses isolation: template, per thread/task
+_run_databases = contextvars.ContextVar('run_databases', default=None)
 
 
 class RunTest:
-    def __init__(self):
-        self._db = DB()
+    def __init__(self, mock_gate=None, metrics=None):
+        # mock_gate (mock_gate.MockGate) replaces the gate, nsqd and Postgres for offline runs
+        self.mock_gate = mock_gate
+        self._shared_db = mock_gate.db if mock_gate else DB()
         self.error_test_case = []
+        self.report = Report()
+        # live counters for --metrics-port and --progress
+        self.metrics = metrics or Metrics()
 
-        self.run_nsq = False
         self.nsq_thread = None
         self.nsq_loop = None
-        self.nsq_reader = None
-        self.nsq_messages = []
-        self.nsq_lock = threading.Lock()
+        self.nsq_readers = []
+        self.nsq_topics = set()
+        self.nsq_index = NsqIndex()
         self.nsq_started = threading.Event()
-
-        self.block_event = threading.Event()
-        self.block_event.set()
-
-    def _start_nsq(self, topic='PACKET'):
-        if self.nsq_thread and self.nsq_thread.is_alive():
-            return
-
-        def _nsq_thread_fn(topic_name):
-            loop = tornado.ioloop.IOLoop()
-            tornado.ioloop.IOLoop.clear_instance()
-            loop.make_current()
-            self.nsq_loop = loop
-
-            channel_name = f"test_runner_{int(time.time())}_{threading.get_ident()}"
-            self.nsq_reader = nsq.Reader(
-                message_handler=self._nsq_msg_handler,
-                nsqd_tcp_addresses=['127.0.0.1:4150'],
-                topic=topic_name,
-                channel=channel_name,
-                lookupd_poll_interval=1
-            )
-
-            self.nsq_started.set()
-
+        self._nsq_lock = threading.Lock()
+        self.nsqd_addresses = config('NSQD_TCP_ADDRESSES', default='127.0.0.1:4150', cast=Csv())
+        self.nsq_default_topics = config('NSQ_TOPICS', default='PACKET', cast=Csv())
+        self.nsq_max_in_flight = config('NSQ_MAX_IN_FLIGHT', default=200, cast=int)
+        self.metrics.collect(lambda: [(f"nsq_{k}", None, v) for k, v in self.nsq_index.stats().items()])
+
+        # ACK reading stops as soon as the expected frames are in; these bound the wait
+        self.ack_max_wait = config('ACK_MAX_WAIT', default=5, cast=float)
+        self.ack_grace = config('ACK_GRACE', default=0.3, cast=float)
+
+        # captured steps (see capture.py) send at their `at` offset divided by this; 0 plays them back to back
+        self.replay_speed = 1.0
+
+        # link impairment (impair.py) for payloads and connections without their own `impair`
+        self.impair = None
+        self.links = LinkPool()
+        self.metrics.collect(lambda: [(f"impair_{k}", None, v) for k, v in self.links.stats().items()])
+        self.metrics.collect(lambda: [g for name, pool in self._pools().items() for g in pool.metrics.gauges(name)])
+
+        # seconds the gate gets to pick up pre_test changes before the step sends; a step can set `settle`
+        self.pre_test_settle = 0 if mock_gate else config('PRE_TEST_SETTLE', default=2, cast=float)
+
+        # db_check retries until its assertions hold; these bound the backoff
+        self.db_check_timeout = config('DB_CHECK_TIMEOUT', default=10, cast=float)
+        self.db_backoff_initial = config('DB_BACKOFF_INITIAL', default=0.05, cast=float)
+        self.db_backoff_max = config('DB_BACKOFF_MAX', default=1, cast=float)
+        self._db_notifier = None
+        if config('DB_NOTIFY', default=False, cast=bool) and not mock_gate:
             try:
-                loop.start()
-            finally:
-                try:
-                    self.nsq_reader.close()
-                except Exception:
-                    pass
-
-        t = threading.Thread(target=_nsq_thread_fn, args=(topic,), daemon=True)
-        t.start()
-        self.nsq_thread = t
-
-        if not self.nsq_started.wait(timeout=5):
-            raise RuntimeError("Failed to start NSQ reader within timeout")
+                self._db_notifier = DBNotifier(channels=('devices', 'command_queue'))
+            except Exception as e:
+                print(f"[ERROR] Starting DB LISTEN failed, falling back to polling: {e}")
+
+    def _pools(self):
+        """The runner's real DB pools by name; the mock's stand-ins have no metrics."""
+        return {'sync': self._shared_db} if hasattr(self._shared_db, 'metrics') else {}
+
+    def pool_stats(self):
+        return {name: pool.metrics.snapshot() for name, pool in self._pools().items()}
+
+    def close(self):
+        """Release what the runner holds in the database under test and keep the pools' stats."""
+        self.report.db_pools = self.pool_stats()
+        if self._db_notifier:
+            self._db_notifier.close()
+        self._shared_db.close()
+
+    def _start_nsq(self, topics=None):
+        """Subscribe to `topics` (default NSQ_TOPICS); all readers share one IOLoop thread."""
+        with self._nsq_lock:
+            new_topics = [t for t in (topics or self.nsq_default_topics) if t not in self.nsq_topics]
+            if not new_topics:
+                return
+
+            if self.mock_gate:
+                for topic in new_topics:
+                    self.mock_gate.nsq.subscribe(topic, self._nsq_msg_handler)
+                self.nsq_topics.update(new_topics)
+                self.nsq_started.set()
+                return
+
+            if not (self.nsq_thread and self.nsq_thread.is_alive()):
+                self.nsq_started.clear()
+
+                def _nsq_thread_fn():
+                    loop = tornado.ioloop.IOLoop()
+                    tornado.ioloop.IOLoop.clear_instance()
+                    loop.make_current()
+                    self.nsq_loop = loop
+                    self.nsq_started.set()
+
+                    try:
+                        loop.start()
+                    finally:
+                        for reader in self.nsq_readers:
+                            try:
+                                reader.close()
+                            except Exception:
+                                pass
+
+                t = threading.Thread(target=_nsq_thread_fn, daemon=True)
+                t.start()
+                self.nsq_thread = t
+
+                if not self.nsq_started.wait(timeout=5):
+                    raise RuntimeError("Failed to start NSQ reader within timeout")
+
+            for topic in new_topics:
+                # readers bind to the current IOLoop, so they are created on its thread
+                self.nsq_loop.add_callback(self._add_nsq_reader, topic)
+            self.nsq_topics.update(new_topics)
+
+    def _add_nsq_reader(self, topic):
+        channel_name = f"test_runner_{int(time.time())}_{threading.get_ident()}"
+        self.nsq_readers.append(nsq.Reader(
+            message_handler=self._nsq_msg_handler,
+            nsqd_tcp_addresses=self.nsqd_addresses,
+            topic=topic,
+            channel=channel_name,
+            lookupd_poll_interval=1,
+            max_in_flight=self.nsq_max_in_flight,
+        ))
 
     def _nsq_msg_handler(self, message):
-        with self.nsq_lock:
-            self.nsq_messages.append(message.body)
-            # print(message.body)
+        with phase('nsq_ingest'):
+            self.nsq_index.add(message.body)
         return True
 
-    def _nsq_checker(self, expected: dict, timeout):
-        start = time.time()
-
-        while time.time() - start < timeout:
-            for idx, msg_raw in enumerate(self.nsq_messages):
-                try:
-                    msg = json.loads(msg_raw.decode() if isinstance(msg_raw, bytes) else msg_raw)
-                except json.JSONDecodeError:
-                    print('[ERROR] Failed decode message nsq')
-                    continue
-
-                msg_obj = list(msg.keys())
-                exp_obj = list(expected.keys())
-
-                if set(msg_obj) != set(exp_obj):
-                    continue
+    def _pending_nsq(self, identifiers=None):
+        """Messages still waiting to be matched, limited to `identifiers` when a run is isolated."""
+        return self.nsq_index.pending(identifiers)
 
-                matched = True
-
-                for k in exp_obj:
-                    if isinstance(expected[k], dict):
-                        try:
-                            message = msg[k] if isinstance(msg[k], dict) else json.loads(msg[k])
-                        except:
-                            matched = False
-                            break
-
-                        # recursive check for nested dicts like "message"
-                        for sub_k, sub_v in expected[k].items():
-                            if sub_v != '' and str(message.get(sub_k)) != str(sub_v):
-                                matched = False
-                                break
-                    else:
-                        if expected[k] != '' and str(msg.get(k)) != str(expected[k]):
-                            matched = False
-                            break
-                        else:
-                            continue
-
-                if matched:
-                    del self.nsq_messages[idx]
-                    if 'data' in msg and len(self.nsq_messages) > 0:
-                        for x, msg_ in enumerate(self.nsq_messages):
-                            msg_ = json.loads(msg_.decode() if isinstance(msg_, bytes) else msg_)
-                            if 'data' in msg_ and msg_['data'] == msg['data']:
-                                print('Duplicate data', msg['data'])
-                                del self.nsq_messages[x]
-                    return True
-
-            time.sleep(0.1)
-
-        return False
-
-    def run(self, files=None):
+    def _payload_files(self, files=None):
         folder = 'src/payloads'
 
         if not os.path.isdir(folder):
             print(f"[ERROR] Folder does not exist: {folder}")
-            return
+            return []
 
         if isinstance(files, str):
             files = [files]
         elif files is not None:
             files = list(files)
 
-        for file_name in os.listdir(folder):
-            if files and file_name not in files:
-                continue
+        return [
+            os.path.join(folder, file_name)
+            for file_name in sorted(os.listdir(folder))
+            if os.path.isfile(os.path.join(folder, file_name)) and (not files or file_name in files)
+        ]
 
-            file_path = os.path.join(folder, file_name)
-            print(f"\n[INFO] Running test case: {file_name}")
+    def _plan_runs(self, file_paths, jobs=1):
+        """Split payload files into independent runs, each with its own IMEI slot.
+
+        A file is one run, since its cases usually build on the device state left by the
+        previous case. Files marked `parallel: true` declare independent cases, and every
+        case becomes its own run. Serial execution keeps the configured IMEIs.
+        """
+        if jobs <= 1:
+            return [(file_path, None, None) for file_path in file_paths]
+
+        runs = []
+        for file_path in file_paths:
             try:
-                self.run_test_tcp(file_path)
-            except FileNotFoundError:
-                print(f"[ERROR] File not found: {file_path}")
-            except json.JSONDecodeError as e:
-                print(f"[ERROR] Invalid JSON in {file_name}: {e}")
-
-    def run_test_tcp(self, filename: str):
-        test_case = load_payload(filename)
-        msg_type = test_case.get('message_type', 'hex')
-        device_type = test_case.get('device_type')
+                test_case = load_payload(file_path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                runs.append((file_path, None, None))
+                continue
+
+            if test_case.get('parallel'):
+                for case_idx in range(len(test_case.get('test_case', []))):
+                    runs.append((file_path, [case_idx], None))
+            else:
+                runs.append((file_path, None, None))
+
+        return [(file_path, cases, device_vars(slot)) for slot, (file_path, cases, _) in enumerate(runs)]
+
+    def _run_planned(self, planned):
+        file_path, case_indexes, variables = planned
+        file_name = os.path.basename(file_path)
+        print(f"\n[INFO] Running test case: {file_name}")
+        try:
+            with PROFILER.worker(), phase('run'):
+                self.run_test_tcp(file_path, variables=variables, case_indexes=case_indexes)
+        except FileNotFoundError:
+            print(f"[ERROR] File not found: {file_path}")
+        except json.JSONDecodeError as e:
+            print(f"[ERROR] Invalid JSON in {file_name}: {e}")
+        except ValueError as e:
+            print(f"[ERROR] {file_name}: {e}")
+
+    def run(self, files=None, jobs=1):
+        planned = self._plan_runs(self._payload_files(files), jobs)
+        if jobs <= 1:
+            for p in planned:
+                self._run_planned(p)
+            return
 
-        self.run_nsq = False
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(self._run_planned, planned))
+        print('\nFAILED: ', self.error_test_case)
+
+    def _prepare_test_case(self, filename: str, variables=None):
+        """The bound payload and whether its NSQ checks run; both belong to this run only."""
+        with phase('load_payload'):
+            test_case = load_payload(filename, variables)
+        # one serial counter per device of the run, whichever steps its packets come from
+        serials = {}
+        for case in test_case.get('test_case', []):
+            for conn in case.get('connections') or []:
+                share_serials(conn.get('steps', []), serials)
+        if self.mock_gate:
+            self.mock_gate.learn(test_case, key=(filename, tuple(device_identifiers(variables)) if variables else None))
+
+        run_nsq = False
         # Start NSQ consumer if needed
         if test_case.get('nsq_check'):
             try:
-                self._start_nsq(topic='PACKET')
-                self.run_nsq = True
+                self._start_nsq(test_case.get('nsq_topics'))
+                run_nsq = True
             except Exception as e:
                 print(f"[ERROR] Starting NSQ reader failed: {e}")
 
-        host = config('TCP_HOST', default='localhost')
-        port = int(config('TCP_PORT', default=1200))
-        for case in test_case.get('test_case', []):
+        return test_case, run_nsq
+
+    @property
+    def _db(self):
+        run = _run_databases.get()
+        return run['db'] if run else self._shared_db
+
+    # ISOLATION
+    @staticmethod
+    def _isolation(test_case: dict, variables=None):
+        """(mode, TableSnapshot, template) of the payload's `isolation` option, or None.
+
+        isolation: reset        delete the run's rows of the isolated tables before every case
+        isolation: snapshot     capture those rows when the run starts, restore them before every case
+        isolation:              clone a template database for the run, restore before every case
+          mode: template
+          template: gate_e2e_template     (else DB_TEMPLATE)
+          tables: [devices, command_queue]
+
+        Template mode points pre_test and db_check at the run's clone, <DB_NAME>_e2e_<imei>, which
+        only the mock or a self-hosted gate configured to use that database writes to; against a
+        shared gate every db_check of the run would read a database the gate never touches.
+        """
+        option = test_case.get('isolation')
+        if not option:
+            return None
+        if isinstance(option, str):
+            option = {'mode': option}
+        mode = option.get('mode', 'reset')
+        if mode not in ISOLATION_MODES:
+            raise ValueError(f"Unknown isolation mode: {mode} (use {', '.join(ISOLATION_MODES)})")
+        template = None
+        if mode == 'template':
+            template = option.get('template') or config('DB_TEMPLATE', default='')
+            if not template:
+                raise ValueError("isolation mode template needs a `template` database or DB_TEMPLATE")
+        snapshot = TableSnapshot(device_identifiers(variables or default_vars), option.get('tables', ISOLATION_TABLES))
+        return mode, snapshot, template
+
+    def _clone_run_database(self, snapshot, template):
+        """Copy of the template database for one run, named after its first IMEI so runs never share it."""
+        name = f"{config('DB_NAME', default='localhost')}_e2e_{snapshot.imeis[0]}"
+        start = time.perf_counter()
+        clone_database(name, template)
+        print(f"[INFO] Cloned database {template} -> {name} in {time.perf_counter() - start:.3f}s")
+        print(f"[WARN] db_check reads {name}; the gate must write to it as well (see RunTest._isolation)")
+        return name
+
+    def _begin_isolation(self, isolation):
+        """Prepare the run's database; returns the reset token to pass to _end_isolation."""
+        mode, snapshot, template = isolation
+        token = None
+        # the mock's FakeDB is already private to the process, template mode only resets
+        if mode == 'template' and not self.mock_gate:
+            name = self._clone_run_database(snapshot, template)
+            token = _run_databases.set({'name': name, 'db': DB(maxconn=4, database=name)})
+        if mode != 'reset':
+            snapshot.capture(self._db)
+        return token
+
+    def _end_isolation(self, token):
+        run = _run_databases.get()
+        _run_databases.reset(token)
+        run['db'].close()
+        drop_database(run['name'])
+
+    def _reset_case(self, isolation):
+        _, snapshot, _ = isolation
+        start = time.perf_counter()
+        with phase('isolation'):
+            snapshot.restore(self._db)
+        self.metrics.observe('isolation_reset', time.perf_counter() - start)
+
+    def _gate_address(self):
+        if self.mock_gate:
+            return self.mock_gate.address
+        return config('TCP_HOST', default='localhost'), int(config('TCP_PORT', default=1200))
+
+    def _connection_address(self, steps, host, port):
+        host, port, delay = self._connection_target(steps, host, port)
+        if self.mock_gate:
+            # every gate, including pod_ip/port overrides, is the mock
+            host, port = self.mock_gate.address
+        return host, port, delay
+
+    def _link_address(self, steps, host, port, impair=None, msg_type='hex'):
+        """host:port, or the impairment proxy in front of it when the connection's link is degraded."""
+        impairment = self._connection_impairment(steps, impair, msg_type)
+        if impairment is None:
+            return host, port
+        return self.links.address(host, port, impairment)
+
+    @staticmethod
+    def _connection_impairment(steps, impair=None, msg_type='hex'):
+        """The Impairment of a connection: its settings steps' `impair`, else the payload's or --impair."""
+        for x in steps:
+            impair = x['impair'] if 'impair' in x else impair
+        impairment = parse_impairment(impair)
+        return impairment.for_message_type(msg_type) if impairment else None
+
+    @staticmethod
+    def _connection_target(steps, host, port):
+        """Resolve host, port and start delay from the settings-only steps of a connection."""
+        delay = 0
+        for x in steps:
+            host = x['pod_ip'] if 'pod_ip' in x else host
+            port = int(x['port']) if 'port' in x else port
+            delay = x['delay'] if 'delay' in x else delay
+        return host, port, delay
+
+    def run_test_tcp(self, filename: str, variables=None, case_indexes=None):
+        test_case, run_nsq = self._prepare_test_case(filename, variables)
+        msg_type = test_case.get('message_type', 'hex')
+        device_type = test_case.get('device_type')
+        identifiers = device_identifiers(variables) if variables else None
+        isolation = self._isolation(test_case, variables)
+        with phase('isolation'):
+            token = self._begin_isolation(isolation) if isolation else None
+        try:
+            self._run_cases(test_case, case_indexes, msg_type, device_type, identifiers, isolation, run_nsq)
+        finally:
+            if token:
+                self._end_isolation(token)
+        print('\nFAILED: ', self.error_test_case)
+
+    def _run_cases(self, test_case, case_indexes, msg_type, device_type, identifiers, isolation, run_nsq=False):
+        host, port = self._gate_address()
+        impair = test_case.get('impair', self.impair)
+        for case_idx, case in enumerate(test_case.get('test_case', [])):
+            if case_indexes is not None and case_idx not in case_indexes:
+                continue
+
             connections = case.get('connections')
             if not connections:
                 print(f"[WARN] No 'connection' section in case: {case.get('name')}")
                 continue
+            if isolation:
+                self._reset_case(isolation)
 
             # print(f"\n[INFO] Running case '{case['name']}' with {len(connections)} connections")
+            schedule = self._case_schedule(case, threading.Event)
+            if schedule is None:
+                continue
 
             threads = []
             self.result_lock = threading.Lock()
 
             for idx, conn in enumerate(connections, start=1):
-                delay = 0
-
-                for x in conn['steps']:
-                    host = x['pod_ip'] if 'pod_ip' in x else host
-                    port = int(x['port']) if 'port' in x else port
-                    delay = x['delay'] if 'delay' in x else delay
-                    if 'name' not in x:
-                        continue
-
-                time.sleep(delay)
+                host, port, delay = self._connection_address(conn['steps'], host, port)
+                link_host, link_port = self._link_address(conn['steps'], host, port, impair, msg_type)
+
+                if not schedule.delays_start(idx):
+                    with phase('delay'):
+                        time.sleep(delay)
+                    delay = 0
+                # the connection sees the run's database, see _run_databases
                 t = threading.Thread(
-                    target=self._run_connection_steps,
-                    args=(idx, host, port, conn['steps'], msg_type, device_type, case['name'])
+                    target=contextvars.copy_context().run,
+                    args=(self._run_connection_steps, idx, link_host, link_port, conn['steps'], msg_type, device_type,
+                          case['name'], schedule, identifiers, delay, run_nsq)
                 )
                 t.start()
                 threads.append(t)
 
             # Wait for all to finish
-            for t in threads:
-                t.join()
+            with phase('join'):
+                for t in threads:
+                    t.join()
 
             # print(f"[INFO] Completed test case '{case['name']}'")
-        print('\nFAILED: ', self.error_test_case)
 
-    def _run_connection_steps(self, conn_id: int, host, port, steps, msg_type: str, device_type: str, case_name: str):
-        self.block_event.wait()
-        result = {}
+    def _case_schedule(self, case: dict, event_factory):
+        try:
+            return CaseSchedule(CasePlan(case['connections']), event_factory)
+        except ValueError as e:
+            print(f"[ERROR] Invalid schedule in case '{case.get('name')}': {e}")
+            self.error_test_case.append(case.get('name'))
+            return None
+
+    def _wait_schedule(self, events, what):
+        with phase('schedule_wait'):
+            for event in events:
+                if not event.wait(SCHEDULE_TIMEOUT):
+                    raise TimeoutError(f"{what} waited {SCHEDULE_TIMEOUT}s for a preceding step")
+
+    @staticmethod
+    def _encode_send(step: dict, msg_type: str) -> bytes:
+        if 'send_bytes' in step:
+            return step['send_bytes']
+        if isinstance(step['send'], PacketStream):
+            return step['send'].next()
+        return encode_send(step['send'], msg_type)
+
+    @staticmethod
+    def _pre_test_batches(step: dict):
+        """Group pre_test entries, in order, into statement batches and bulk fixtures."""
+        batch = []
+        for statement in step.get('pre_test') or []:
+            if is_fixture(statement):
+                if batch:
+                    yield 'statements', batch
+                    batch = []
+                yield 'fixture', statement
+            else:
+                batch.append(statement)
+        if batch:
+            yield 'statements', batch
+
+    def _run_pre_test(self, step: dict):
+        with phase('pre_test'):
+            for kind, item in self._pre_test_batches(step):
+                if kind == 'fixture':
+                    run_fixture(self._db, item)
+                else:
+                    self._db.save_many(item)
+
+    def _ack_wait(self, step: dict):
+        """Frames that complete the step's ACK and how long to wait for them.
+
+        Steps without expect_ack only drain what arrives within the grace period.
+        """
+        expected = expected_frames(step.get('expect_ack'))
+        return expected, step.get('max_wait', self.ack_max_wait if expected else self.ack_grace)
+
+    def _read_ack(self, sock: socket.socket, reader, step: dict, timings=None):
+        """Read ACK frames for a step; returns the frames and whether the server closed the connection."""
+        expected, max_wait = self._ack_wait(step)
+        deadline = time.time() + max_wait
+        frames = []
+        sock.setblocking(False)
+
+        while not expected or len(frames) < expected:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            with phase('select'):
+                ready, _, _ = select.select([sock], [], [], remaining)
+            if not ready:
+                break
+            data = sock.recv(4096)
+            if data == b'':
+                frames.extend(reader.flush())
+                reader.read_done()
+                return frames, True
+            with phase('frame_parse'):
+                frames.extend(reader.feed(data))
+                mark_ack_timings(timings, frames, expected)
+
+        if len(frames) < expected:
+            # report the incomplete frame instead of leaking it into the next step
+            frames.extend(reader.flush())
+        reader.read_done()
+        return frames, False
+
+    @staticmethod
+    def _check_ack(step: dict, frames, msg_type: str, step_result: dict):
+        expected_ack = step.get('expect_ack', [])
+        if isinstance(expected_ack, list):
+            # an empty string stands for no frame, like in expected_frames()
+            expected_ack = [ack for ack in expected_ack if ack]
+
+        # pre-decoded payloads compare raw frames and only hex-encode for the notes
+        if (expected_bytes := step.get('expect_ack_bytes')) is not None:
+            if expected_ack and frames != expected_bytes:
+                step_result['ack'] = False
+                step_result['notes'] += f', ack expected {expected_ack}, got {[bytes_to_str(f) for f in frames]}'
+            else:
+                step_result["ack"] = True
+            return
+
+        # decode ACKs
+        if msg_type == 'hex':
+            ack = [bytes_to_str(frame) for frame in frames]
+        else:
+            ack = frames[0].decode() if frames else ""
+
+        # Verify ACK
+        if expected_ack and ack != expected_ack:
+            step_result['ack'] = False
+            step_result['notes'] += f', ack expected {expected_ack}, got {ack}'
+            # raise AssertionError(f"ACK mismatch — expected {expected_ack}, got {ack}")
+        else:
+            step_result["ack"] = True
+
+    def _db_mismatches(self, db: dict):
+        """Run a db_check query once and return the failed assertions as notes."""
+        with phase('db_query'):
+            row = self._db.fetch_one_dict(db['query'], db.get('params', []))
+        return self._db_row_mismatches(db, row)
+
+    @staticmethod
+    def _db_row_mismatches(db: dict, result):
+        assertions = db.get('assertions', {})
+
+        if not result:
+            return [', db row not found'] if assertions else []
+
+        for k, expected_value in assertions.items():
+            actual_value = result.get(k)
+
+            # ignore if expected is empty string
+            if expected_value == '':
+                continue
+
+            if isinstance(actual_value, datetime):
+                # expected times (date_now, date, ...) were taken when the run started, so the gate
+                # wrote them at most the run's elapsed time later
+                expected_dt = datetime.fromisoformat(str(expected_value)).replace(tzinfo=timezone.utc)
+                if actual_value.tzinfo is None:
+                    actual_value = actual_value.replace(tzinfo=timezone.utc)
+                skew = timedelta(seconds=DB_CLOCK_SKEW)
+                elapsed = datetime.now(timezone.utc) - VARS_TAKEN_AT
+                if not expected_dt - skew <= actual_value <= expected_dt + elapsed + skew:
+                    return [f', db mismatch [{k}] — expected {expected_value} (+{elapsed}), got {actual_value}']
+            elif str(actual_value) != str(expected_value):
+                return [f', db mismatch [{k}] — expected {expected_value}, got {actual_value}']
+
+        return []
+
+    def _wait_db(self, db: dict):
+        """Retry a db_check with exponential backoff until its assertions hold or its timeout passes.
+
+        With DB_NOTIFY enabled the backoff sleep is cut short by the next change on devices/command_queue.
+        """
+        deadline = time.time() + db.get('timeout', self.db_check_timeout)
+        backoff = self.db_backoff_initial
+
+        while True:
+            mismatches = self._db_mismatches(db)
+            remaining = deadline - time.time()
+            if not mismatches or remaining <= 0:
+                return mismatches
+
+            wait = min(backoff, remaining)
+            with phase('db_backoff'):
+                if self._db_notifier:
+                    self._db_notifier.wait(wait)
+                else:
+                    time.sleep(wait)
+            backoff = min(backoff * 2, self.db_backoff_max)
+
+    def _check_db(self, step: dict, step_result: dict):
+        if 'db_check' not in step:
+            step_result["db"] = "skipped"
+            return
+
+        db_pass = True
+        for db in step['db_check']:
+            db:dict
+            # an explicit delay is still honoured, e.g. `- delay: 3` entries
+            if db.get('delay'):
+                with phase('delay'):
+                    time.sleep(db['delay'])
+
+            if not db.get('query'):
+                continue
+
+            mismatches = self._wait_db(db)
+            if mismatches:
+                db_pass = False
+                step_result['notes'] += ''.join(mismatches)
+
+        step_result["db"] = db_pass
+        self._mark_visible(step_result, 'db_visible', db_pass)
+
+    @staticmethod
+    def _mark_visible(step_result: dict, metric: str, passed):
+        """Latency from sending the step until its DB/NSQ expectations were all observed."""
+        timings = step_result.get('timings', {})
+        if passed is True and 'sent' in timings:
+            timings[metric] = time.perf_counter() - timings['sent']
+
+    def _check_nsq(self, step: dict, step_result: dict, identifiers=None, run_nsq=False):
+        if not (run_nsq and 'nsq_check' in step):
+            step_result['nsq'] = 'skipped'
+            return
+
+        nsq_exp = step['nsq_check']
+
+        if len(nsq_exp) == 0:
+            if len(pending := self._pending_nsq(identifiers)) > 0:
+                raise AssertionError(f"Unexpected NSQ messages: {pending}")
+            step_result["nsq"] = "skipped"
+        else:
+            all_found = True
+            for expected in nsq_exp:
+                can_be_failed = expected.get("expected_failed", False)
+                expected = {k: v for k, v in expected.items() if k != "expected_failed"}
+                timeout = 10 if not can_be_failed else 3
+                if not self.nsq_index.wait_match(expected, timeout):
+                    all_found = False
+                    step_result["nsq"] = can_be_failed
+                    step_result['notes'] += f', nsq msg not found expected: {expected}'
+            self._mark_visible(step_result, 'nsq_visible', all_found)
+            if len(pending := self._pending_nsq(identifiers)) == 0:
+                step_result["nsq"] = True
+            else:
+                step_result["nsq"] = can_be_failed
+                step_result['notes'] += f', nsq msg found {pending}'
+
+    def _report_step(self, step_result: dict, case_name: str, step_name: str, identifiers=None, device_type=None):
+        with phase('report'):
+            self._report_result(step_result, case_name, step_name, identifiers, device_type)
+
+    def _report_result(self, step_result: dict, case_name: str, step_name: str, identifiers=None, device_type=None):
+        # process result
+        result = {
+            'status': 'PASS',
+            'ack': step_result.get('ack', False),
+            'db': step_result.get('db', False),
+            'nsq': step_result.get('nsq', False),
+            'conn': step_result.get('conn', False),
+            'step': f'{case_name}, {step_name}'
+        }
+
+        if step_result.get('notes'):
+            result['notes'] = step_result['notes']
+        if step_result.get('error'):
+            result['error'] = step_result['error']
+
+        if any(not v for k, v in result.items() if k not in ('step', 'status')):
+            result['status'] = 'FAIL'
+
+        print(result)
+        if result['nsq'] != 'skipped' and len(pending := self._pending_nsq(identifiers)) > 0:
+            print(f'nsq message: ', pending)
+
+        if result['status'] == 'FAIL':
+            self.error_test_case.append(result['step'])
+        self.metrics.record_step(result, step_result.get('timings'))
+
+        self.report.record_step(result, case_name, device_type or 'string',
+                                time.perf_counter() - step_result.get('started', time.perf_counter()),
+                                step_result.get('timings'))
+
+    def _record_connect(self, case_name: str, device_type: str, started: float):
+        elapsed = time.perf_counter() - started
+        self.report.record(case_name, device_type or 'string', 'connect', elapsed)
+        self.metrics.observe('connect', elapsed)
+        self.metrics.inc('connections_total')
+        self.metrics.add('active_connections', 1)
+
+    def _record_disconnect(self):
+        self.metrics.add('active_connections', -1)
+
+    def _replay_delay(self, step: dict, session_started: float) -> float:
+        """Seconds until a captured step is due, counted from the connect of its session."""
+        if 'at' not in step or not self.replay_speed:
+            return 0
+        return max(0.0, session_started + float(step['at']) / self.replay_speed - time.perf_counter())
+
+    def _run_connection_steps(self, conn_id: int, host, port, steps, msg_type: str, device_type: str, case_name: str,
+                              schedule: CaseSchedule, identifiers=None, delay=0, run_nsq=False):
+        connected = False
         try:
+            self._wait_schedule(schedule.start_waits(conn_id), f"Conn-{conn_id}")
+            with phase('delay'):
+                time.sleep(delay)
             sock = socket.socket()
-            sock.connect((host, port))
+            connect_started = time.perf_counter()
+            with phase('connect'):
+                sock.connect((host, port))
+            self._record_connect(case_name, device_type, connect_started)
+            connected = True
+            session_started = time.perf_counter()
             sock.settimeout(30)
+            reader = frame_reader(msg_type, device_type)
             # print(f"[INFO] Conn-{conn_id}: Connected")
 
-            for step in steps:
+            for pos, step in enumerate(steps):
                 step: dict
-                if step.get('block', False):
-                    # Pause all other connection threads until this step finishes.
-                    self.block_event.clear()
-                else:
-                    # Ensure the block event is released so other threads can continue.
-                    self.block_event.set()
-
                 step_name = step.get('name')
                 if not step_name:
                     continue
                 step_result = {
                     "status": "pass",
                     "notes": "",
-                    "conn": True
+                    "conn": True,
+                    "started": time.perf_counter(),
+                    "timings": {}
                 }
 
                 try:
-                    if msg_type == 'string' or step['send'][:4] == '8080':
-                        msg = step['send'].encode()
-                    elif msg_type == 'hex':
-                        msg = hex_to_bytes(step['send'])
-                    else:
-                        raise ValueError(f"Unsupported message_type: {msg_type}")
+                    # steps named in `after`/`barrier` (or a blocking connection) must be done first
+                    self._wait_schedule(schedule.step_waits(conn_id, pos, step), step_name)
+                    with phase('replay_wait'):
+                        time.sleep(self._replay_delay(step, session_started))
+                    step_result['started'] = time.perf_counter()
+                    with phase('encode_send'):
+                        msg = self._encode_send(step, msg_type)
 
                     # Run pre_test SQL if any
-                    if pre_test := step.get('pre_test'):
-                        for query in pre_test:
-                            self._db.save(query)
-                        time.sleep(2)
-
-                    sock.sendall(msg)
+                    if step.get('pre_test'):
+                        self._run_pre_test(step)
+                        with phase('settle'):
+                            time.sleep(step.get('settle', self.pre_test_settle))
+
+                    step_result['timings']['sent'] = time.perf_counter()
+                    with phase('send'):
+                        sock.sendall(msg)
+                    reader.sent(msg)
                     # print(f"[DEBUG] Conn-{conn_id} → sent {step_name}")
 
                     # ACK checker
-                    buffer = []
-                    inactivity_timeout = 1
-                    poll_interval = 0.1
-                    last_received = time.time()
-                    sock.setblocking(False)
-
-                    while True:
-                        ready, _, _ = select.select([sock], [], [], poll_interval)
-                        if ready:
-                            data = sock.recv(4096)
-                            if data == b'':
-                                if step == steps[-1]:
-                                    # delay, waiting db and nsq update
-                                    time.sleep(2)
-                                else:
-                                    step_result['conn'] = False
-                                    step_result['notes'] += ', connection closed by server'
-                                break
-                            buffer.append(data)
-                            last_received = time.time()
-                        if time.time() - last_received > inactivity_timeout:
-                            break
-
-                    # decode ACKs
-                    if msg_type == 'hex':
-                        ack = [msg for x in buffer for msg in split_hex(device_type, bytes_to_str(x))]
-                    else:
-                        ack = buffer[0].decode() if buffer else ""
-
-                    # Verify ACK
-                    expected_ack = step.get('expect_ack', [])
-                    if expected_ack and ack != expected_ack:
-                        step_result['ack'] = False
-                        step_result['notes'] += f', ack expected {expected_ack}, got {ack}'
-                        # raise AssertionError(f"ACK mismatch — expected {expected_ack}, got {ack}")
-                    else:
-                        step_result["ack"] = True
+                    frames, closed = self._read_ack(sock, reader, step, step_result['timings'])
+                    if closed and step != steps[-1]:
+                        step_result['conn'] = False
+                        step_result['notes'] += ', connection closed by server'
+
+                    with phase('check_ack'):
+                        self._check_ack(step, frames, msg_type, step_result)
 
                     if step == steps[-1] and step_result['conn']:
                         sock.close()
                         step_result['conn'] = True
-                        # delay, waiting db and nsq update
-                        time.sleep(2)
-
-                    # DB CHECK
-                    if 'db_check' not in step:
-                        step_result["db"] = "skipped"
-                    else:
-                        db_pass = True
-                        for db in step['db_check']:
-                            db:dict
-                            time.sleep(db.get('delay', 2))
-
-                            query = db.get('query')
-                            if not query:
-                                continue
-
-                            result = self._db.fetch_one_dict(query, db.get('params', []))
-                            assertions = db.get('assertions', {})
-
-                            if not result:
-                                if not assertions:
-                                    step_result["db"] = "pass"
-                                    continue
-
-                            for k, expected_value in db.get('assertions', {}).items():
-                                actual_value = result.get(k)
-
-                                # ignore if expected is empty string
-                                if expected_value == '':
-                                    continue
-
-                                if isinstance(actual_value, datetime):
-                                    expected_dt = datetime.fromisoformat(str(expected_value)).replace(tzinfo=timezone.utc)
-                                    if abs((actual_value - expected_dt).total_seconds()) > 300:
-                                        db_pass = False
-                                        step_result['notes'] += f', db mismatch [{k}] — expected {expected_value}, got {actual_value}'
-                                        break
-                                elif str(actual_value) != str(expected_value):
-                                    db_pass = False
-                                    step_result['notes'] += f', db mismatch [{k}] — expected {expected_value}, got {actual_value}'
-                                    break
-
-                        step_result["db"] = db_pass
-
-                    # NSQ CHECK
-                    if self.run_nsq and 'nsq_check' in step:
-                        nsq_exp = step['nsq_check']
-
-                        if len(nsq_exp) == 0:
-                            if len(self.nsq_messages) > 0:
-                                raise AssertionError(f"Unexpected NSQ messages: {self.nsq_messages}")
-                            step_result["nsq"] = "skipped"
-                        else:
-                            for expected in nsq_exp:
-                                can_be_failed = expected.pop("expected_failed", False)
-                                # print(expected)
-                                timeout = 10 if not can_be_failed else 3
-                                if not self._nsq_checker(expected, timeout):
-                                    step_result["nsq"] = can_be_failed
-                                    step_result['notes'] += f', nsq msg not found expected: {expected}'
-                            if len(self.nsq_messages) == 0:
-                                step_result["nsq"] = True
-                            elif len(self.nsq_messages) != 0:
-                                step_result["nsq"] = can_be_failed
-                                step_result['notes'] += f', nsq msg found {self.nsq_messages}'
-                    else:
-                        step_result['nsq'] = 'skipped'
+
+                    self._check_db(step, step_result)
+                    self._check_nsq(step, step_result, identifiers, run_nsq)
 
                 except Exception as e:
                     step_result["status"] = "FAILED!"
                     step_result["error"] = str(e)
                     # print(f"[ERROR] Conn-{conn_id} {step_name}: {e}")
 
-                # process result
-                result = {
-                    'status': 'PASS',
-                    'ack': step_result.get('ack', False),
-                    'db': step_result.get('db', False),
-                    'nsq': step_result.get('nsq', False),
-                    'conn': step_result.get('conn', False),
-                    'step': f'{case_name}, {step_name}'
-                }
-
-                if step_result.get('notes'):
-                    result['notes'] = step_result['notes']
-                if step_result.get('error'):
-                    result['error'] = step_result['error']
-
-                if any(not v for k, v in result.items() if k not in ('step', 'status')):
-                    result['status'] = 'FAIL'
-
-                print(result)
-                if result['nsq'] != 'skipped' and len(self.nsq_messages) > 0:
-                    print(f'nsq message: ', self.nsq_messages)
-
-                if result['status'] == 'FAIL':
-                    self.error_test_case.append(result['step'])
+                self._report_step(step_result, case_name, step_name, identifiers, device_type)
+                schedule.finish(conn_id, pos)
 
             # print(f"[INFO] Conn-{conn_id}: Completed all steps.")
 
         except Exception as e:
             print(f"[ERROR] Conn-{conn_id}: connection failed — {e}")
+            self.metrics.inc('failures_total', reason='connect')
+        finally:
+            schedule.release(conn_id)
+            if connected:
+                self._record_disconnect()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run gate end-to-end test payloads.')
+    parser.add_argument('files', nargs='*', help='payload file names inside src/payloads (default: all)')
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread',
+                        help='thread: one OS thread per connection; asyncio: all connections on one event loop')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of independent runs (payload files or parallel cases) executed concurrently')
+
+    parser.add_argument('--report-json', metavar='PATH', help='write step results and latency histograms as JSON')
+    parser.add_argument('--junit', metavar='PATH', help='write step results as JUnit XML')
+    parser.add_argument('--mock', action='store_true',
+                        help='run against the bundled in-process gate, NSQ and DB stand-ins instead of real services')
+    parser.add_argument('--metrics-port', type=int, default=config('METRICS_PORT', default=0, cast=int),
+                        metavar='PORT', help='serve live Prometheus metrics on METRICS_HOST:PORT (0: off)')
+    parser.add_argument('--progress', action='store_true',
+                        help='print a compact progress line every PROGRESS_INTERVAL seconds')
+    parser.add_argument('--replay-speed', type=float, default=1.0, metavar='X',
+                        help='play captured steps (with `at`) at X times their recorded pace, 0 for back to back')
+    parser.add_argument('--impair', metavar='SPEC',
+                        help='degrade every device link through a local proxy: a preset (gprs, edge, 3g, flaky) '
+                             'and/or latency=S,jitter=S,bandwidth=B/s,fragment=BYTES,reset=P,reset_after=S,seed=N; '
+                             'a payload or connection `impair` takes precedence')
+    parser.add_argument('--profile-runner', nargs='?', const='phases', metavar='KINDS',
+                        help='time the runner\'s own phases; add cprofile and/or memory (tracemalloc), '
+                             'e.g. phases,cprofile,memory')
+    parser.add_argument('--profile-out', default='runner_profile', metavar='PREFIX',
+                        help='--profile-runner writes PREFIX.json, PREFIX.folded (flamegraph stacks) and PREFIX.pstats')
+
+    load = parser.add_argument_group('load mode', 'replay one scenario from many virtual devices')
+    load.add_argument('--load', action='store_true', help='run the first payload file as a load test')
+    load.add_argument('--devices', type=int, default=1, help='number of virtual devices')
+    load.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='worker processes')
+    load.add_argument('--iterations', type=int, default=1, help='times each device plays the scenario')
+    load.add_argument('--rate', type=float, default=0, help='total packets/sec, 0 for unpaced')
+    load.add_argument('--connect-rate', type=float, default=0, help='total new connections/sec, 0 for unpaced')
+    load.add_argument('--profile', metavar='SPEC',
+                      help='open-loop packet schedule instead of --rate: constant:<rate>, poisson:<rate>[:<seed>], '
+                           'ramp:<from>:<to>:<seconds>, burst:<size>:<period>, spread:<seconds>')
+    load.add_argument('--connect-profile', metavar='SPEC',
+                      help='open-loop connection schedule instead of --connect-rate, same specs; '
+                           'burst:<devices>:<period> replays mass reconnects, spread:<seconds> ramps up to --devices')
+    load.add_argument('--pre-test', action='store_true', help='also run the pre_test SQL of every device')
+    load.add_argument('--keep-alive', action=argparse.BooleanOptionalAction, default=None,
+                      help="reuse device sockets across cases and iterations (default: the payload's keep_alive)")
+    load.add_argument('--prewarm', action='store_true',
+                      help='connect and log in every device before the measured run (implies --keep-alive)')
+
+    dist = parser.add_argument_group('distributed load', 'split a load run over agents on this or other hosts')
+    dist.add_argument('--agent', action='store_true', help='serve load runs for a coordinator')
+    dist.add_argument('--listen', metavar='HOST:PORT', help='agent control address (default 127.0.0.1:AGENT_PORT; '
+                           'other interfaces need AGENT_TOKEN)')
+    dist.add_argument('--agents', metavar='HOST:PORT,...', help='coordinate a --load run over these agents')
+    dist.add_argument('--local-agents', type=int, default=0, metavar='N',
+                      help='coordinate a --load run over N agents started on this host')
+    return parser.parse_args(argv)
+
+
+def run_distributed(args):
+    """Coordinate a load run over --agents and/or --local-agents; exits non-zero unless it passed."""
+    from distributed import Coordinator, parse_address, spawn_local_agents, stop_local_agents, local_token
+    addresses = [parse_address(a) for a in args.agents.split(',')] if args.agents else []
+    procs, local = spawn_local_agents(args.local_agents, mock=args.mock)
+    try:
+        report = Coordinator(addresses + local, token=local_token()).run(
+            args.files[0], devices=args.devices, processes=args.processes, iterations=args.iterations,
+            rate=args.rate, connect_rate=args.connect_rate, pre_test=args.pre_test, keep_alive=args.keep_alive,
+            prewarm=args.prewarm, profile=args.profile, connect_profile=args.connect_profile, impair=args.impair)
+    finally:
+        stop_local_agents(procs, local)
+
+    if report and args.report_json:
+        with open(args.report_json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if report and report['passed'] else 1
+
 
 if __name__ == "__main__":
-    running = RunTest()
-    if len(sys.argv) > 1:
-        running.run(files=sys.argv[1])
+    args = parse_args()
+    if args.agent:
+        from distributed import Agent, AGENT_PORT, parse_address
+        host, port = parse_address(args.listen) if args.listen else ('127.0.0.1', AGENT_PORT)
+        try:
+            agent = Agent(host, port, mock=args.mock)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        agent.serve()
+        raise SystemExit(0)
+    if args.impair:
+        try:
+            parse_impairment(args.impair)
+        except (TypeError, ValueError) as e:
+            raise SystemExit(f"invalid --impair: {e}")
+    if args.agents or args.local_agents:
+        if not args.files:
+            raise SystemExit('a distributed run needs a payload file')
+        raise SystemExit(run_distributed(args))
+
+    if args.profile_runner:
+        kinds = set(args.profile_runner.split(','))
+        if kinds - {'phases', 'cprofile', 'memory'}:
+            raise SystemExit(f"unknown --profile-runner kind: {', '.join(sorted(kinds - {'phases', 'cprofile', 'memory'}))}")
+        if args.load:
+            print('[WARN] --profile-runner covers the functional runner, load workers are not profiled')
+        else:
+            PROFILER.enable(cprofile='cprofile' in kinds, memory='memory' in kinds)
+
+    mock_gate = None
+    if args.mock:
+        from mock_gate import MockGate
+        mock_gate = MockGate().start()
+
+    metrics = progress = None
+    if args.metrics_port or args.progress:
+        from metrics import Progress, serve_metrics
+        metrics = Metrics()
+        if args.metrics_port:
+            serve_metrics(metrics, args.metrics_port)
+        if args.progress:
+            progress = Progress(metrics).start()
+
+    if args.load:
+        if not args.files:
+            raise SystemExit('--load needs a payload file')
+        from load import run_load
+        report = run_load(args.files[0], devices=args.devices, processes=args.processes,
+                          iterations=args.iterations, rate=args.rate, connect_rate=args.connect_rate,
+                          pre_test=args.pre_test, mock_gate=mock_gate, keep_alive=args.keep_alive,
+                          prewarm=args.prewarm, profile=args.profile, connect_profile=args.connect_profile,
+                          impair=args.impair, metrics=metrics)
+        if progress:
+            progress.stop()
+        raise SystemExit(0 if report and report['passed'] else 1)
+
+    if args.engine == 'asyncio':
+        from async_runner import AsyncRunTest
+        running = AsyncRunTest(mock_gate, metrics)
     else:
-        running.run()
-
-# python3 src/runner.py test_case_concox.yml
\ No newline at end of file
+        running = RunTest(mock_gate, metrics)
+    running.replay_speed = args.replay_speed
+    running.impair = args.impair
+    try:
+        running.run(files=args.files or None, jobs=args.jobs)
+    finally:
+        running.close()
+    if progress:
+        progress.stop()
+    if running.nsq_topics:
+        print('[NSQ]', running.nsq_index.stats())
+    for name, stats in running.report.db_pools.items():
+        print(f"[DB] pool {name}:", stats)
+    if running.links:
+        running.links.stop()
+        print('[IMPAIR]', running.links.stats())
+    if mock_gate:
+        mock_gate.stop()
+        print('[MOCK]', mock_gate.stats)
+
+    if args.report_json:
+        running.report.write_json(args.report_json)
+    if args.junit:
+        running.report.write_junit(args.junit)
+    if PROFILER.enabled:
+        PROFILER.report(steps=len(running.report.steps), prefix=args.profile_out)
+
+# python3 src/runner.py test_case_concox.yml
+# python3 src/runner.py test_case_concox.yml --engine asyncio
+# python3 src/runner.py --jobs 4
+# python3 src/runner.py test_case_concox.yml --load --devices 1000 --processes 4 --rate 500
+# python3 src/runner.py --mock --engine asyncio
+# python3 src/runner.py test_case_concox.yml --load --devices 1000 --iterations 20 --prewarm
+# python3 src/runner.py test_case_concox.yml --load --devices 5000 --connect-profile spread:60 --profile poisson:2000
+# python3 src/runner.py captured.yml --engine asyncio --jobs 500 --replay-speed 10
+# python3 src/runner.py test_case_concox.yml --mock --jobs 8 --profile-runner phases,cprofile
+# python3 src/runner.py test_case_concox.yml --impair gprs,fragment=8
+# python3 src/runner.py test_case_concox.yml --load --devices 1000 --impair latency=0.3,jitter=0.1,reset=0.01
+# AGENT_TOKEN=... python3 src/runner.py --agent --listen 0.0.0.0:7400
+# python3 src/runner.py test_case_concox.yml --devices 50000 --agents 10.0.0.5:7400,10.0.0.6:7400 --rate 5000
@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import marshal
+import threading
+import yaml
+import templates
+from helper import expand_templates, replace_variables, encode_send
+
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+VAR_PATTERN = re.compile(r"\$\{(\w+)\}")
+CACHE_DIR = '__pycache__'
+
+
+# RAW PAYLOAD, cached on disk by file mtime
+# bump when the cached tree changes shape; marshal only holds plain data, loading it runs no code
+CACHE_FORMAT = 1
+
+
+def _cache_path(filename):
+    folder, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(folder, CACHE_DIR, f"{name}.payload.marshal")
+
+
+def _parse(filename):
+    with open(filename, encoding="utf-8") as f:
+        if filename.endswith((".yaml", ".yml")):
+            return yaml.load(f, Loader=YamlLoader)
+        return json.load(f)
+
+
+def read_raw(filename):
+    """Parsed payload tree, reusing the cache next to the file while its mtime and size are unchanged."""
+    stat = os.stat(filename)
+    key = (CACHE_FORMAT, stat.st_mtime_ns, stat.st_size)
+    cache_path = _cache_path(filename)
+
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, tree = marshal.load(f)
+        if cached_key == key:
+            return tree
+    except Exception:
+        # missing, stale or unreadable cache, parse again
+        pass
+
+    tree = _parse(filename)
+    try:
+        data = marshal.dumps((key, tree))
+    except ValueError:
+        # YAML dates and the like have no marshal form, parse every time
+        return tree
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # read-only checkout, parse every time
+        pass
+    return tree
+
+
+# COMPILED NODES
+def _placeholders(obj):
+    if isinstance(obj, str):
+        return set(VAR_PATTERN.findall(obj))
+    if isinstance(obj, list):
+        return set().union(*(_placeholders(x) for x in obj)) if obj else set()
+    if isinstance(obj, dict):
+        return set().union(*(_placeholders(v) for v in obj.values())) if obj else set()
+    return set()
+
+
+class _Text:
+    """A string with ${var} placeholders, split once into literal and variable parts."""
+
+    __slots__ = ('parts',)
+
+    def __init__(self, value):
+        pieces = VAR_PATTERN.split(value)
+        # even indexes are literals, odd indexes variable names
+        self.parts = tuple((i % 2 == 1, piece) for i, piece in enumerate(pieces) if piece or i % 2 == 1)
+
+    def bind(self, variables):
+        return ''.join(
+            str(variables.get(piece, f"${{{piece}}}")) if is_var else piece
+            for is_var, piece in self.parts
+        )
+
+
+class _List:
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = tuple(items)
+
+    def bind(self, variables):
+        return [_bind(x, variables) for x in self.items]
+
+
+class _Dict:
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = tuple(items)
+
+    def bind(self, variables):
+        return {k: _bind(v, variables) for k, v in self.items}
+
+
+class _Step(_Dict):
+    """A test step; send and expect_ack are decoded to bytes once when they do not depend on variables."""
+
+    __slots__ = ('msg_type', 'send_bytes', 'expect_bytes')
+
+    def __init__(self, items, msg_type):
+        super().__init__(items)
+        self.msg_type = msg_type
+        fields = dict(self.items)
+        self.send_bytes = self._encode(fields.get('send'))
+        self.expect_bytes = self._decode_expect(fields.get('expect_ack'))
+
+    def _encode(self, send):
+        if not isinstance(send, str):
+            return None
+        try:
+            return encode_send(send, self.msg_type)
+        except ValueError:
+            # invalid payloads fail in the step itself, like before
+            return None
+
+    def _decode_expect(self, expect_ack):
+        if self.msg_type != 'hex' or not isinstance(expect_ack, list) or not all(isinstance(x, str) for x in expect_ack):
+            return None
+        try:
+            # an empty string stands for no frame, see framing.expected_frames()
+            return [bytes.fromhex(x) for x in expect_ack if x]
+        except ValueError:
+            return None
+
+    def bind(self, variables):
+        step = super().bind(variables)
+        send_bytes = self.send_bytes if self.send_bytes is not None else self._encode(step.get('send'))
+        if send_bytes is not None:
+            step['send_bytes'] = send_bytes
+        expect_bytes = self.expect_bytes if self.expect_bytes is not None else self._decode_expect(step.get('expect_ack'))
+        if expect_bytes is not None:
+            step['expect_ack_bytes'] = expect_bytes
+        return step
+
+
+class _Eager:
+    """A $template whose output does not pass its ${var} arguments through; expanded at bind time."""
+
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def bind(self, variables):
+        return expand_templates(replace_variables(self.raw, variables), variables)
+
+
+def _bind(node, variables):
+    if isinstance(node, (_Text, _List, _Dict, _Eager)):
+        return node.bind(variables)
+    return node
+
+
+def _compile(obj):
+    if isinstance(obj, dict) and '$template' in obj:
+        # expand with placeholders left in place; they are bound per device later
+        expanded = expand_templates(obj, {})
+        # objects with state, like generated packets, are made anew for every binding
+        stateful = not isinstance(expanded, (dict, list, str, int, float, bool, type(None)))
+        if stateful or not _placeholders(obj.get('args', [])) <= _placeholders(expanded):
+            return _Eager(obj)
+        return _compile(expanded)
+    if isinstance(obj, dict):
+        return _Dict((k, _compile(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return _List(_compile(x) for x in obj)
+    if isinstance(obj, str) and VAR_PATTERN.search(obj):
+        return _Text(obj)
+    return obj
+
+
+def _compile_step(step, msg_type):
+    if not isinstance(step, dict):
+        return _compile(step)
+    return _Step(((k, _compile(v)) for k, v in step.items()), msg_type)
+
+
+def _compile_connection(conn, msg_type):
+    return _Dict(
+        (k, _List(_compile_step(step, msg_type) for step in v) if k == 'steps' and isinstance(v, list) else _compile(v))
+        for k, v in conn.items()
+    )
+
+
+def _compile_case(case, msg_type):
+    return _Dict(
+        (k, _List(_compile_connection(conn, msg_type) for conn in v) if k == 'connections' and isinstance(v, list)
+         else _compile(v))
+        for k, v in case.items()
+    )
+
+
+class Scenario:
+    """A payload file compiled once; bind() produces the payload dict for one set of variables."""
+
+    __slots__ = ('filename', 'root')
+
+    def __init__(self, filename, tree):
+        self.filename = filename
+        msg_type = tree.get('message_type', 'hex')
+        self.root = _Dict(
+            (k, _List(_compile_case(case, msg_type) for case in v) if k == 'test_case' and isinstance(v, list)
+             else _compile(v))
+            for k, v in tree.items()
+        )
+
+    def bind(self, variables=None):
+        return self.root.bind(templates.vars if variables is None else variables)
+
+    def option(self, key, default=None):
+        """A top-level payload field, bound with the default variables."""
+        value = dict(self.root.items).get(key, default)
+        return _bind(value, templates.vars)
+
+    def connections(self):
+        """Compiled steps per case and connection, as [[(settings steps, named steps), ...], ...].
+
+        Settings steps (no name) carry pod_ip/port/delay; named steps are played. Load mode
+        binds them one at a time with bind_step() instead of the whole payload per device.
+        """
+        cases = []
+        for case in _items(dict(self.root.items).get('test_case')):
+            conns = []
+            for conn in _items(dict(_items(case, {})).get('connections')):
+                steps = _items(dict(_items(conn, {})).get('steps'))
+                named = tuple(x for x in steps if _field(x, 'name'))
+                conns.append((tuple(x for x in steps if not _field(x, 'name')), named))
+            cases.append(conns)
+        return cases
+
+
+def _items(node, default=()):
+    """The entries of a compiled _List/_Dict, or of a plain list/dict left by _compile."""
+    if isinstance(node, (_List, _Dict)):
+        return node.items
+    if isinstance(node, dict):
+        return tuple(node.items())
+    if isinstance(node, list):
+        return tuple(node)
+    return default
+
+
+def _field(node, key):
+    return dict(_items(node, {})).get(key)
+
+
+def bind_step(node, variables=None):
+    """One compiled step bound for a device (default variables if None), see Scenario.connections()."""
+    return _bind(node, templates.vars if variables is None else variables)
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def compile_payload(filename):
+    """Compiled Scenario for a payload file, kept per process until the file changes."""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    with _compiled_lock:
+        scenario = _compiled.get(key)
+    if scenario is None:
+        scenario = Scenario(filename, read_raw(filename))
+        with _compiled_lock:
+            _compiled[key] = scenario
+    return scenario
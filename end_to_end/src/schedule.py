@@ -0,0 +1,139 @@
+import threading
+from decouple import config
+
+# longest a step waits for its predecessors before it fails instead of hanging the case
+SCHEDULE_TIMEOUT = config('SCHEDULE_TIMEOUT', default=60, cast=float)
+
+
+class CasePlan:
+    """Dependencies between the steps of one case, resolved from the payload.
+
+    A connection may be named with `name:`, otherwise it is conn1, conn2, ... Steps declare
+        after: <step> | <connection>.<step> | [...]   start once those steps finished
+        barrier: <name>                               start once every step of that barrier is reached
+    On the settings step of a connection (pod_ip/port/delay) they hold back the whole
+    connection, and its `delay` then counts from the moment they are met.
+
+    The older `block: true` flag becomes a dependency too: connections listed after one
+    with block steps start once its leading block steps finished.
+    """
+
+    def __init__(self, connections):
+        self.names = {}
+        self.after = {}
+        self.barriers = {}
+        self.start_after = {}
+        self.start_barriers = {}
+        self.explicit_start = set()
+
+        steps_by_name = {}
+        for conn_idx, conn in enumerate(connections, start=1):
+            name = conn.get('name') or f"conn{conn_idx}"
+            self.names[conn_idx] = name
+            for pos, step in enumerate(conn.get('steps', [])):
+                if step.get('name'):
+                    steps_by_name.setdefault(step['name'], []).append((conn_idx, pos))
+                    steps_by_name.setdefault(f"{name}.{step['name']}", []).append((conn_idx, pos))
+
+        block_release = None
+        for conn_idx, conn in enumerate(connections, start=1):
+            start_after, start_barriers = [], []
+            if block_release is not None:
+                start_after.append(block_release)
+
+            for pos, step in enumerate(conn.get('steps', [])):
+                refs = step.get('after') or []
+                deps = [self._resolve(ref, steps_by_name) for ref in ([refs] if isinstance(refs, str) else refs)]
+                if step.get('name'):
+                    self.after[(conn_idx, pos)] = deps
+                    if step.get('barrier'):
+                        self.barriers.setdefault(step['barrier'], []).append((conn_idx, pos))
+                else:
+                    start_after.extend(deps)
+                    if step.get('barrier'):
+                        start_barriers.append(step['barrier'])
+                        self.barriers.setdefault(step['barrier'], []).append((conn_idx, None))
+                    if deps or step.get('barrier'):
+                        self.explicit_start.add(conn_idx)
+
+            self.start_after[conn_idx] = start_after
+            self.start_barriers[conn_idx] = start_barriers
+            block_release = self._block_release(conn_idx, conn.get('steps', [])) or block_release
+
+    @staticmethod
+    def _resolve(ref, steps_by_name):
+        found = steps_by_name.get(ref, [])
+        if len(found) != 1:
+            raise ValueError(f"after: '{ref}' must name exactly one step, found {len(found)}")
+        return found[0]
+
+    @staticmethod
+    def _block_release(conn_idx, steps):
+        """The last step of the leading run of block steps, the point where a blocking connection let others go."""
+        release = None
+        for pos, step in enumerate(steps):
+            if not step.get('name'):
+                continue
+            if not step.get('block'):
+                break
+            release = (conn_idx, pos)
+        return release
+
+
+class CaseSchedule:
+    """Runtime state of a CasePlan: one completion event per step and one per barrier.
+
+    event_factory is threading.Event for RunTest and asyncio.Event for AsyncRunTest;
+    the bookkeeping itself never blocks, so both engines share it.
+    """
+
+    def __init__(self, plan: CasePlan, event_factory):
+        self.plan = plan
+        self._lock = threading.Lock()
+        self._done = {key: event_factory() for key in plan.after}
+        self._barriers = {name: [len(parties), event_factory()] for name, parties in plan.barriers.items()}
+        self._arrived = set()
+
+    def delays_start(self, conn_idx):
+        """Whether the connection's delay waits for its own dependencies instead of running in the spawn loop."""
+        return conn_idx in self.plan.explicit_start
+
+    def _arrive(self, name, key):
+        with self._lock:
+            if key in self._arrived:
+                return
+            self._arrived.add(key)
+            barrier = self._barriers[name]
+            barrier[0] -= 1
+            if barrier[0] <= 0:
+                barrier[1].set()
+
+    def start_waits(self, conn_idx):
+        """Events to wait for before the connection opens its socket."""
+        events = [self._done[key] for key in self.plan.start_after[conn_idx]]
+        for name in self.plan.start_barriers[conn_idx]:
+            self._arrive(name, (conn_idx, None))
+            events.append(self._barriers[name][1])
+        return events
+
+    def step_waits(self, conn_idx, pos, step):
+        """Events to wait for before the step runs."""
+        events = [self._done[key] for key in self.plan.after.get((conn_idx, pos), [])]
+        if step.get('barrier'):
+            self._arrive(step['barrier'], (conn_idx, pos))
+            events.append(self._barriers[step['barrier']][1])
+        return events
+
+    def finish(self, conn_idx, pos):
+        if (conn_idx, pos) in self._done:
+            self._done[(conn_idx, pos)].set()
+
+    def release(self, conn_idx):
+        """Mark what is left of a finished or failed connection as done, so no other connection waits on it."""
+        for (idx, pos), event in self._done.items():
+            if idx == conn_idx:
+                event.set()
+        for name, parties in self.plan.barriers.items():
+            for key in parties:
+                if key[0] == conn_idx:
+                    self._arrive(name, key)
@@ -1,35 +1,435 @@
+import os
+import time
+import atexit
+import secrets
+import select
+import asyncio
+import threading
 import psycopg2
+import psycopg2.extensions
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager, asynccontextmanager
 from decouple import config
 
 
+def connect_kwargs(database=None):
+    return dict(
+        host=config('DB_HOST', default='localhost'),
+        database=database or config('DB_NAME', default='localhost'),
+        user=config('DB_USER', default='localhost'),
+        password=config('DB_PASS', default='localhost'),
+        port=config('DB_PORT', default=5432)
+    )
+
+
+def split_statement(statement):
+    """Accept a SQL string, a (query, params) pair or a {'query', 'params'} dict."""
+    if isinstance(statement, dict):
+        return statement['query'], statement.get('params') or []
+    if isinstance(statement, (tuple, list)):
+        return statement[0], statement[1] if len(statement) > 1 else []
+    return statement, []
+
+
+class PoolMetrics:
+    """How often a pool handed out connections, how busy it got and how long callers waited."""
+
+    def __init__(self, size):
+        self.size = size
+        self.acquired = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._lock = threading.Lock()
+
+    def on_acquire(self, waited):
+        with self._lock:
+            self.acquired += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def on_release(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'acquired': self.acquired,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'utilisation': round(self.max_in_use / self.size, 3) if self.size else 0,
+                'wait_total': round(self.wait_total, 6),
+                'wait_mean': round(self.wait_total / self.acquired, 6) if self.acquired else 0,
+                'wait_max': round(self.wait_max, 6),
+            }
+
+    def gauges(self, pool):
+        """The snapshot as metrics.Metrics collector entries, labelled with the pool name."""
+        return [(f"db_pool_{k}", {'pool': pool}, v) for k, v in self.snapshot().items()]
+
+
 class DB:
-    def __init__(self):
-        self.conn = psycopg2.connect(
-            host=config('DB_HOST', default='localhost'),
-            database=config('DB_NAME', default='localhost'),
-            user=config('DB_USER', default='localhost'),
-            password=config('DB_PASS', default='localhost'),
-            port=config('DB_PORT', default=5432)
-        )
-        self.conn.autocommit = True
-        self.cursor = self.conn.cursor()
+    """Bounded pool of autocommit connections; every call runs on its own cursor.
+
+    Callers block while all DB_POOL_MAX connections are busy instead of failing.
+    """
+
+    def __init__(self, minconn=None, maxconn=None, database=None):
+        minconn = minconn or config('DB_POOL_MIN', default=1, cast=int)
+        maxconn = maxconn or config('DB_POOL_MAX', default=16, cast=int)
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs(database))
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.metrics = PoolMetrics(maxconn)
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        self._slots.acquire()
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        self.metrics.on_acquire(time.perf_counter() - start)
+
+        broken = False
+        try:
+            conn.autocommit = True
+            yield conn
+        except psycopg2.OperationalError:
+            broken = True
+            raise
+        finally:
+            self.pool.putconn(conn, close=broken or conn.closed)
+            self.metrics.on_release()
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
 
     def fetch_one(self, query, params=None):
-        self.cursor.execute(query, params or [])
-        return self.cursor.fetchone()
+        with self.cursor() as cursor:
+            cursor.execute(query, params or [])
+            return cursor.fetchone()
 
     def fetch_one_dict(self, query, params=None):
-        self.cursor.execute(query, params or [])
-        row = self.cursor.fetchone()
-        if row is None:
-            return None
-        colnames = [desc[0] for desc in self.cursor.description]
-        return dict(zip(colnames, row))
+        with self.cursor() as cursor:
+            cursor.execute(query, params or [])
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            colnames = [desc[0] for desc in cursor.description]
+            return dict(zip(colnames, row))
 
     def save(self, query, params=None):
-        self.cursor.execute(query, params or [])
-        return self.cursor.rowcount
+        with self.cursor() as cursor:
+            cursor.execute(query, params or [])
+            return cursor.rowcount
+
+    def save_many(self, statements):
+        """Execute several statements in one round trip; returns the rowcount of the last one."""
+        statements = [split_statement(x) for x in statements]
+        if not statements:
+            return 0
+
+        with self.cursor() as cursor:
+            sql = ';\n'.join(cursor.mogrify(query, params or None).decode() for query, params in statements)
+            cursor.execute(sql)
+            return cursor.rowcount
+
+    def close(self):
+        self.pool.closeall()
+
+
+class AsyncDB:
+    """asyncio variant of DB built on psycopg2 asynchronous connections.
+
+    Queries wait on the event loop (add_reader/add_writer) instead of a thread.
+    """
+
+    def __init__(self, maxconn=None, database=None):
+        self.maxconn = maxconn or config('DB_POOL_MAX', default=16, cast=int)
+        self.database = database
+        self.metrics = PoolMetrics(self.maxconn)
+        self._idle = []
+        self._slots = None
+
+    @staticmethod
+    async def _wait(conn):
+        loop = asyncio.get_running_loop()
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+
+            fut = loop.create_future()
+            fd = conn.fileno()
+
+            def _ready():
+                if not fut.done():
+                    fut.set_result(None)
+
+            if state == psycopg2.extensions.POLL_READ:
+                loop.add_reader(fd, _ready)
+                remove = loop.remove_reader
+            elif state == psycopg2.extensions.POLL_WRITE:
+                loop.add_writer(fd, _ready)
+                remove = loop.remove_writer
+            else:
+                raise psycopg2.OperationalError(f"Unexpected poll state: {state}")
+
+            try:
+                await fut
+            finally:
+                remove(fd)
+
+    @asynccontextmanager
+    async def connection(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxconn)
+
+        start = time.perf_counter()
+        await self._slots.acquire()
+        try:
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = psycopg2.connect(async_=True, **connect_kwargs(self.database))
+                await self._wait(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        self.metrics.on_acquire(time.perf_counter() - start)
+
+        try:
+            yield conn
+        except BaseException:
+            # the connection may still have a query in flight
+            conn.close()
+            raise
+        finally:
+            if not conn.closed:
+                self._idle.append(conn)
+            self.metrics.on_release()
+            self._slots.release()
+
+    async def _execute(self, query, params=None, fetch=False):
+        async with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params or [])
+                await self._wait(conn)
+                if not fetch:
+                    return cursor.rowcount
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                colnames = [desc[0] for desc in cursor.description]
+                return dict(zip(colnames, row))
+            finally:
+                cursor.close()
+
+    async def fetch_one_dict(self, query, params=None):
+        return await self._execute(query, params, fetch=True)
+
+    async def save(self, query, params=None):
+        return await self._execute(query, params)
+
+    async def save_many(self, statements):
+        statements = [split_statement(x) for x in statements]
+        if not statements:
+            return 0
+
+        async with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                sql = ';\n'.join(cursor.mogrify(query, params or None).decode() for query, params in statements)
+                cursor.execute(sql)
+                await self._wait(conn)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+# ISOLATION
+# tables a case leaves device state in, all keyed by imei
+ISOLATION_TABLES = ('devices', 'command_queue')
+
+
+class TableSnapshot:
+    """Rows of the isolated tables for a set of IMEIs, restorable in one round trip.
+
+    capture() reads them once as JSON; restore_statements() deletes whatever the
+    case left behind and puts the captured rows back, a single save_many() batch.
+    Without a capture it only deletes, i.e. resets the devices to not existing.
+    """
+
+    def __init__(self, imeis, tables=ISOLATION_TABLES):
+        self.imeis = sorted(imeis)
+        self.tables = tuple(tables)
+        self.rows = {}
+
+    def capture(self, db):
+        for table in self.tables:
+            row = db.fetch_one(f"SELECT COALESCE(json_agg(t), '[]')::text FROM {table} t WHERE imei = ANY(%s)",
+                               [self.imeis])
+            self.rows[table] = row[0] if row else '[]'
+        return self
+
+    def restore_statements(self):
+        statements = []
+        # children first, so a foreign key from command_queue to devices holds
+        for table in reversed(self.tables):
+            statements.append({'query': f"DELETE FROM {table} WHERE imei = ANY(%s)", 'params': [self.imeis]})
+        for table in self.tables:
+            if self.rows.get(table, '[]') != '[]':
+                statements.append({
+                    'query': f"INSERT INTO {table} SELECT * FROM json_populate_recordset(NULL::{table}, %s)",
+                    'params': [self.rows[table]],
+                })
+        return statements
+
+    def restore(self, db):
+        return db.save_many(self.restore_statements())
+
+
+def _admin_connection():
+    conn = psycopg2.connect(**connect_kwargs(config('DB_ADMIN_NAME', default='postgres')))
+    conn.autocommit = True
+    return conn
+
+
+def clone_database(name, template):
+    """(Re)create database `name` as a copy of `template`; the template must have no open connections."""
+    conn = _admin_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+            cursor.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(sql.Identifier(name),
+                                                                            sql.Identifier(template)))
+    finally:
+        conn.close()
+
+
+def drop_database(name):
+    conn = _admin_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(name)))
+    finally:
+        conn.close()
+
+
+NOTIFY_FUNCTION = """
+    CREATE OR REPLACE FUNCTION {name}() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify(TG_TABLE_NAME, COALESCE(NEW.imei, OLD.imei)::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+
+class DBNotifier:
+    """LISTEN on table channels and let waiters wake up on the next change.
+
+    Installs an AFTER trigger per table that pg_notify()s the table name with the
+    changed imei, so only enable it (DB_NOTIFY=true) against a test database. The
+    trigger and function are named per notifier, so runners sharing a database do
+    not drop each other's; close(), which also runs at exit, drops them.
+    """
+
+    def __init__(self, channels=('devices', 'command_queue')):
+        self.name = f"e2e_runner_notify_{os.getpid()}_{secrets.token_hex(4)}"
+        self.conn = psycopg2.connect(**connect_kwargs())
+        self.conn.autocommit = True
+        self.channels = channels
+        self.generation = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+        atexit.register(self.close)
+        try:
+            statements = [NOTIFY_FUNCTION.format(name=self.name)]
+            for table in channels:
+                statements.append(
+                    f"CREATE TRIGGER {self.name} AFTER INSERT OR UPDATE OR DELETE ON {table} "
+                    f"FOR EACH ROW EXECUTE FUNCTION {self.name}()"
+                )
+            self._execute(statements)
+            with self.conn.cursor() as cursor:
+                for table in channels:
+                    cursor.execute(f"LISTEN {table}")
+        except psycopg2.Error:
+            # do not leave half of the triggers behind
+            self.close()
+            raise
+
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _execute(statements):
+        """DDL runs on a connection of its own, the LISTEN one belongs to the listener thread."""
+        conn = psycopg2.connect(**connect_kwargs())
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        finally:
+            conn.close()
+
+    def _listen(self):
+        while not self._closed:
+            if select.select([self.conn], [], [], 1) == ([], [], []):
+                continue
+            try:
+                self.conn.poll()
+            except psycopg2.Error:
+                if self._closed:
+                    return
+                raise
+            if self.conn.notifies:
+                self.conn.notifies.clear()
+                with self._cond:
+                    self.generation += 1
+                    self._cond.notify_all()
+
+    def wait(self, timeout) -> bool:
+        """Block until the next notification or timeout; True when notified."""
+        with self._cond:
+            generation = self.generation
+            return self._cond.wait_for(lambda: self.generation != generation, timeout)
 
     def close(self):
-        self.cursor.close()
+        """Stop listening and drop this notifier's triggers; safe to call more than once."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        if self._thread:
+            # the listener wakes up from select at least once a second
+            self._thread.join(timeout=5)
         self.conn.close()
+        try:
+            self._execute(
+                [f"DROP TRIGGER IF EXISTS {self.name} ON {table}" for table in self.channels]
+                + [f"DROP FUNCTION IF EXISTS {self.name}()"]
+            )
+        except psycopg2.Error as e:
+            print(f"[ERROR] Removing DB notify triggers failed: {e}")
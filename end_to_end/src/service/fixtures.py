@@ -0,0 +1,77 @@
+import io
+from decouple import config
+from psycopg2.extras import execute_values
+from templates import imei_range, _nullable
+
+# above this many rows insert_devices streams them with COPY instead of a multi-row INSERT
+COPY_THRESHOLD = config('BULK_COPY_THRESHOLD', default=1000, cast=int)
+
+UPSERT_DEVICES = """
+    INSERT INTO devices (imei, family, model, target)
+    {source}
+    ON CONFLICT (imei) DO UPDATE
+    SET family = EXCLUDED.family, model = EXCLUDED.model, target = EXCLUDED.target,
+        connection_status = false, connection_status_time = Null
+"""
+
+
+def _copy_value(val):
+    if val is None:
+        return '\\N'
+    return str(val).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def insert_devices(db, imeis, family, model, target):
+    """Upsert one devices row per imei, resetting the connection status like insert_device."""
+    rows = [(imei, _nullable(family), _nullable(model), _nullable(target)) for imei in imeis]
+    if not rows:
+        return 0
+
+    with db.connection() as conn:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cursor:
+                if len(rows) <= COPY_THRESHOLD:
+                    execute_values(cursor, UPSERT_DEVICES.format(source="VALUES %s"), rows, page_size=len(rows))
+                else:
+                    cursor.execute(
+                        "CREATE TEMP TABLE e2e_devices_fixture "
+                        "(imei text, family text, model text, target integer) ON COMMIT DROP"
+                    )
+                    data = io.StringIO(''.join('\t'.join(_copy_value(v) for v in row) + '\n' for row in rows))
+                    cursor.copy_expert("COPY e2e_devices_fixture (imei, family, model, target) FROM STDIN", data)
+                    cursor.execute(UPSERT_DEVICES.format(
+                        source="SELECT imei, family, model, target FROM e2e_devices_fixture"
+                    ))
+                count = cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return count
+
+
+def delete_devices(db, imeis):
+    return db.save("DELETE FROM devices WHERE imei = ANY(%s)", [list(imeis)])
+
+
+def reset_command_queue(db, imeis):
+    return db.save("DELETE FROM command_queue WHERE imei = ANY(%s)", [list(imeis)])
+
+
+FIXTURES = {
+    'insert_devices': lambda db, spec, imeis: insert_devices(db, imeis, spec['family'], spec['model'], spec['target']),
+    'delete_devices': lambda db, spec, imeis: delete_devices(db, imeis),
+    'reset_command_queue': lambda db, spec, imeis: reset_command_queue(db, imeis),
+}
+
+
+def is_fixture(statement):
+    return isinstance(statement, dict) and 'fixture' in statement
+
+
+def run_fixture(db, spec: dict):
+    """Run a fixture produced by one of the *_range templates."""
+    if spec['fixture'] not in FIXTURES:
+        raise ValueError(f"Unknown fixture: {spec['fixture']}")
+    return FIXTURES[spec['fixture']](db, spec, imei_range(spec['start_imei'], spec['count']))
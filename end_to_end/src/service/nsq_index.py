@@ -0,0 +1,182 @@
+import json
+import time
+import threading
+from collections import deque
+from decouple import config
+from profiler import PROFILER, phase
+
+
+class NsqIndex:
+    """NSQ messages received by the runner, decoded once and indexed by (identifier, message_type).
+
+    Checkers block in wait_match() on a condition variable and only look at messages of
+    their own bucket that arrived since their last look, so a check costs O(1) per message.
+
+    Memory is bounded: every bucket keeps at most `retention` unmatched messages, the whole
+    index at most `max_pending`, and messages older than `max_age` seconds are dropped.
+    The oldest messages go first and every drop is counted in stats().
+    """
+
+    def __init__(self, retention=None, max_pending=None, max_age=None):
+        self.retention = retention or config('NSQ_RETENTION', default=1000, cast=int)
+        self.max_pending = max_pending or config('NSQ_MAX_PENDING', default=100000, cast=int)
+        self.max_age = config('NSQ_MAX_AGE', default=600, cast=float) if max_age is None else max_age
+
+        self._cond = threading.Condition()
+        self._buckets = {}
+        self._seq = 0
+        self._count = 0
+        # arrival order over all buckets as (seq, key, received); matched entries are skipped lazily
+        self._arrivals = deque()
+        self._stats = dict.fromkeys(
+            ('received', 'matched', 'decode_errors', 'dropped_retention', 'dropped_pending', 'dropped_expired'), 0
+        )
+
+    def __len__(self):
+        with self._cond:
+            return self._count
+
+    @staticmethod
+    def _key(identifier, message_type):
+        return str(identifier), message_type
+
+    def add(self, raw):
+        try:
+            msg = json.loads(raw.decode() if isinstance(raw, bytes) else raw)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            print('[ERROR] Failed decode message nsq')
+            with self._cond:
+                self._stats['decode_errors'] += 1
+            return
+
+        now = time.time()
+        with PROFILER.acquire(self._cond):
+            self._seq += 1
+            self._stats['received'] += 1
+            key = self._key(msg.get('identifier'), msg.get('message_type'))
+            bucket = self._buckets.setdefault(key, {})
+            bucket[self._seq] = msg
+            self._count += 1
+            self._arrivals.append((self._seq, key, now))
+
+            if len(bucket) > self.retention:
+                # buckets are in arrival order, the first one is the oldest
+                del bucket[next(iter(bucket))]
+                self._count -= 1
+                self._stats['dropped_retention'] += 1
+            self._evict(now)
+            self._cond.notify_all()
+
+    def _evict(self, now):
+        """Drop expired messages and the oldest ones beyond max_pending; call with the lock held."""
+        arrivals = self._arrivals
+        while arrivals:
+            seq, key, received = arrivals[0]
+            expired = self.max_age and now - received > self.max_age
+            if not expired and self._count <= self.max_pending:
+                break
+            arrivals.popleft()
+            bucket = self._buckets.get(key)
+            if bucket is None or seq not in bucket:
+                continue
+            del bucket[seq]
+            if not bucket:
+                del self._buckets[key]
+            self._count -= 1
+            self._stats['dropped_expired' if expired else 'dropped_pending'] += 1
+
+        if len(arrivals) > 2 * self._count + 1024:
+            # mostly matched entries, rebuild so the queue stays proportional to what is pending
+            self._arrivals = deque(x for x in arrivals if x[0] in self._buckets.get(x[1], ()))
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=self._count, buckets=len(self._buckets))
+
+    def pending(self, identifiers=None):
+        """Messages not matched yet, limited to `identifiers` when given, in arrival order."""
+        with self._cond:
+            found = [
+                (seq, msg)
+                for (identifier, _), bucket in self._buckets.items()
+                if identifiers is None or identifier in identifiers
+                for seq, msg in bucket.items()
+            ]
+        return [msg for _, msg in sorted(found, key=lambda x: x[0])]
+
+    def wait_match(self, expected: dict, timeout) -> bool:
+        """Consume the first message matching `expected`, waiting up to `timeout` seconds for it."""
+        deadline = time.time() + timeout
+        seen = {}
+
+        with PROFILER.acquire(self._cond):
+            while True:
+                with phase('nsq_match'):
+                    if self._match_new(expected, seen):
+                        return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                with phase('nsq_wait'):
+                    self._cond.wait(remaining)
+
+    def _match_new(self, expected: dict, seen: dict) -> bool:
+        """Consume the first match among messages arrived since `seen`; call with the lock held."""
+        for key in self._candidate_keys(expected):
+            bucket = self._buckets[key]
+            last = seen.get(key, 0)
+            for seq, msg in bucket.items():
+                if seq <= last:
+                    continue
+                if self._matches(msg, expected):
+                    self._consume(key, seq, msg)
+                    return True
+            if bucket:
+                seen[key] = next(reversed(bucket))
+        return False
+
+    def _candidate_keys(self, expected: dict):
+        identifier = expected.get('identifier', '')
+        message_type = expected.get('message_type')
+        if identifier not in ('', None):
+            key = self._key(identifier, message_type)
+            return [key] if key in self._buckets else []
+        return [key for key in self._buckets if key[1] == message_type]
+
+    def _consume(self, key, seq, msg):
+        bucket = self._buckets[key]
+        del bucket[seq]
+        self._count -= 1
+        self._stats['matched'] += 1
+
+        if 'data' in msg:
+            # the gate may publish the same packet twice for one device
+            for dup_seq in [s for s, m in bucket.items() if m.get('data') == msg['data']]:
+                print('Duplicate data', msg['data'])
+                del bucket[dup_seq]
+                self._count -= 1
+
+        if not bucket:
+            del self._buckets[key]
+
+    @staticmethod
+    def _matches(msg: dict, expected: dict) -> bool:
+        if set(msg.keys()) != set(expected.keys()):
+            return False
+
+        for k, exp_v in expected.items():
+            if isinstance(exp_v, dict):
+                try:
+                    message = msg[k] if isinstance(msg[k], dict) else json.loads(msg[k])
+                except (TypeError, ValueError):
+                    return False
+
+                # nested dicts like "message"
+                for sub_k, sub_v in exp_v.items():
+                    if sub_v != '' and str(message.get(sub_k)) != str(sub_v):
+                        return False
+            elif exp_v != '' and str(msg.get(k)) != str(exp_v):
+                return False
+
+        return True
@@ -0,0 +1,85 @@
+import time
+import asyncio
+from framing import frame_reader
+
+
+class Session:
+    """One device socket with its frame reader, kept across cases while the gate keeps it open."""
+
+    __slots__ = ('host', 'port', 'stream', 'writer', 'reader', 'warmed')
+
+    def __init__(self, host, port, stream, writer, reader):
+        self.host = host
+        self.port = port
+        self.stream = stream
+        self.writer = writer
+        self.reader = reader
+        # prewarm already played the first step of the first case on it
+        self.warmed = False
+
+    @property
+    def alive(self):
+        return not (self.writer.is_closing() or self.stream.at_eof())
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+class SessionManager:
+    """Device sockets of one load worker, keyed by (device slot, connection index).
+
+    With keep_alive a socket outlives its connection block and is handed to the same
+    connection of the next case or iteration, as long as it targets the same gate.
+    A new socket is only opened when there is none yet, the target changed or the
+    gate closed the old one; the latter counts as a reconnect. Connect latency is
+    recorded from the slot the connect pacer scheduled.
+    """
+
+    def __init__(self, stats, connect_pacer, keep_alive=False, timeout=30):
+        self.stats = stats
+        self.connect_pacer = connect_pacer
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._sessions = {}
+
+    async def acquire(self, key, host, port, msg_type, device_type):
+        """An open session for `key`, or None when connecting failed."""
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            if session.alive and (session.host, session.port) == (host, port):
+                self.stats.sessions_reused += 1
+                return session
+            if not session.alive:
+                self.stats.reconnects += 1
+            self._close(session)
+
+        intended = await self.connect_pacer.wait()
+        try:
+            stream, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stats.connect_failures += 1
+            return None
+        self.stats.latency['connect'].record(time.perf_counter() - intended)
+
+        self.stats.connections += 1
+        self.stats.active += 1
+        self.stats.max_active = max(self.stats.max_active, self.stats.active)
+        return Session(host, port, stream, writer, frame_reader(msg_type, device_type))
+
+    def release(self, key, session, closed=False):
+        """Park the session for the next use of `key`, or close it; returns whether it was parked."""
+        if self.keep_alive and not closed and session.alive:
+            self._sessions[key] = session
+            return True
+        self._close(session)
+        return False
+
+    def _close(self, session):
+        self.stats.active -= 1
+        session.close()
+
+    def close_all(self):
+        for session in self._sessions.values():
+            self._close(session)
+        self._sessions.clear()
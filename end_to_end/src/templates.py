@@ -1,6 +1,10 @@
 from decouple import config
+from packets import PacketStream
 from datetime import datetime, timedelta, timezone
 
+# the date vars below are relative to this moment; DB timestamp assertions allow for the time since
+VARS_TAKEN_AT = datetime.now(timezone.utc)
+
 vars = {
     'imei': config('IMEI_0', default='123000000000001', cast=str),
     'imei_hex': config('IMEI_0', default='123000000000001', cast=str).encode().hex(),
@@ -22,6 +26,30 @@ vars = {
     'date_now': (datetime.now(timezone(timedelta(hours=7))).astimezone(timezone.utc)).isoformat()
 }
 
+# ISOLATED IMEIS
+# Parallel runs draw their IMEIs from a dedicated pool so DB rows and NSQ
+# messages of concurrent runs never share an identifier.
+IMEI_POOL_PREFIX = config('IMEI_POOL_PREFIX', default='123900', cast=str)
+IMEI_VARS = ('imei', 'imei_1', 'imei_trackvision')
+
+def imei_from_pool(seq):
+    return f"{IMEI_POOL_PREFIX}{seq:0{15 - len(IMEI_POOL_PREFIX)}d}"
+
+def device_vars(slot):
+    """Return a copy of vars with distinct IMEIs for run slot `slot`; slot 0 keeps the configured IMEIs."""
+    slot_vars = dict(vars)
+    if slot == 0:
+        return slot_vars
+
+    for i, key in enumerate(IMEI_VARS):
+        slot_vars[key] = imei_from_pool(slot * len(IMEI_VARS) + i)
+    slot_vars['imei_hex'] = slot_vars['imei'].encode().hex()
+    slot_vars['imei_1_hex'] = slot_vars['imei_1'].encode().hex()
+    return slot_vars
+
+def device_identifiers(variables):
+    return {str(variables[key]) for key in IMEI_VARS}
+
 # TEMPLATE DATA
 def nsq_data(imei=None, raw_data=None, model=None, family=None):
     return {
@@ -96,28 +124,73 @@ def to_hex_string(str):
     return str.encode().hex()
 
 # PRE-TEST
+def _nullable(val):
+    return None if val in (None, 'None', 'null') else val
+
 def delete_device(imei):
-    return f"DELETE FROM devices WHERE imei = '{imei}'"
+    return {"query": "DELETE FROM devices WHERE imei = %s", "params": [imei]}
 
 def update_ip_port(imei, host, port):
-    return f"UPDATE devices SET pod_ip = '{host}:{port}' WHERE imei = '{imei}'"
+    return {"query": "UPDATE devices SET pod_ip = %s WHERE imei = %s", "params": [f"{host}:{port}", imei]}
 
 def insert_device(imei, family, model, target):
-    def quote(val):
-        if val in (None, 'None', 'null'):
-            return 'null'
-        return f"'{val}'"
-
-    family = quote(family)
-    model = quote(model)
-    target = 'null' if target in (None, 'None', 'null') else str(target)
-
-    return f"""
-        INSERT INTO devices (imei, family, model, target)
-        VALUES ('{imei}', {family}, {model}, {target})
-        ON CONFLICT (imei) DO UPDATE
-        SET family = {family}, model = {model}, target = {target}, connection_status = false, connection_status_time = Null
-    """
+    return {
+        "query": """
+            INSERT INTO devices (imei, family, model, target)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (imei) DO UPDATE
+            SET family = EXCLUDED.family, model = EXCLUDED.model, target = EXCLUDED.target,
+                connection_status = false, connection_status_time = Null
+        """,
+        "params": [imei, _nullable(family), _nullable(model), _nullable(target)],
+    }
 
 def reset_command_queue(imei):
-    return f"DELETE FROM command_queue WHERE imei = '{imei}'"
+    return {"query": "DELETE FROM command_queue WHERE imei = %s", "params": [imei]}
+
+# BULK PRE-TEST
+# Fixtures for many devices at once, executed by service.fixtures. The IMEI range
+# is only generated when the fixture runs, e.g.
+#   - $template: insert_devices_range
+#     args: ["${imei}", 10000, "concox", "x3", "${target_nsq_debug}"]
+def imei_range(start_imei, count):
+    start_imei = str(start_imei)
+    first = int(start_imei)
+    return [str(first + i).zfill(len(start_imei)) for i in range(int(count))]
+
+def insert_devices_range(start_imei, count, family, model, target):
+    return {
+        "fixture": "insert_devices",
+        "start_imei": start_imei,
+        "count": count,
+        "family": family,
+        "model": model,
+        "target": target,
+    }
+
+def delete_devices_range(start_imei, count):
+    return {"fixture": "delete_devices", "start_imei": start_imei, "count": count}
+
+def reset_command_queue_range(start_imei, count):
+    return {"fixture": "reset_command_queue", "start_imei": start_imei, "count": count}
+
+# GENERATED PACKETS
+# Instead of a fixed hex string a step can send a packet built per send, with a valid
+# checksum, the next serial number and the current time (see packets.py), e.g.
+#   send:
+#     $template: concox_location_packet
+#     args: [-6.2, 106.8]
+def concox_login_packet(imei, serial=1):
+    return PacketStream('concox_login', imei, serial=serial)
+
+def concox_heartbeat_packet(serial=1):
+    return PacketStream('concox_heartbeat', serial=serial)
+
+def concox_location_packet(lat=-7.269, lon=113.333, speed=0, course=0, serial=1):
+    return PacketStream('concox_location', lat=lat, lon=lon, speed=speed, course=course, serial=serial)
+
+def teltonika_login_packet(imei):
+    return PacketStream('teltonika_login', imei)
+
+def teltonika_avl_packet(lat=-7.269, lon=113.333, speed=0, records=1):
+    return PacketStream('teltonika_avl', lat=lat, lon=lon, speed=speed, records=records)